@@ -1,10 +1,10 @@
 from django.contrib import admin
-from .models import PDFDocument, QuizSession, Question, ChatMessage
+from .models import PDFDocument, QuizSession, Question, ChatMessage, BackgroundJob, BankQuestion
 
 @admin.register(PDFDocument)
 class PDFDocumentAdmin(admin.ModelAdmin):
-    list_display = ['title', 'total_pages', 'processed', 'uploaded_at']
-    list_filter = ['processed', 'uploaded_at']
+    list_display = ['title', 'total_pages', 'processed', 'stage', 'uploaded_at']
+    list_filter = ['processed', 'stage', 'uploaded_at']
     search_fields = ['title']
     readonly_fields = ['id', 'uploaded_at']
 
@@ -24,3 +24,15 @@ class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ['document', 'message', 'timestamp']
     list_filter = ['timestamp']
     search_fields = ['document__title', 'message']
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'document', 'status', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
+
+@admin.register(BankQuestion)
+class BankQuestionAdmin(admin.ModelAdmin):
+    list_display = ['document', 'topic', 'question_text', 'page', 'times_served', 'created_at']
+    list_filter = ['topic']
+    search_fields = ['document__title', 'question_text']
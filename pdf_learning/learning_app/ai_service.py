@@ -1,22 +1,63 @@
 import os
 import json
+import math
 import re
-from typing import List, Dict, Any, Optional
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-import requests
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Dict, Any, NamedTuple, Optional, Tuple
+import numpy as np
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from . import caches
+from .chunker import TextChunk
+from .dedup import SemanticDeduplicator
+from .embedding_cache import EmbeddingCache
+from .health import acheck_llm_health, check_llm_health
+from .lexical_index import LexicalIndex, get_lexical_index, reciprocal_rank_fusion
+from .llm_client import (AsyncOllamaClient, LLMUnavailableError, OllamaClient, get_async_llm_client,
+                         get_llm_client)
+from .pdf_processor import PDFProcessor
+from .reranker import cross_encoder_order, mmr_order, trim_to_budget
+from .response_cache import get_response_cache
+from .scheduler import INTERACTIVE, get_scheduler
+from .shared_resources import (get_embedding_model, get_chroma_client, is_embedding_model_loaded,
+                               load_embedding_model_in_background)
+
+class CachedEmbeddings(NamedTuple):
+    vectors: np.ndarray
+    missed: List[int]  # Indices that had to be encoded
 
 class AIService:
-    def __init__(self):
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.chroma_client = chromadb.PersistentClient(path=str(settings.CHROMA_DB_PATH))
-        self.ollama_url = "http://localhost:11434"
+    def __init__(self, llm_client: Optional[OllamaClient] = None,
+                 async_llm_client: Optional[AsyncOllamaClient] = None,
+                 priority: str = INTERACTIVE, fairness_key: str = ""):
+        # The embedding model, vector store and LLM connection pool are shared
+        # per process, so constructing an AIService is cheap to do per request.
+        self.llm_client = llm_client or get_llm_client()
+        self._async_llm_client = async_llm_client
+        # Every generation waits for a slot from the process-wide LLM scheduler:
+        # priority picks the queue, and requests with different fairness keys
+        # (documents, quizzes) take turns within it.
+        self.priority = priority
+        self.fairness_key = fairness_key
+    
+    @property
+    def async_llm_client(self) -> AsyncOllamaClient:
+        # Looked up lazily: the shared async client belongs to the running event loop
+        return self._async_llm_client or get_async_llm_client()
+    
+    @property
+    def embedding_model(self):
+        return get_embedding_model()
+    
+    @property
+    def chroma_client(self):
+        return get_chroma_client()
         
     def create_collection(self, document_id: str):
         """Create a new collection for a document"""
-        collection_name-= f"doc_{document_id}".replace('-', '_')
+        collection_name = f"doc_{document_id}".replace('-', '_')
         try:
             collection = self.chroma_client.create_collection(
                 name=collection_name,
@@ -27,66 +68,472 @@ class AIService:
             # Collection might already exist
             return self.chroma_client.get_collection(name=collection_name)
     
-    def add_text_chunks(self, document_id: str, text_chunks: List[str], page_numbers: List[int]):
+    def add_text_chunks(self, document_id: str, text_chunks: List[str], page_numbers: List[int],
+                        page_ends: Optional[List[int]] = None) -> Dict[str, float]:
         """Add text chunks to the vector database"""
+        page_ends = page_ends or page_numbers
+        chunks = (
+            TextChunk(text=text, page=page_num, page_end=page_end, tokens=0)
+            for text, page_num, page_end in zip(text_chunks, page_numbers, page_ends)
+        )
+        return self.add_chunk_stream(document_id, chunks)
+    
+    def add_chunk_stream(self, document_id: str, chunks: Iterable[TextChunk], batch_size: Optional[int] = None,
+                         on_batch: Optional[Callable[[int], None]] = None) -> Dict[str, float]:
+        """Embed and store chunks in batches as they are produced.
+        
+        Only one batch of text and float32 embeddings is held at a time, and
+        batches never exceed the vector store's maximum write size.
+        on_batch is called with the running number of chunks stored.
+        """
         collection = self.create_collection(document_id)
+        batch_size = min(batch_size or settings.EMBEDDING_BATCH_SIZE, self.chroma_client.get_max_batch_size())
+        
+        cache = EmbeddingCache()
+        lexical = get_lexical_index()
+        stored = 0
+        cache_hits = 0
+        started = time.perf_counter()
+        batch = []
+        
+        def flush():
+            nonlocal cache_hits
+            texts = [chunk.text for chunk in batch]
+            embeddings = self.embed_with_cache(texts, cache)
+            cache_hits += len(texts) - len(embeddings.missed)
+            ids = [f"chunk_{stored + i}" for i in range(len(batch))]
+            
+            # Upsert keeps re-ingesting the same content into a shared collection idempotent
+            collection.upsert(
+                embeddings=embeddings.vectors,
+                documents=texts,
+                metadatas=[
+                    {"page": chunk.page, "page_end": chunk.page_end, "chunk_id": stored + i}
+                    for i, chunk in enumerate(batch)
+                ],
+                ids=ids
+            )
+            if lexical:
+                lexical.add_chunks(document_id, [(chunk_id, chunk.text, chunk.page, chunk.page_end)
+                                                 for chunk_id, chunk in zip(ids, batch)])
         
-        embeddings = self.embedding_model.encode(text_chunks).tolist()
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+                stored += len(batch)
+                batch = []
+                if on_batch:
+                    on_batch(stored)
         
-        ids = [f"chunk_{i}" for i in range(len(text_chunks))]
-        metadatas = [{"page": page_num, "chunk_id": i} for i, page_num in enumerate(page_numbers)]
+        if batch:
+            flush()
+            stored += len(batch)
+            if on_batch:
+                on_batch(stored)
         
-        collection.add(
-            embeddings=embeddings,
-            documents=text_chunks,
-            metadatas=metadatas,
-            ids=ids
-        )
+        # Ids are positional: drop any left over from an earlier ingest that produced more chunks
+        stale = collection.get(where={"chunk_id": {"$gte": stored}}, include=[])['ids']
+        if stale:
+            collection.delete(ids=stale)
+            if lexical:
+                lexical.delete_chunks(document_id, stale)
+        
+        elapsed = time.perf_counter() - started
+        stats = {
+            'chunks': stored,
+            'seconds': round(elapsed, 2),
+            'chunks_per_second': round(stored / elapsed, 1) if elapsed > 0 else 0.0,
+            'cache_hits': cache_hits,
+        }
+        print(f"Embedded {stored} chunks for document {document_id} "
+              f"in {stats['seconds']}s ({stats['chunks_per_second']} chunks/s, {cache_hits} from cache)")
+        return stats
     
-    def retrieve_relevant_context(self, document_id: str, query: str, n_results: int = 5) -> List[str]:
-        """Retrieve relevant context for a query"""
+    def embed_with_cache(self, texts: List[str], cache: EmbeddingCache) -> CachedEmbeddings:
+        """Embed texts, reusing cached vectors and encoding only the misses"""
+        cached = cache.get_many(texts)
+        missed = [i for i, vector in enumerate(cached) if vector is None]
+        
+        if missed:
+            encoded = self.embedding_model.encode(
+                [texts[i] for i in missed],
+                batch_size=settings.EMBEDDING_ENCODE_BATCH_SIZE,
+                convert_to_numpy=True
+            ).astype(np.float32, copy=False)
+            cache.put_many([texts[i] for i in missed], encoded)
+            for i, vector in zip(missed, encoded):
+                cached[i] = vector
+        
+        return CachedEmbeddings(vectors=np.vstack(cached), missed=missed)
+    
+    def retrieve_relevant_context(self, document_id: str, query: str, n_results: int = 5,
+                                  page_range: str = "", total_pages: Optional[int] = None) -> List[str]:
+        """Retrieve relevant context for a query, optionally limited to a page range"""
+        return self.retrieve_for_queries(document_id, [query], n_results, page_range, total_pages)
+    
+    def retrieve_for_queries(self, document_id: str, queries: List[str], n_results: int = 5,
+                             page_range: str = "", total_pages: Optional[int] = None,
+                             limit: Optional[int] = None) -> List[str]:
+        """Retrieve context for several queries in one embedding call and one vector-store query.
+        
+        Each query contributes its n_results nearest chunks; chunks found by
+        more than one query are merged by id and ranked by their best
+        distance. With hybrid search on, keyword matches from the lexical
+        index are fused in by reciprocal rank. At most limit chunks are returned.
+        """
+        if not queries:
+            return []
+        
+        pages = self.pages_in_range(page_range, total_pages)
+        cache_key = (document_id, tuple(caches.normalize_query(q) for q in queries), n_results, tuple(pages))
+        cached = caches.retrieval_results.get(cache_key)
+        if cached is not None:
+            return cached[:limit]
+        
+        lexical = get_lexical_index()
+        if lexical and not is_embedding_model_loaded():
+            # Answer from the keyword index rather than wait for the model to load;
+            # not cached, since vector results will be better once it has
+            load_embedding_model_in_background()
+            chunks = [hit['text'] for hit in self.lexical_ranking(lexical, document_id, queries, n_results, pages)]
+            if chunks:
+                return chunks[:limit]
+        
         collection_name = f"doc_{document_id}".replace('-', '_')
         try:
             collection = self.chroma_client.get_collection(name=collection_name)
-            query_embedding = self.embedding_model.encode([query]).tolist()
-            
-            results = collection.query(
-                query_embeddings=query_embedding,
-                n_results=n_results
-            )
+            query_embeddings = self.embed_queries(queries)
+            where = {"page": {"$in": pages}} if pages else None
             
-            return results['documents'][0] if results['documents'] else []
+            # A handful of pages holds few chunks: rank them directly
+            # instead of searching the whole index
+            if pages and len(pages) <= settings.PAGE_RANGE_SCAN_MAX_PAGES:
+                results = self.rank_chunks(collection.get(where=where, include=["documents", "embeddings"]),
+                                           query_embeddings, n_results)
+            else:
+                results = collection.query(
+                    query_embeddings=query_embeddings.tolist(),
+                    n_results=n_results,
+                    where=where,
+                    include=["documents", "distances"]
+                )
         except Exception as e:
             print(f"Error retrieving context: {e}")
             return []
+        
+        ranked = self.ranked_chunks(results)
+        if lexical:
+            ranked = self.fuse_lexical(ranked, self.lexical_ranking(lexical, document_id, queries, n_results, pages))
+        
+        chunks = [document for _, document in ranked]
+        if chunks:
+            caches.retrieval_results.set(cache_key, chunks)
+        return chunks[:limit]
     
-    def call_gemma(self, prompt: str, max_tokens: int = 1000) -> str:
-        """Call Gemma 2B via Ollama"""
+    def lexical_ranking(self, lexical: LexicalIndex, document_id: str, queries: List[str], n_results: int,
+                        pages: List[int] = ()) -> List[Dict[str, Any]]:
+        """Keyword matches for each query, fused into one ranking of unique chunks"""
+        hits = {}
+        rankings = []
+        for query in queries:
+            matches = lexical.search(document_id, query, n_results, pages)
+            hits.update((hit['id'], hit) for hit in matches)
+            rankings.append([hit['id'] for hit in matches])
+        return [hits[chunk_id] for chunk_id, _ in reciprocal_rank_fusion(rankings)]
+    
+    def fuse_lexical(self, ranked: List[Tuple[str, str]], lexical_hits: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+        """Fuse vector-ranked (id, text) pairs with keyword hits by reciprocal rank.
+        
+        Keyword hits can displace weaker vector results but don't lengthen
+        the list, so prompt sizes stay the same.
+        """
+        if not lexical_hits:
+            return ranked
+        texts = dict(ranked)
+        texts.update((hit['id'], hit['text']) for hit in lexical_hits)
+        fused = reciprocal_rank_fusion([[chunk_id for chunk_id, _ in ranked], [hit['id'] for hit in lexical_hits]])
+        # Keep the keyword hits when the vector search found nothing
+        return [(chunk_id, texts[chunk_id]) for chunk_id, _ in fused[:len(ranked) or len(lexical_hits)]]
+    
+    def retrieve_reranked(self, document_id: str, query: str, top_k: Optional[int] = None,
+                          candidates: Optional[int] = None, method: Optional[str] = None,
+                          token_budget: Optional[int] = None) -> List[str]:
+        """Retrieve prompt context: over-fetch candidates, rerank them and trim to a token budget.
+        
+        method is 'mmr' (relevant but not redundant), 'cross_encoder' (each
+        candidate scored against the query by a small local model) or 'none'
+        (the top_k nearest chunks). Fewer, better chunks mean a shorter prompt
+        and a faster answer.
+        """
+        method = method or settings.RERANK_METHOD
+        top_k = top_k or settings.RERANK_TOP_K
+        token_budget = settings.CHAT_CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+        
+        if method == 'none':
+            chunks = self.retrieve_relevant_context(document_id, query, n_results=top_k)
+        else:
+            chunks = self.rerank_candidates(document_id, query, top_k, candidates or settings.RERANK_CANDIDATES, method)
+        return trim_to_budget(chunks, token_budget)
+    
+    def rerank_candidates(self, document_id: str, query: str, top_k: int, candidates: int, method: str) -> List[str]:
+        """The top_k of a query's candidate chunks after reranking with method.
+        
+        Candidates are the nearest chunks plus, with hybrid search on, the best
+        keyword matches, fused by reciprocal rank; MMR then uses the fused
+        score as each candidate's relevance.
+        """
+        if method not in ('mmr', 'cross_encoder'):
+            raise ValueError(f"Unknown rerank method '{method}'")
+        
+        cache_key = (document_id, (method, caches.normalize_query(query)), candidates, top_k)
+        cached = caches.retrieval_results.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        lexical = get_lexical_index()
+        if lexical and not is_embedding_model_loaded():
+            # Keyword matches only until the embedding model has loaded
+            load_embedding_model_in_background()
+            chunks = [hit['text'] for hit in lexical.search(document_id, query, top_k)]
+            if chunks:
+                return chunks
+        
+        collection_name = f"doc_{document_id}".replace('-', '_')
         try:
-            response = requests.post(
-                f"{self.ollama_url}/api/generate",
-                json={
-                    "model": "gemma2:2b",
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.3,  # Lower temperature for more consistent output
-                        "top_p": 0.8,
-                        "num_predict": max_tokens
-                    }
-                },
-                timeout=120  # Increased timeout
+            collection = self.chroma_client.get_collection(name=collection_name)
+            query_embeddings = self.embed_queries([query])
+            results = collection.query(
+                query_embeddings=query_embeddings.tolist(),
+                n_results=max(candidates, top_k),
+                include=["documents", "embeddings"]
             )
+            pool = {
+                chunk_id: (document, embedding)
+                for chunk_id, document, embedding in zip(results['ids'][0], results['documents'][0],
+                                                         results['embeddings'][0])
+            }
+            rankings = [list(pool)]
             
-            if response.status_code == 200:
-                return response.json().get('response', '')
-            else:
-                print(f"Ollama API error: {response.status_code}")
-                return "Error: Could not generate response"
-                
+            hits = lexical.search(document_id, query, max(candidates, top_k)) if lexical else []
+            if hits:
+                rankings.append([hit['id'] for hit in hits])
+                # Keyword-only matches need their stored embeddings for MMR
+                missing = [hit['id'] for hit in hits if hit['id'] not in pool]
+                if missing:
+                    extra = collection.get(ids=missing, include=["documents", "embeddings"])
+                    pool.update((chunk_id, (document, embedding)) for chunk_id, document, embedding
+                                in zip(extra['ids'], extra['documents'], extra['embeddings']))
         except Exception as e:
-            print(f"Error calling Gemma: {e}")
-            return "Error: AI service unavailable"
+            print(f"Error retrieving context: {e}")
+            return []
+        
+        fused = [(chunk_id, score) for chunk_id, score in reciprocal_rank_fusion(rankings) if chunk_id in pool]
+        if not fused:
+            return []
+        ids = [chunk_id for chunk_id, _ in fused]
+        documents = [pool[chunk_id][0] for chunk_id in ids]
+        if method == 'mmr':
+            # With only vector candidates, rank by similarity to the query as usual
+            relevance = [score for _, score in fused] if len(rankings) > 1 else None
+            order = mmr_order(query_embeddings[0], [pool[chunk_id][1] for chunk_id in ids], top_k,
+                              settings.RERANK_MMR_LAMBDA, relevance=relevance)
+        else:
+            order = cross_encoder_order(query, documents, top_k)
+        
+        chunks = [documents[i] for i in order]
+        caches.retrieval_results.set(cache_key, chunks)
+        return chunks
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Embed queries, encoding only those not already in the query embedding cache"""
+        keys = [caches.normalize_query(query) for query in queries]
+        vectors = [caches.query_embeddings.get(key) for key in keys]
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            encoded = self.embedding_model.encode([queries[i] for i in missing])
+            for i, vector in zip(missing, encoded):
+                vectors[i] = np.asarray(vector, dtype=np.float32)
+                caches.query_embeddings.set(keys[i], vectors[i])
+        
+        return np.stack(vectors)
+    
+    def merge_results(self, results: Dict[str, Any]) -> List[str]:
+        """Flatten per-query results into unique chunks, closest first"""
+        return [document for _, document in self.ranked_chunks(results)]
+    
+    def ranked_chunks(self, results: Dict[str, Any]) -> List[Tuple[str, str]]:
+        """Unique (chunk id, document) pairs from per-query results, closest first"""
+        best = {}  # chunk id -> (distance, document)
+        for ids, documents, distances in zip(results.get('ids') or [], results.get('documents') or [],
+                                             results.get('distances') or []):
+            for chunk_id, document, distance in zip(ids, documents, distances):
+                if chunk_id not in best or distance < best[chunk_id][0]:
+                    best[chunk_id] = (distance, document)
+        ranked = sorted(best.items(), key=lambda item: item[1][0])
+        return [(chunk_id, document) for chunk_id, (_, document) in ranked]
+    
+    def pages_in_range(self, page_range: str, total_pages: Optional[int]) -> List[int]:
+        """1-indexed pages selected by a page range string; empty means the whole document"""
+        if not page_range or not page_range.strip() or not total_pages:
+            return []
+        return [page + 1 for page in PDFProcessor().parse_page_range(page_range, total_pages)]
+    
+    def rank_chunks(self, chunks: Dict[str, Any], query_embeddings: np.ndarray, n_results: int) -> Dict[str, Any]:
+        """Rank chunks returned by collection.get against each query, shaped like a query() result"""
+        documents = chunks.get('documents') or []
+        results = {'ids': [], 'documents': [], 'distances': []}
+        if not documents:
+            return results
+        
+        embeddings = np.asarray(chunks['embeddings'], dtype=np.float32)
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.outer(np.linalg.norm(query_embeddings, axis=1), np.linalg.norm(embeddings, axis=1))
+        distances = 1 - (query_embeddings @ embeddings.T) / np.where(norms == 0, 1, norms)
+        
+        for row in distances:
+            top = np.argsort(row)[:n_results]
+            results['ids'].append([chunks['ids'][i] for i in top])
+            results['documents'].append([documents[i] for i in top])
+            results['distances'].append([float(row[i]) for i in top])
+        return results
+    
+    def sample_chunks(self, document_id: str, count: int, query: str = "",
+                      exclude_ids: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """Pick chunks to generate questions from, with their ids and pages.
+        
+        With a query the closest chunks are returned; without one the chunks
+        are spread evenly across the document. Chunks in exclude_ids are skipped.
+        """
+        collection_name = f"doc_{document_id}".replace('-', '_')
+        collection = self.chroma_client.get_collection(name=collection_name)
+        exclude_ids = set(exclude_ids)
+        
+        if query:
+            results = collection.query(
+                query_embeddings=self.embed_queries([query]).tolist(),
+                n_results=count + len(exclude_ids),
+                include=["documents", "metadatas"]
+            )
+            ids, documents, metadatas = results['ids'][0], results['documents'][0], results['metadatas'][0]
+        else:
+            candidates = [chunk_id for chunk_id in collection.get(include=[])['ids'] if chunk_id not in exclude_ids]
+            step = max(1, len(candidates) / max(count, 1))
+            selected = [candidates[int(i * step)] for i in range(min(count, len(candidates)))]
+            if not selected:
+                return []
+            results = collection.get(ids=selected, include=["documents", "metadatas"])
+            ids, documents, metadatas = results['ids'], results['documents'], results['metadatas']
+        
+        chunks = [
+            {'id': chunk_id, 'text': text, 'page': (metadata or {}).get('page')}
+            for chunk_id, text, metadata in zip(ids, documents, metadatas)
+            if chunk_id not in exclude_ids
+        ]
+        return chunks[:count]
+    
+    GENERATION_OPTIONS = {
+        "temperature": 0.3,  # Lower temperature for more consistent output
+        "top_p": 0.8,
+    }
+    
+    def call_gemma(self, prompt: str, max_tokens: int = 1000, response_format: Optional[str] = None,
+                   use_cache: bool = True) -> str:
+        """Call Gemma 2B via Ollama. Pass response_format="json" to constrain output to JSON.
+        
+        Identical requests are answered from the response cache unless
+        use_cache is False. Raises LLMUnavailableError when the backend can't
+        be reached or the scheduler's queue for this priority is full.
+        """
+        options = {**self.GENERATION_OPTIONS, "num_predict": max_tokens}
+        cache, key = self.response_cache_key(self.llm_client.model, prompt, options, response_format, use_cache)
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            return cached
+        
+        with get_scheduler().slot(self.priority, self.fairness_key):
+            started = time.perf_counter()
+            data = self.llm_client.generate(prompt, options=options, response_format=response_format)
+        
+        response = data.get('response', '')
+        if cache:
+            cache.set(key, response, data.get('eval_count', 0), time.perf_counter() - started)
+        return response
+    
+    async def acall_gemma(self, prompt: str, max_tokens: int = 1000, response_format: Optional[str] = None,
+                          use_cache: bool = True) -> str:
+        """call_gemma for async views; waiting on the LLM holds no thread"""
+        client = self.async_llm_client
+        options = {**self.GENERATION_OPTIONS, "num_predict": max_tokens}
+        cache, key = self.response_cache_key(client.model, prompt, options, response_format, use_cache)
+        cached = await cache.aget(key) if cache else None
+        if cached is not None:
+            return cached
+        
+        async with get_scheduler().aslot(self.priority, self.fairness_key):
+            started = time.perf_counter()
+            data = await client.generate(prompt, options=options, response_format=response_format)
+        
+        response = data.get('response', '')
+        if cache:
+            await cache.aset(key, response, data.get('eval_count', 0), time.perf_counter() - started)
+        return response
+    
+    def stream_gemma(self, prompt: str, max_tokens: int = 1000, use_cache: bool = True) -> Iterator[str]:
+        """Call Gemma 2B via Ollama, yielding text fragments as they are generated.
+        
+        A cached response is yielded as a single fragment; a generated one is
+        cached only if the stream ran to completion.
+        """
+        options = {**self.GENERATION_OPTIONS, "num_predict": max_tokens}
+        cache, key = self.response_cache_key(self.llm_client.model, prompt, options, None, use_cache)
+        cached = cache.get(key) if cache else None
+        if cached is not None:
+            yield cached
+            return
+        
+        fragments = []
+        # The slot is held until the stream ends or the client disconnects
+        with get_scheduler().slot(self.priority, self.fairness_key):
+            started = time.perf_counter()
+            for data in self.llm_client.generate_stream(prompt, options=options):
+                if data.get('response'):
+                    fragments.append(data['response'])
+                    yield data['response']
+                if data.get('done') and cache:
+                    cache.set(key, ''.join(fragments), data.get('eval_count', 0), time.perf_counter() - started)
+    
+    async def astream_gemma(self, prompt: str, max_tokens: int = 1000, use_cache: bool = True) -> AsyncIterator[str]:
+        """stream_gemma for async views; waiting on the next fragment holds no thread"""
+        client = self.async_llm_client
+        options = {**self.GENERATION_OPTIONS, "num_predict": max_tokens}
+        cache, key = self.response_cache_key(client.model, prompt, options, None, use_cache)
+        cached = await cache.aget(key) if cache else None
+        if cached is not None:
+            yield cached
+            return
+        
+        fragments = []
+        # The slot is held until the stream ends or the client disconnects
+        async with get_scheduler().aslot(self.priority, self.fairness_key):
+            started = time.perf_counter()
+            async with aclosing(client.generate_stream(prompt, options=options)) as stream:
+                async for data in stream:
+                    if data.get('response'):
+                        fragments.append(data['response'])
+                        yield data['response']
+                    if data.get('done') and cache:
+                        await cache.aset(key, ''.join(fragments), data.get('eval_count', 0),
+                                         time.perf_counter() - started)
+    
+    def response_cache_key(self, model: str, prompt: str, options: Dict[str, Any], response_format: Optional[str],
+                           use_cache: bool):
+        """The response cache and this request's key in it, or (None, None) when not caching"""
+        cache = get_response_cache() if use_cache else None
+        if cache is None:
+            return None, None
+        return cache, cache.key(model, prompt, options, response_format)
     
     def generate_single_mcq(self, context: str, topic: str = "") -> Dict:
         """Generate a single MCQ question using a simpler approach"""
@@ -117,7 +564,8 @@ Make sure:
 
 Generate the question now:"""
 
-        response = self.call_gemma(prompt, max_tokens=500)
+        # Repeating a prompt here is meant to sample a different question, so skip the response cache
+        response = self.call_gemma(prompt, max_tokens=500, use_cache=settings.MCQ_USE_RESPONSE_CACHE)
         return self.parse_single_mcq(response)
     
     def parse_single_mcq(self, response: str) -> Dict:
@@ -171,8 +619,102 @@ Generate the question now:"""
             print(f"Error parsing MCQ: {e}")
             return None
     
-    def generate_mcq_questions(self, document_id: str, topic: str = "", page_range: str = "", num_questions: int = 5) -> List[Dict]:
-        """Generate multiple choice questions using iterative approach"""
+    def generate_mcq_batch(self, context: str, count: int, topic: str = "") -> List[Dict]:
+        """Generate several MCQ questions over one shared context in a single call"""
+        
+        prompt = f"""Based on the following text, create {count} different multiple choice questions.
+
+TEXT:
+{context[:settings.MCQ_BATCH_CONTEXT_CHARS]}
+
+TOPIC FOCUS: {topic if topic else "main concepts"}
+
+Respond with JSON in this EXACT format:
+{{"questions": [
+  {{"question": "...", "options": {{"A": "...", "B": "...", "C": "...", "D": "..."}}, "answer": "A", "explanation": "..."}}
+]}}
+
+Make sure:
+- Each question tests a different idea from the text
+- Each question tests understanding, not just memory
+- Only ONE option is clearly correct
+- Other options are plausible but wrong
+- Base everything on the provided text only"""
+
+        response = self.call_gemma(prompt, max_tokens=300 * count, response_format="json",
+                                   use_cache=settings.MCQ_USE_RESPONSE_CACHE)
+        return self.parse_mcq_batch(response)
+    
+    def parse_mcq_batch(self, response: str) -> List[Dict]:
+        """Parse a JSON batch of MCQs, keeping every well-formed item.
+        
+        Malformed items are dropped individually, and if the JSON as a whole is
+        invalid (e.g. cut off at the token limit) each complete question object
+        that can still be decoded is salvaged.
+        """
+        decoder = json.JSONDecoder()
+        items = []
+        position = 0
+        
+        while True:
+            start = response.find('{', position)
+            if start < 0:
+                break
+            try:
+                parsed, position = decoder.raw_decode(response, start)
+            except ValueError:
+                position = start + 1
+                continue
+            
+            if isinstance(parsed, dict) and isinstance(parsed.get('questions'), list):
+                items.extend(parsed['questions'])
+            elif isinstance(parsed, dict):
+                items.append(parsed)
+        
+        questions = []
+        for item in items:
+            question = self.normalize_mcq_item(item)
+            if question:
+                questions.append(question)
+            else:
+                print(f"Skipping malformed question in batch: {item}")
+        return questions
+    
+    def normalize_mcq_item(self, item: Any) -> Optional[Dict]:
+        """Convert one JSON question object into the question dict used everywhere else"""
+        if not isinstance(item, dict):
+            return None
+        
+        options = item.get('options')
+        if isinstance(options, list) and len(options) == 4:
+            options = dict(zip(['A', 'B', 'C', 'D'], options))
+        if not isinstance(options, dict):
+            return None
+        options = {str(key).strip().upper()[:1]: str(value).strip() for key, value in options.items()}
+        
+        answer = str(item.get('answer') or item.get('correct_answer') or '').strip().upper()[:1]
+        question_text = str(item.get('question') or item.get('question_text') or '').strip()
+        
+        if question_text and sorted(options) == ['A', 'B', 'C', 'D'] and answer in options:
+            return {
+                'question_text': question_text,
+                'options': options,
+                'correct_answer': answer,
+                'explanation': str(item.get('explanation') or '').strip()
+            }
+        return None
+    
+    def generate_mcq_questions(self, document_id: str, topic: str = "", page_range: str = "", num_questions: int = 5,
+                               total_pages: Optional[int] = None,
+                               on_question: Optional[Callable[[Dict], None]] = None,
+                               deduplicator: Optional[SemanticDeduplicator] = None) -> List[Dict]:
+        """Generate multiple choice questions from retrieved context.
+        
+        page_range (e.g. "1-5,8") limits retrieval to those pages; total_pages
+        is needed to resolve it. on_question is called with each question as
+        soon as it is accepted. Pass a deduplicator seeded with stored
+        questions to avoid repeating them.
+        """
         
         print(f"Starting MCQ generation for document {document_id}")
         print(f"Topic: '{topic}', Page range: '{page_range}', Num questions: {num_questions}")
@@ -189,14 +731,9 @@ Generate the question now:"""
                 "fundamental principles and ideas"
             ])
         
-        # Collect context from multiple searches
-        all_context_chunks = []
-        for query in search_queries:
-            chunks = self.retrieve_relevant_context(document_id, query, n_results=6)
-            all_context_chunks.extend(chunks)
-        
-        # Remove duplicates and limit
-        unique_chunks = list(dict.fromkeys(all_context_chunks))[:10]
+        # One batched search for every query, merged and deduplicated by chunk
+        unique_chunks = self.retrieve_for_queries(document_id, search_queries, n_results=6, page_range=page_range,
+                                                  total_pages=total_pages, limit=10)
         
         if not unique_chunks:
             print("No context chunks retrieved")
@@ -204,72 +741,177 @@ Generate the question now:"""
         
         print(f"Retrieved {len(unique_chunks)} context chunks")
         
-        # Generate questions one by one using different context chunks
+        questions = self.generate_questions_from_chunks(unique_chunks, topic, num_questions, on_question=on_question,
+                                                        deduplicator=deduplicator)
+        
+        print(f"Generated {len(questions)} questions total")
+        return questions
+    
+    def generate_questions_from_chunks(self, context_chunks: List[str], topic: str = "", num_questions: int = 5,
+                                       max_in_flight: Optional[int] = None,
+                                       questions_per_call: Optional[int] = None,
+                                       on_question: Optional[Callable[[Dict], None]] = None,
+                                       deduplicator: Optional[SemanticDeduplicator] = None) -> List[Dict]:
+        """Generate questions concurrently, cycling through the context chunks.
+        
+        Up to max_in_flight LLM requests run at once, each asking for
+        questions_per_call questions. Results are deduplicated as they arrive
+        and generation stops as soon as num_questions valid questions exist;
+        requests still queued at that point are cancelled. on_question is
+        called from the calling thread for each accepted question.
+        
+        Near-duplicates (by embedding similarity) of earlier questions, or of
+        anything the deduplicator was seeded with, are skipped. Accepted
+        questions carry their normalized embedding under 'embedding'.
+        """
+        deduplicator = deduplicator or self.question_deduplicator()
+        max_in_flight = max(1, max_in_flight or settings.MCQ_MAX_IN_FLIGHT)
+        per_call = max(1, min(questions_per_call or settings.MCQ_QUESTIONS_PER_CALL, num_questions))
+        max_attempts = math.ceil(num_questions / per_call) * 3  # Allow multiple attempts
         questions = []
-        max_attempts = num_questions * 3  # Allow multiple attempts
         attempts = 0
         
-        for i in range(num_questions):
-            if attempts >= max_attempts:
-                break
-                
+        executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='mcq')
+        in_flight = set()
+        
+        def submit_next():
+            nonlocal attempts
             # Use different context chunks for variety
-            context_chunk = unique_chunks[i % len(unique_chunks)]
-            
-            print(f"Generating question {i+1}/{num_questions} (attempt {attempts+1})")
-            
-            try:
-                question = self.generate_single_mcq(context_chunk, topic)
-                if question:
-                    # Check for duplicates
-                    is_duplicate = any(
-                        self.questions_similar(question['question_text'], existing['question_text']) 
-                        for existing in questions
-                    )
-                    
-                    if not is_duplicate:
-                        questions.append(question)
-                        print(f"Successfully generated question {len(questions)}")
-                    else:
-                        print(f"Duplicate question detected, skipping")
-                else:
-                    print(f"Failed to generate valid question")
-                    
-            except Exception as e:
-                print(f"Error generating question {i+1}: {e}")
-            
+            context = self.build_context(context_chunks, attempts * per_call, per_call)
             attempts += 1
+            print(f"Requesting {per_call} question(s) (attempt {attempts}/{max_attempts})")
+            in_flight.add(executor.submit(self.generate_mcq_set, context, per_call, topic))
+        
+        def fill_pipeline():
+            # Only keep as many requests in flight as questions are still missing
+            needed_calls = math.ceil((num_questions - len(questions)) / per_call)
+            while len(in_flight) < min(max_in_flight, needed_calls) and attempts < max_attempts:
+                submit_next()
+        
+        try:
+            fill_pipeline()
+            while in_flight and len(questions) < num_questions:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.discard(future)
+                    try:
+                        results = future.result()
+                    except LLMUnavailableError as e:
+                        # Backend is down: stop asking instead of burning the attempt budget
+                        print(f"Stopping question generation: {e}")
+                        attempts = max_attempts
+                        results = []
+                    except Exception as e:
+                        print(f"Error generating question: {e}")
+                        results = []
+                    
+                    if not results:
+                        print(f"Failed to generate valid question")
+                    vectors = deduplicator.filter_new([question['question_text'] for question in results])
+                    for question, vector in zip(results, vectors):
+                        if len(questions) >= num_questions:
+                            break
+                        if vector is None:
+                            print(f"Duplicate question detected, skipping")
+                        else:
+                            question['embedding'] = vector
+                            questions.append(question)
+                            print(f"Successfully generated question {len(questions)}")
+                            if on_question:
+                                on_question(question)
+                
+                fill_pipeline()
+        finally:
+            # Don't wait for requests whose results are no longer needed
+            executor.shutdown(wait=False, cancel_futures=True)
         
-        print(f"Generated {len(questions)} questions total")
         return questions
     
-    def questions_similar(self, q1: str, q2: str) -> bool:
-        """Check if two questions are too similar"""
-        # Simple similarity check
-        q1_words = set(q1.lower().split())
-        q2_words = set(q2.lower().split())
+    def build_context(self, context_chunks: List[str], start: int, count: int) -> str:
+        """Join consecutive chunks (wrapping around) into one context block"""
+        if count == 1:
+            return context_chunks[start % len(context_chunks)]
         
-        if len(q1_words) == 0 or len(q2_words) == 0:
-            return False
-            
-        intersection = len(q1_words.intersection(q2_words))
-        union = len(q1_words.union(q2_words))
+        selected = [context_chunks[(start + i) % len(context_chunks)] for i in range(min(count, len(context_chunks)))]
+        return "\n\n".join(selected)
+    
+    def generate_mcq_set(self, context: str, count: int, topic: str = "") -> List[Dict]:
+        """Generate up to count questions, falling back to the single-question prompt"""
+        if count > 1:
+            questions = self.generate_mcq_batch(context, count, topic)
+            if questions:
+                return questions
+            print("Batch generation returned no valid questions, falling back to single question")
         
-        similarity = intersection / union if union > 0 else 0
-        return similarity > 0.7  # 70% similarity threshold
+        question = self.generate_single_mcq(context, topic)
+        return [question] if question else []
+    
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed short texts such as questions with the shared model"""
+        return self.embedding_model.encode(texts, batch_size=settings.EMBEDDING_ENCODE_BATCH_SIZE,
+                                           convert_to_numpy=True)
+    
+    def question_deduplicator(self, seed_vectors: Optional[np.ndarray] = None) -> SemanticDeduplicator:
+        """A duplicate detector using the shared embedding model, optionally seeded with known questions"""
+        deduplicator = SemanticDeduplicator(self.encode_texts)
+        if seed_vectors is not None and len(seed_vectors):
+            deduplicator.add(seed_vectors)
+        return deduplicator
+    
+    NO_CONTEXT_ANSWER = "I don't have enough information from the document to answer this question."
     
     def answer_question(self, document_id: str, question: str) -> str:
         """Answer a question using RAG - this already works well"""
+        prompt = self.build_answer_prompt(document_id, question)
+        if prompt is None:
+            return self.NO_CONTEXT_ANSWER
+        
+        return self.call_gemma(prompt, max_tokens=500)
+    
+    async def aanswer_question(self, document_id: str, question: str) -> str:
+        """answer_question for async views.
+        
+        Retrieval is CPU and disk bound, so it runs on a worker thread; it
+        doesn't touch the ORM and needn't share Django's sync thread.
+        """
+        prompt = await sync_to_async(self.build_answer_prompt, thread_sensitive=False)(document_id, question)
+        if prompt is None:
+            return self.NO_CONTEXT_ANSWER
         
-        # Retrieve relevant context
-        context_chunks = self.retrieve_relevant_context(document_id, question, n_results=5)
+        return await self.acall_gemma(prompt, max_tokens=500)
+    
+    def answer_question_stream(self, document_id: str, question: str) -> Iterator[str]:
+        """Answer a question using RAG, yielding the answer as it is generated"""
+        prompt = self.build_answer_prompt(document_id, question)
+        if prompt is None:
+            yield self.NO_CONTEXT_ANSWER
+            return
+        
+        yield from self.stream_gemma(prompt, max_tokens=500)
+    
+    async def aanswer_question_stream(self, document_id: str, question: str) -> AsyncIterator[str]:
+        """answer_question_stream for async views"""
+        prompt = await sync_to_async(self.build_answer_prompt, thread_sensitive=False)(document_id, question)
+        if prompt is None:
+            yield self.NO_CONTEXT_ANSWER
+            return
+        
+        async with aclosing(self.astream_gemma(prompt, max_tokens=500)) as stream:
+            async for fragment in stream:
+                yield fragment
+    
+    def build_answer_prompt(self, document_id: str, question: str) -> Optional[str]:
+        """Build the RAG prompt for a chat question, or None if no context was found"""
+        
+        # Retrieve relevant context, reranked and trimmed to the prompt's token budget
+        context_chunks = self.retrieve_reranked(document_id, question)
         context = "\n\n".join(context_chunks)
         
         if not context.strip():
-            return "I don't have enough information from the document to answer this question."
+            return None
         
         # Prompt engineering for accurate answers
-        prompt = f"""You are a helpful AI assistant answering questions based on a document.
+        return f"""You are a helpful AI assistant answering questions based on a document.
 
 CONTEXT FROM DOCUMENT:
 {context}
@@ -285,8 +927,6 @@ INSTRUCTIONS:
 
 ANSWER:
 """
-
-        return self.call_gemma(prompt, max_tokens=500)
     
     def evaluate_answer(self, question_text: str, correct_answer: str, user_answer: str, options: Dict) -> Dict:
         """Evaluate user's answer and provide feedback"""
@@ -306,10 +946,14 @@ ANSWER:
         
         return feedback
     
-    def test_connection(self) -> bool:
-        """Test if the AI service is working"""
-        try:
-            response = self.call_gemma("Hello, respond with 'OK' if you can hear me.", max_tokens=10)
-            return "OK" in response or "ok" in response.lower()
-        except:
-            return False
+    def test_connection(self, force: bool = False) -> bool:
+        """Test if the AI service is working.
+        
+        Uses the cached health check rather than a full generation; pass
+        force=True to probe the backend now.
+        """
+        return check_llm_health(force=force, client=self.llm_client)['ok']
+    
+    async def atest_connection(self, force: bool = False) -> bool:
+        """test_connection for async views"""
+        return (await acheck_llm_health(force=force, client=self._async_llm_client))['ok']
@@ -6,4 +6,15 @@ class LearningAppConfig(AppConfig):
     
     def ready(self):
         # Import any signals or other initialization code here
-        pass
+        from django.conf import settings
+        from . import ingestion, question_bank, quiz_generation  # noqa: F401 - registers background job handlers
+        from . import signals  # noqa: F401
+        from .jobs import resume_interrupted_jobs
+        from django.core.signals import request_started
+        
+        # Jobs interrupted by a restart are picked up once the database is in use
+        request_started.connect(resume_interrupted_jobs)
+        
+        if settings.AI_WARMUP_ON_STARTUP:
+            from .shared_resources import warm_up
+            warm_up()
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from django.conf import settings
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe in-process cache bounded by entry count, with an optional TTL.
+
+    The least recently used entry is evicted once max_entries is exceeded;
+    entries older than ttl seconds are treated as misses.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and self.ttl and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = _MISSING
+
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drop every entry whose key matches predicate; returns the number removed"""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Query embeddings depend only on the text and the model, so they never go stale.
+# Retrieval results are keyed by collection and expire after a TTL as well, since
+# a document may be re-ingested by a worker in another process.
+query_embeddings = LRUCache(settings.QUERY_EMBEDDING_CACHE_SIZE)
+retrieval_results = LRUCache(settings.RETRIEVAL_CACHE_SIZE, ttl=settings.RETRIEVAL_CACHE_TTL)
+
+
+def normalize_query(query: str) -> str:
+    """Cache key form of a query: case- and whitespace-insensitive"""
+    return ' '.join(query.lower().split())
+
+
+def invalidate_document(collection_id: str) -> int:
+    """Forget cached retrieval results for a document's collection"""
+    return retrieval_results.invalidate(lambda key: key[0] == collection_id)
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        'query_embeddings': query_embeddings.stats(),
+        'retrieval_results': retrieval_results.stats(),
+    }
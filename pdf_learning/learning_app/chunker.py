@@ -0,0 +1,130 @@
+import math
+import re
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+# A sentence ends at ., ! or ? followed by whitespace. Matching whole sentences
+# is several times faster than splitting on a lookbehind for the boundary.
+SENTENCE = re.compile(r'(?:[.!?]+(?=\S)|[^\s.!?])[^.!?]*(?:[.!?](?!\s)[^.!?]*)*[.!?]*|[.!?]+')
+
+TokenCounter = Callable[[List[str]], List[int]]
+
+
+class TextChunk(NamedTuple):
+    text: str
+    page: int  # Page the chunk starts on (1-indexed)
+    page_end: int  # Page the chunk ends on; differs from page only when spanning pages
+    tokens: int
+
+
+def embedding_token_counter(texts: List[str]) -> List[int]:
+    """Count tokens with the embedding model's own tokenizer"""
+    from .shared_resources import get_embedding_model
+
+    if not texts:
+        return []
+    encoded = get_embedding_model().tokenizer(texts, add_special_tokens=False)['input_ids']
+    return [len(ids) for ids in encoded]
+
+
+def whitespace_token_counter(texts: List[str]) -> List[int]:
+    """Approximate token counts by whitespace-separated words"""
+    return [len(text.split()) for text in texts]
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split text into stripped, non-empty sentences"""
+    return SENTENCE.findall(text.strip())
+
+
+class TokenChunker:
+    """Pack sentences into overlapping chunks measured in model tokens.
+
+    Each sentence is tokenized once. Chunk boundaries are found by binary
+    search over running token totals, so packing does no per-sentence
+    Python work beyond the counting itself.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, overlap_tokens: Optional[int] = None,
+                 span_pages: Optional[bool] = None, token_counter: Optional[TokenCounter] = None):
+        self.max_tokens = max_tokens or settings.CHUNK_MAX_TOKENS
+        self.overlap_tokens = settings.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        self.span_pages = settings.CHUNK_SPAN_PAGES if span_pages is None else span_pages
+        self.token_counter = token_counter or embedding_token_counter
+
+        if self.overlap_tokens >= self.max_tokens:
+            raise ValueError("overlap_tokens must be smaller than max_tokens")
+
+    def chunk_pages(self, pages: Iterable[Tuple[int, str]]) -> Iterator[TextChunk]:
+        """Yield chunks from a stream of (page_number, text) records"""
+        # Sentences not yet out of the overlap window; with span_pages this
+        # carries the tail of one page into the next
+        sentences: List[str] = []
+        counts: List[int] = []
+        page_nums: List[int] = []
+
+        for page_num, page_text in pages:
+            new_sentences, new_counts = self._measure(split_sentences(page_text))
+            sentences += new_sentences
+            counts += new_counts
+            page_nums += [page_num] * len(new_sentences)
+
+            if not self.span_pages:
+                yield from self._pack(sentences, counts, page_nums, final=True)
+                sentences, counts, page_nums = [], [], []
+            elif new_sentences:
+                start = yield from self._pack(sentences, counts, page_nums, final=False)
+                del sentences[:start], counts[:start], page_nums[:start]
+
+        if sentences:
+            yield from self._pack(sentences, counts, page_nums, final=True)
+
+    def _pack(self, sentences: List[str], counts: List[int], page_nums: List[int], final: bool):
+        """Yield the full chunks of sentences, and the tail too if final.
+
+        Returns the index of the first sentence of the unemitted tail.
+        """
+        totals = list(accumulate(counts, initial=0))  # totals[i] = tokens before sentence i
+        n = len(sentences)
+        start = 0
+        while n:
+            # Take as many sentences as fit; a chunk always gets at least one
+            end = max(bisect_right(totals, totals[start] + self.max_tokens, start + 1) - 1, start + 1)
+            if end >= n:
+                if final:
+                    yield self._emit(sentences, page_nums, totals, start, n)
+                break
+            yield self._emit(sentences, page_nums, totals, start, end)
+            # The next chunk starts at the shortest tail within overlap_tokens
+            # that still leaves room for the next sentence
+            start = bisect_left(totals, max(totals[end] - self.overlap_tokens,
+                                            totals[end + 1] - self.max_tokens), start + 1, end)
+        return start
+
+    def _measure(self, sentences: List[str]) -> Tuple[List[str], List[int]]:
+        """Count tokens per sentence, splitting any sentence longer than a chunk"""
+        counts = self.token_counter(sentences)
+        oversized = [index for index, tokens in enumerate(counts) if tokens > self.max_tokens]
+
+        # Rare case: break long run-on "sentences" (tables, lists) on word boundaries
+        for index in reversed(oversized):
+            words = sentences[index].split()
+            pieces = math.ceil(counts[index] / self.max_tokens)
+            words_per_piece = math.ceil(len(words) / pieces)
+            parts = [' '.join(words[i:i + words_per_piece]) for i in range(0, len(words), words_per_piece)]
+            sentences[index:index + 1] = parts
+            counts[index:index + 1] = self.token_counter(parts)
+
+        return sentences, counts
+
+    @staticmethod
+    def _emit(sentences: List[str], page_nums: List[int], totals: List[int], start: int, end: int) -> TextChunk:
+        return TextChunk(
+            text=' '.join(sentences[start:end]),
+            page=page_nums[start],
+            page_end=page_nums[end - 1],
+            tokens=totals[end] - totals[start]
+        )
@@ -0,0 +1,68 @@
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+
+Encoder = Callable[[List[str]], np.ndarray]
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """Scale rows to unit length so dot products are cosine similarities"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class SemanticDeduplicator:
+    """Reject questions whose embedding is too close to one already accepted.
+
+    Accepted questions are kept as rows of a unit-normalized matrix, so a
+    candidate is checked against all of them with a single matrix-vector
+    product. The matrix grows by doubling, which keeps appends cheap when it
+    is seeded with thousands of stored questions.
+    """
+
+    def __init__(self, encode: Encoder, threshold: Optional[float] = None):
+        self.encode = encode
+        self.threshold = settings.QUESTION_DUPLICATE_THRESHOLD if threshold is None else threshold
+        self._matrix = None
+        self.size = 0
+
+    def add(self, vectors):
+        """Add embeddings of questions that count as already asked"""
+        vectors = normalize_rows(vectors)
+        if not len(vectors) or not vectors.shape[1]:
+            return
+        if self._matrix is None:
+            self._matrix = np.empty((max(64, len(vectors)), vectors.shape[1]), dtype=np.float32)
+        elif self.size + len(vectors) > len(self._matrix):
+            grown = np.empty((max(len(self._matrix) * 2, self.size + len(vectors)), self._matrix.shape[1]),
+                             dtype=np.float32)
+            grown[:self.size] = self._matrix[:self.size]
+            self._matrix = grown
+
+        self._matrix[self.size:self.size + len(vectors)] = vectors
+        self.size += len(vectors)
+
+    def is_duplicate(self, vector: np.ndarray) -> bool:
+        if not self.size:
+            return False
+        return float(np.max(self._matrix[:self.size] @ vector)) >= self.threshold
+
+    def filter_new(self, texts: Sequence[str]) -> List[np.ndarray]:
+        """Accept the texts that aren't duplicates, including of each other.
+
+        Candidates are embedded in one call. Returns one entry per text: its
+        normalized embedding if it was accepted, None if it was a duplicate.
+        """
+        if not texts:
+            return []
+
+        accepted = []
+        for vector in normalize_rows(self.encode(list(texts))):
+            if self.is_duplicate(vector):
+                accepted.append(None)
+            else:
+                self.add(vector)
+                accepted.append(vector)
+        return accepted
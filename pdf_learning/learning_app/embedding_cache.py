@@ -0,0 +1,101 @@
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+import numpy as np
+from django.conf import settings
+
+
+def text_hash(text: str) -> str:
+    """Content address for a chunk of text"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk store of chunk embeddings keyed by model and text hash.
+
+    Shared by every document, so overlapping uploads reuse embeddings instead
+    of re-encoding them. The least recently used entries are evicted once the
+    store grows past EMBEDDING_CACHE_MAX_MB.
+    """
+
+    def __init__(self, path=None, max_bytes: Optional[int] = None, model_name: Optional[str] = None):
+        self.path = str(path or settings.EMBEDDING_CACHE_PATH)
+        self.max_bytes = settings.EMBEDDING_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self.model_name = model_name or settings.EMBEDDING_MODEL_NAME
+
+        if not self.enabled:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the cache safe to use from worker threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _key(self, text: str) -> str:
+        return text_hash(f"{self.model_name}\0{text}")
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Return the cached embedding for each text, or None where missing"""
+        if not self.enabled or not texts:
+            return [None] * len(texts)
+
+        keys = [self._key(text) for text in texts]
+        placeholders = ','.join('?' * len(keys))
+        with self._connect() as conn:
+            rows = dict(conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys
+            ).fetchall())
+            if rows:
+                conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(rows))})",
+                    [time.time(), *rows]
+                )
+
+        return [np.frombuffer(rows[key], dtype=np.float32) if key in rows else None for key in keys]
+
+    def put_many(self, texts: List[str], embeddings: np.ndarray):
+        """Store embeddings for texts, evicting old entries if over the size limit"""
+        if not self.enabled or not texts:
+            return
+
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, np.asarray(embeddings, dtype=np.float32)):
+            blob = vector.tobytes()
+            rows.append((self._key(text), blob, len(blob), now))
+
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM embeddings").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        # Trim to 90% of the limit so eviction doesn't run on every write
+        excess = total - int(self.max_bytes * 0.9)
+        to_delete = max(1, int(excess / (total / count)) + 1)
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (to_delete,)
+        )
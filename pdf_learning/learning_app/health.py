@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .llm_client import (AsyncOllamaClient, LLMUnavailableError, OllamaClient, get_async_llm_client,
+                         get_llm_client)
+
+HEALTH_CACHE_KEY = 'learning_app:llm_health'
+
+
+def check_llm_health(force: bool = False, client: Optional[OllamaClient] = None) -> Dict[str, Any]:
+    """Return the backend health, probing Ollama only when the cached result has expired.
+
+    The result lives in the Django cache so every worker sharing that cache
+    reuses one probe. Failures are cached for a shorter time than successes
+    so a restarted backend is noticed quickly.
+    """
+    if not force:
+        cached = cache.get(HEALTH_CACHE_KEY)
+        if cached is not None:
+            return cached
+
+    result = probe_llm(client or get_llm_client())
+    cache.set(HEALTH_CACHE_KEY, result, _ttl(result))
+    return result
+
+
+async def acheck_llm_health(force: bool = False, client: Optional[AsyncOllamaClient] = None) -> Dict[str, Any]:
+    """check_llm_health for async views; shares the same cached result"""
+    if not force:
+        cached = await cache.aget(HEALTH_CACHE_KEY)
+        if cached is not None:
+            return cached
+
+    result = await aprobe_llm(client or get_async_llm_client())
+    await cache.aset(HEALTH_CACHE_KEY, result, _ttl(result))
+    return result
+
+
+def probe_llm(client: OllamaClient) -> Dict[str, Any]:
+    """Check the server and model using Ollama's lightweight metadata endpoints"""
+    result = _new_result(client.model)
+    timeout = (settings.OLLAMA_CONNECT_TIMEOUT, settings.LLM_HEALTH_TIMEOUT)
+
+    try:
+        # /api/tags lists installed models; /api/ps lists models loaded in memory
+        tags = client.request('GET', '/api/tags', timeout=timeout, retries=0).json()
+        result['server_up'] = True
+        result['model_available'] = _has_model(tags, client.model)
+
+        running = client.request('GET', '/api/ps', timeout=timeout, retries=0).json()
+        result['model_loaded'] = _has_model(running, client.model)
+    except (LLMUnavailableError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    return _conclude(result, client)
+
+
+async def aprobe_llm(client: AsyncOllamaClient) -> Dict[str, Any]:
+    """probe_llm for the async client"""
+    result = _new_result(client.model)
+    timeout = (settings.OLLAMA_CONNECT_TIMEOUT, settings.LLM_HEALTH_TIMEOUT)
+
+    try:
+        tags = (await client.request('GET', '/api/tags', timeout=timeout, retries=0)).json()
+        result['server_up'] = True
+        result['model_available'] = _has_model(tags, client.model)
+
+        running = (await client.request('GET', '/api/ps', timeout=timeout, retries=0)).json()
+        result['model_loaded'] = _has_model(running, client.model)
+    except (LLMUnavailableError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    # Preloading runs on a background thread, so hand it a sync client for the same server
+    sync_client = get_llm_client()
+    if (sync_client.base_url, sync_client.model) != (client.base_url, client.model):
+        sync_client = OllamaClient(base_url=client.base_url, model=client.model, breaker=client.breaker)
+    return _conclude(result, sync_client)
+
+
+def _new_result(model: str) -> Dict[str, Any]:
+    return {
+        'ok': False,
+        'server_up': False,
+        'model': model,
+        'model_available': False,
+        'model_loaded': False,
+        'checked_at': time.time(),
+        'error': '',
+    }
+
+
+def _ttl(result: Dict[str, Any]) -> int:
+    return settings.LLM_HEALTH_TTL if result['ok'] else settings.LLM_HEALTH_FAILURE_TTL
+
+
+def _conclude(result: Dict[str, Any], client: OllamaClient) -> Dict[str, Any]:
+    result['ok'] = result['model_available']
+    if not result['model_available']:
+        result['error'] = f"Model '{client.model}' is not installed. Run: ollama pull {client.model}"
+    elif not result['model_loaded'] and settings.OLLAMA_KEEP_ALIVE:
+        preload_model(client)
+
+    return result
+
+
+def preload_model(client: OllamaClient):
+    """Ask Ollama to load the model in the background so the first real request is warm"""
+    def load():
+        try:
+            client.request('POST', '/api/generate', retries=0,
+                           json={'model': client.model, 'keep_alive': settings.OLLAMA_KEEP_ALIVE})
+        except LLMUnavailableError as e:
+            print(f"Could not preload model {client.model}: {e}")
+
+    threading.Thread(target=load, name='ollama-preload', daemon=True).start()
+
+
+def _has_model(listing: Dict[str, Any], model: str) -> bool:
+    names = set()
+    for entry in listing.get('models', []):
+        names.update(filter(None, [entry.get('name'), entry.get('model')]))
+    return model in names or f"{model}:latest" in names
@@ -0,0 +1,68 @@
+from typing import Iterable, Iterator, Tuple
+
+from . import caches
+from .ai_service import AIService
+from .jobs import job_handler
+from .models import BackgroundJob, PDFDocument
+from .pdf_processor import PDFProcessor
+from .question_bank import request_top_up
+
+# Persist extraction progress every N pages rather than on every page
+PROGRESS_INTERVAL = 10
+
+
+def set_stage(document: PDFDocument, stage: str, **fields):
+    """Persist the ingestion stage along with any progress counters"""
+    document.stage = stage
+    for name, value in fields.items():
+        setattr(document, name, value)
+    document.save(update_fields=['stage', *fields])
+
+
+def track_pages(document: PDFDocument, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+    """Pass page records through while recording extraction progress"""
+    for page_num, page_text in pages:
+        yield page_num, page_text
+        document.pages_extracted = page_num
+        if page_num % PROGRESS_INTERVAL == 0:
+            document.save(update_fields=['pages_extracted'])
+    document.save(update_fields=['pages_extracted'])
+
+
+@job_handler('ingest_document')
+def ingest_document(job: BackgroundJob):
+    """Extract, chunk and embed an uploaded PDF"""
+    document = job.document
+    processor = PDFProcessor()
+    ai_service = AIService()
+
+    # An identical upload may have finished while this job was queued
+    duplicate = document.find_processed_duplicate()
+    if duplicate:
+        document.copy_ingestion_from(duplicate)
+        request_top_up(document)
+        return
+
+    # Results cached while a previous ingestion was partial or failed are stale
+    caches.invalidate_document(document.collection_id)
+    try:
+        pdf_path = document.file.path
+        set_stage(document, 'extracting', error='', total_pages=processor.count_pages(pdf_path))
+
+        # Pages are chunked and embedded as they are extracted; neither the
+        # whole text nor all of its embeddings exist in memory at once
+        pages = track_pages(document, processor.iter_pages(pdf_path))
+
+        def on_batch(stored):
+            set_stage(document, 'embedding', chunks_embedded=stored)
+
+        stats = ai_service.add_chunk_stream(document.collection_id, processor.chunk_pages(pages), on_batch=on_batch)
+
+        set_stage(document, 'done', chunks_embedded=stats['chunks'], processed=True)
+        caches.invalidate_document(document.collection_id)
+    except Exception as e:
+        set_stage(document, 'failed', error=str(e))
+        raise
+
+    # Start filling the question bank so the first quiz doesn't wait on the LLM
+    request_top_up(document)
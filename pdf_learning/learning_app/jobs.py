@@ -0,0 +1,219 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import BackgroundJob, PDFDocument
+
+# Database-backed job queue executed by local thread pools. The job table is
+# the source of truth, so queued work survives restarts and can be drained by
+# the process_jobs management command.
+#
+# Jobs run on one of two pools. Live quiz generation has a user waiting on it,
+# so it gets threads of its own rather than queueing behind ingestion and
+# question bank filling on the background pool.
+QUIZ_POOL = 'quiz'
+BACKGROUND_POOL = 'background'
+
+_handlers: Dict[str, Callable[[BackgroundJob], None]] = {}
+_pools: Dict[str, str] = {}  # job kind -> pool
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executor_lock = threading.Lock()
+
+# Jobs this process is running. A heartbeat thread stamps them while any are
+# in flight, so other processes can tell a slow job from one whose process died.
+_running_jobs = set()
+_heartbeat_thread: Optional[threading.Thread] = None
+_heartbeat_lock = threading.Lock()
+
+_last_recovery: Optional[float] = None
+_recovery_lock = threading.Lock()
+
+
+def job_handler(kind: str, pool: str = BACKGROUND_POOL):
+    """Register a function as the handler for a job kind, run on the given pool"""
+    def decorator(func):
+        _handlers[kind] = func
+        _pools[kind] = pool
+        return func
+    return decorator
+
+
+def pool_size(pool: str) -> int:
+    return settings.QUIZ_WORKERS if pool == QUIZ_POOL else settings.BACKGROUND_WORKERS
+
+
+def get_executor(pool: str = BACKGROUND_POOL) -> ThreadPoolExecutor:
+    """Return this process's worker pool of the given name"""
+    if pool not in _executors:
+        with _executor_lock:
+            if pool not in _executors:
+                _executors[pool] = ThreadPoolExecutor(
+                    max_workers=pool_size(pool),
+                    thread_name_prefix=f'learning-{pool}-job'
+                )
+    return _executors[pool]
+
+
+def enqueue(kind: str, document: Optional[PDFDocument] = None, **payload) -> BackgroundJob:
+    """Record a job and hand it to its worker pool once the transaction commits"""
+    if kind not in _handlers:
+        raise ValueError(f"No handler registered for job kind '{kind}'")
+
+    job = BackgroundJob.objects.create(kind=kind, document=document, payload=payload)
+    transaction.on_commit(lambda: submit(job.id, kind))
+    return job
+
+
+def submit(job_id: int, kind: str):
+    """Run a queued job on its worker pool, or inline if that pool is disabled"""
+    pool = _pools[kind]
+    if pool_size(pool) <= 0:
+        run_job(job_id)
+    else:
+        get_executor(pool).submit(_in_worker, run_job, job_id)
+
+
+def _in_worker(func, *args):
+    close_old_connections()
+    try:
+        func(*args)
+    finally:
+        # Worker threads own their connections; don't leak them between jobs
+        close_old_connections()
+
+
+def pending_jobs(kind: str):
+    """Jobs of a kind that are queued or running"""
+    return BackgroundJob.objects.filter(kind=kind, status__in=['queued', 'running'])
+
+
+def run_job(job_id: int) -> bool:
+    """Claim and execute a single job. Returns False if it was already claimed"""
+    now = timezone.now()
+    claimed = BackgroundJob.objects.filter(id=job_id, status='queued').update(
+        status='running',
+        started_at=now,
+        heartbeat_at=now
+    )
+    if not claimed:
+        return False
+
+    job = BackgroundJob.objects.select_related('document').get(id=job_id)
+    _start_heartbeat(job_id)
+    try:
+        _handlers[job.kind](job)
+        job.status = 'done'
+    except Exception as e:
+        print(f"Background job {job.id} ({job.kind}) failed: {e}")
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        with _heartbeat_lock:
+            _running_jobs.discard(job_id)
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
+    return True
+
+
+def _start_heartbeat(job_id: int):
+    global _heartbeat_thread
+    with _heartbeat_lock:
+        _running_jobs.add(job_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name='learning-job-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+
+def _heartbeat_loop():
+    global _heartbeat_thread
+    while True:
+        time.sleep(settings.BACKGROUND_JOB_HEARTBEAT)
+        with _heartbeat_lock:
+            if not _running_jobs:
+                _heartbeat_thread = None
+                return
+        try:
+            send_heartbeats()
+        except Exception as e:
+            print(f"Background job heartbeat failed: {e}")
+        finally:
+            # Idle between beats, so don't hold a connection open
+            connection.close()
+
+
+def send_heartbeats() -> int:
+    """Mark the jobs this process is running as still alive"""
+    with _heartbeat_lock:
+        job_ids = list(_running_jobs)
+    if not job_ids:
+        return 0
+    return BackgroundJob.objects.filter(id__in=job_ids, status='running').update(heartbeat_at=timezone.now())
+
+
+def run_pending(limit: Optional[int] = None) -> int:
+    """Execute queued jobs in the current thread: quiz jobs first, then the rest, oldest first"""
+    jobs = BackgroundJob.objects.filter(status='queued').order_by('created_at').values_list('id', 'kind')
+    job_ids = [job_id for job_id, kind in sorted(jobs, key=lambda job: _pools.get(job[1]) != QUIZ_POOL)]
+    if limit:
+        job_ids = job_ids[:limit]
+
+    return sum(1 for job_id in job_ids if run_job(job_id))
+
+
+def recover_stale_jobs() -> List[Tuple[int, str]]:
+    """Requeue jobs left running by a process that died, returning their (id, kind).
+
+    A job counts as abandoned once its heartbeat is older than the timeout
+    for its kind (BACKGROUND_JOB_TIMEOUTS, else BACKGROUND_JOB_TIMEOUT),
+    however long it has been running.
+    """
+    now = timezone.now()
+    timeouts = settings.BACKGROUND_JOB_TIMEOUTS
+    cutoff = now - timedelta(seconds=settings.BACKGROUND_JOB_TIMEOUT)
+    expired = Q(heartbeat_at__lt=cutoff) & ~Q(kind__in=list(timeouts))
+    for kind, seconds in timeouts.items():
+        expired |= Q(kind=kind, heartbeat_at__lt=now - timedelta(seconds=seconds))
+    stale = BackgroundJob.objects.filter(expired, status='running').values_list('id', 'kind')
+
+    requeued = []
+    for job_id, kind in list(stale):
+        # Another process may be recovering the same job, or the job may have
+        # just sent a heartbeat; only an update that still sees it stale wins
+        if BackgroundJob.objects.filter(expired, id=job_id, status='running').update(
+                status='queued', started_at=None, heartbeat_at=None):
+            print(f"Requeued background job {job_id} ({kind}), which was interrupted")
+            requeued.append((job_id, kind))
+    return requeued
+
+
+def resume_interrupted_jobs(**kwargs):
+    """Requeue abandoned jobs and hand them to the worker pools.
+
+    Connected to request_started, so it runs once the database is in use and
+    then at most once per heartbeat interval; the work happens on the
+    background pool rather than in the request.
+    """
+    global _last_recovery
+    now = time.monotonic()
+    with _recovery_lock:
+        if _last_recovery is not None and now - _last_recovery < settings.BACKGROUND_JOB_HEARTBEAT:
+            return
+        _last_recovery = now
+    if settings.BACKGROUND_WORKERS <= 0:
+        _resume_jobs()
+    else:
+        get_executor(BACKGROUND_POOL).submit(_in_worker, _resume_jobs)
+
+
+def _resume_jobs():
+    for job_id, kind in recover_stale_jobs():
+        if kind in _handlers:
+            submit(job_id, kind)
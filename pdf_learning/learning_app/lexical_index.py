@@ -0,0 +1,148 @@
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+# Terms in a search query: words, and tokens joined by dots or hyphens such as
+# section numbers (3.2), formulas (H2-O) or acronyms with digits
+QUERY_TERM = re.compile(r'\w+(?:[.\-]\w+)*')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    page INTEGER,
+    page_end INTEGER,
+    text TEXT NOT NULL,
+    UNIQUE (collection, chunk_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+    text, collection, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts (rowid, text, collection) VALUES (new.id, new.text, new.collection);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, text, collection) VALUES ('delete', old.id, old.text, old.collection);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_au AFTER UPDATE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, text, collection) VALUES ('delete', old.id, old.text, old.collection);
+    INSERT INTO chunks_fts (rowid, text, collection) VALUES (new.id, new.text, new.collection);
+END;
+"""
+
+
+class LexicalIndex:
+    """SQLite FTS5 keyword index of chunk text, keyed like the vector store.
+
+    Rows carry the same collection, chunk id and page metadata as the
+    ChromaDB collection, so keyword hits can be fused with vector results.
+    Exact terms (formula names, acronyms, section numbers) that the
+    embedding model blurs are matched directly and ranked by BM25. Each
+    thread keeps its own connection, so a lookup is a single indexed query.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or settings.LEXICAL_INDEX_PATH)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def add_chunks(self, collection_id: str, chunks: Iterable[Tuple[str, str, Optional[int], Optional[int]]]):
+        """Index (chunk_id, text, page, page_end) rows; re-adding a chunk id replaces it"""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO chunks (collection, chunk_id, text, page, page_end) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (collection, chunk_id) DO UPDATE SET"
+                " text = excluded.text, page = excluded.page, page_end = excluded.page_end",
+                [(collection_id, chunk_id, text, page, page_end) for chunk_id, text, page, page_end in chunks]
+            )
+
+    def search(self, collection_id: str, query: str, n_results: int = 5,
+               pages: Sequence[int] = ()) -> List[Dict[str, Any]]:
+        """Best BM25 matches for any term of query within one collection, best first"""
+        match = self.match_expression(query)
+        if match is None:
+            return []
+
+        sql = ("SELECT chunks.chunk_id, chunks.text, chunks.page FROM chunks_fts"
+               " JOIN chunks ON chunks.id = chunks_fts.rowid WHERE chunks_fts MATCH ? AND chunks.collection = ?")
+        params = [match, collection_id]
+        if pages:
+            sql += f" AND chunks.page IN ({','.join('?' * len(pages))})"
+            params.extend(pages)
+        # Only the text column is matched, so only it is scored
+        sql += " ORDER BY bm25(chunks_fts, 1.0, 0.0) LIMIT ?"
+        params.append(n_results)
+
+        try:
+            rows = self._connect().execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Lexical search failed: {e}")
+            return []
+        return [{'id': chunk_id, 'text': text, 'page': page} for chunk_id, text, page in rows]
+
+    def delete_chunks(self, collection_id: str, chunk_ids: Iterable[str]):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM chunks WHERE collection = ? AND chunk_id = ?",
+                             [(collection_id, chunk_id) for chunk_id in chunk_ids])
+
+    def delete_collection(self, collection_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chunks WHERE collection = ?", (collection_id,))
+
+    def has_collection(self, collection_id: str) -> bool:
+        return self._connect().execute(
+            "SELECT 1 FROM chunks WHERE collection = ? LIMIT 1", (collection_id,)
+        ).fetchone() is not None
+
+    @staticmethod
+    def match_expression(query: str) -> Optional[str]:
+        """FTS5 query matching chunk text containing any query term, or None if the query has no terms"""
+        terms = list(dict.fromkeys(term.lower() for term in QUERY_TERM.findall(query)))
+        if not terms:
+            return None
+        # Quoted so punctuation and FTS5 keywords (AND, NEAR...) are taken literally;
+        # a term like 3.2 becomes the phrase "3 2"
+        quoted = ' OR '.join(f'"{term}"' for term in terms)
+        return f'text : ({quoted})'
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: Optional[int] = None) -> List[Tuple[str, float]]:
+    """Merge ranked id lists: each list adds 1 / (k + rank) to an id's score.
+
+    Returns (id, score) pairs, best first. Ties keep first-seen order.
+    """
+    k = settings.RRF_K if k is None else k
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda pair: -pair[1])
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """Return the keyword index shared by this process, or None when hybrid search is off"""
+    global _index
+    if not settings.HYBRID_SEARCH:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LexicalIndex()
+    return _index
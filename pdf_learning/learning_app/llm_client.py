@@ -0,0 +1,315 @@
+import asyncio
+import json
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# Status codes worth retrying: the server is up but temporarily unable to answer
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+
+class LLMUnavailableError(Exception):
+    """The LLM backend could not produce a response"""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """The circuit breaker is open, so the request was not attempted"""
+
+
+class CircuitBreaker:
+    """Fail fast after repeated backend failures.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are rejected immediately. Once reset_timeout seconds have passed a single
+    trial request is let through; success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_request(self):
+        with self._lock:
+            state = self.state
+            if state == 'open' or (state == 'half-open' and self.trial_in_progress):
+                raise CircuitOpenError("AI service unavailable (circuit open after repeated failures)")
+            if state == 'half-open':
+                self.trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class BaseOllamaClient:
+    """Configuration and request building shared by the sync and async clients"""
+
+    def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.base_url = (base_url or settings.OLLAMA_BASE_URL).rstrip('/')
+        self.model = model or settings.OLLAMA_MODEL
+        self.timeout = (settings.OLLAMA_CONNECT_TIMEOUT, settings.OLLAMA_READ_TIMEOUT)
+        self.max_retries = settings.OLLAMA_MAX_RETRIES
+        self.retry_backoff = settings.OLLAMA_RETRY_BACKOFF
+        self.breaker = breaker or CircuitBreaker(settings.OLLAMA_BREAKER_THRESHOLD, settings.OLLAMA_BREAKER_RESET)
+
+    def _generate_payload(self, prompt, options, response_format, stream, **extra) -> Dict[str, Any]:
+        payload = {"model": self.model, "prompt": prompt, "stream": stream, **extra}
+        if settings.OLLAMA_KEEP_ALIVE:
+            payload.setdefault("keep_alive", settings.OLLAMA_KEEP_ALIVE)
+        if options:
+            payload["options"] = options
+        if response_format:
+            payload["format"] = response_format
+        return payload
+
+
+class OllamaClient(BaseOllamaClient):
+    """Pooled, keep-alive HTTP client for Ollama with retries and a circuit breaker"""
+
+    def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        super().__init__(base_url, model, breaker)
+
+        # Sessions reuse TCP connections; size the pool for concurrent generation
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.OLLAMA_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def generate(self, prompt: str, options: Optional[Dict[str, Any]] = None,
+                 response_format: Optional[str] = None, **extra) -> Dict[str, Any]:
+        """Run a non-streaming generation and return Ollama's JSON response"""
+        payload = self._generate_payload(prompt, options, response_format, stream=False, **extra)
+        return self.request('POST', '/api/generate', json=payload).json()
+
+    def generate_stream(self, prompt: str, options: Optional[Dict[str, Any]] = None, **extra) -> Iterator[Dict[str, Any]]:
+        """Run a streaming generation, yielding each NDJSON object Ollama sends"""
+        payload = self._generate_payload(prompt, options, None, stream=True, **extra)
+        with self.request('POST', '/api/generate', json=payload, stream=True) as response:
+            try:
+                for line in response.iter_lines():
+                    if line:
+                        data = json.loads(line)
+                        yield data
+                        if data.get('done'):
+                            break
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                raise LLMUnavailableError(f"AI service stream interrupted: {e}") from e
+
+    def request(self, method: str, path: str, timeout=None, retries: Optional[int] = None,
+                **kwargs) -> requests.Response:
+        """Send a request, retrying transient failures with exponential backoff"""
+        self.breaker.before_request()
+        backend_ok = False
+        try:
+            last_error = None
+            retries = self.max_retries if retries is None else retries
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+                try:
+                    response = self.session.request(method, f"{self.base_url}{path}",
+                                                    timeout=timeout or self.timeout, **kwargs)
+                except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                    last_error = e
+                    continue
+                except requests.Timeout as e:
+                    # A read timeout already cost the full budget; don't pay it again
+                    last_error = e
+                    break
+
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    last_error = f"HTTP {response.status_code}"
+                    response.close()
+                    continue
+                # Any other answer means the server is up, even if the request itself is wrong
+                backend_ok = True
+                if response.status_code != 200:
+                    response.close()
+                    raise LLMUnavailableError(f"Ollama API error: {response.status_code}")
+                return response
+
+            raise LLMUnavailableError(f"AI service unavailable: {last_error}")
+        finally:
+            # Exactly one outcome per request, whatever ended it, so a half-open
+            # circuit's trial is never left pending
+            if backend_ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+
+class AsyncOllamaClient(BaseOllamaClient):
+    """asyncio counterpart of OllamaClient for async views.
+
+    Waiting on a generation holds no thread, so one process can keep many
+    requests in flight. The connection pool belongs to the event loop the
+    client was created on.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        super().__init__(base_url, model, breaker)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self._httpx_timeout(self.timeout),
+            limits=httpx.Limits(max_connections=settings.OLLAMA_ASYNC_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.OLLAMA_POOL_SIZE)
+        )
+
+    @staticmethod
+    def _httpx_timeout(timeout) -> httpx.Timeout:
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+
+    async def generate(self, prompt: str, options: Optional[Dict[str, Any]] = None,
+                       response_format: Optional[str] = None, **extra) -> Dict[str, Any]:
+        """Run a non-streaming generation and return Ollama's JSON response"""
+        payload = self._generate_payload(prompt, options, response_format, stream=False, **extra)
+        response = await self.request('POST', '/api/generate', json=payload)
+        return response.json()
+
+    async def generate_stream(self, prompt: str, options: Optional[Dict[str, Any]] = None,
+                              **extra) -> AsyncIterator[Dict[str, Any]]:
+        """Run a streaming generation, yielding each NDJSON object Ollama sends"""
+        payload = self._generate_payload(prompt, options, None, stream=True, **extra)
+        response = await self.request('POST', '/api/generate', json=payload, stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if line:
+                    data = json.loads(line)
+                    yield data
+                    if data.get('done'):
+                        break
+        except httpx.TransportError as e:
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"AI service stream interrupted: {e}") from e
+        finally:
+            await response.aclose()
+
+    async def request(self, method: str, path: str, timeout=None, retries: Optional[int] = None,
+                      stream: bool = False, **kwargs) -> httpx.Response:
+        """Send a request, retrying transient failures with exponential backoff.
+
+        With stream=True the body is left unread; the caller must close the response.
+        """
+        self.breaker.before_request()
+        backend_ok = False
+        try:
+            last_error = None
+            retries = self.max_retries if retries is None else retries
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+                try:
+                    request = self.client.build_request(method, path,
+                                                        timeout=self._httpx_timeout(timeout or self.timeout), **kwargs)
+                    response = await self.client.send(request, stream=stream)
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError) as e:
+                    last_error = e
+                    continue
+                except httpx.TimeoutException as e:
+                    # A read timeout already cost the full budget; don't pay it again
+                    last_error = e
+                    break
+
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    last_error = f"HTTP {response.status_code}"
+                    await response.aclose()
+                    continue
+                # Any other answer means the server is up, even if the request itself is wrong
+                backend_ok = True
+                if response.status_code != 200:
+                    await response.aclose()
+                    raise LLMUnavailableError(f"Ollama API error: {response.status_code}")
+                return response
+
+            raise LLMUnavailableError(f"AI service unavailable: {last_error}")
+        finally:
+            # Exactly one outcome per request, even if it was cancelled
+            if backend_ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_client = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncOllamaClient
+
+
+def get_llm_client() -> OllamaClient:
+    """Return the LLM client shared by this process"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OllamaClient()
+    return _client
+
+
+def get_async_llm_client() -> AsyncOllamaClient:
+    """Return the async LLM client for the running event loop.
+
+    It shares the sync client's circuit breaker, so failures seen by either
+    make both fail fast. The client is closed when its loop shuts down:
+    under WSGI every async view runs on a loop of its own, so the pool lasts
+    one request; under ASGI it lasts the process.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncOllamaClient(breaker=get_llm_client().breaker)
+        client.closer = loop.create_task(_close_with_loop(client))
+    return client
+
+
+async def _close_with_loop(client: AsyncOllamaClient):
+    # asyncio.run(), which asgiref and uvicorn use, cancels every pending task
+    # before closing the loop; the cancellation is the cue to close the pool.
+    # (A task cancelled before it first ran skips this, but then the client
+    # has sent nothing and holds no connections.)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await client.aclose()
+
+
+async def aclose_async_llm_client():
+    """Close the running loop's async client now, e.g. on ASGI lifespan shutdown"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        client.closer.cancel()
+        await client.aclose()
@@ -0,0 +1,85 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from learning_app.chunker import TokenChunker, embedding_token_counter, split_sentences, whitespace_token_counter
+from learning_app.pdf_processor import PDFProcessor
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from at which but have "
+    "an they you were their one all we can her has there been if more when will would who so no "
+    "energy system cell theory process function model data structure value analysis method result"
+).split()
+
+class Command(BaseCommand):
+    help = 'Compare the legacy character chunker with the token-aware TokenChunker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megabytes', type=float, default=4.0, help='Size of the synthetic corpus')
+        parser.add_argument('--pdf', help='Benchmark on the pages of this PDF instead of synthetic text')
+        parser.add_argument('--tokenizer', choices=['model', 'whitespace'], default='model',
+                            help='Token counter used by TokenChunker')
+
+    def handle(self, *args, **options):
+        processor = PDFProcessor()
+
+        if options['pdf']:
+            pages = list(processor.iter_pages(options['pdf']))
+        else:
+            pages = self.synthetic_pages(int(options['megabytes'] * 1024 * 1024))
+
+        corpus_mb = sum(len(text) for _, text in pages) / (1024 * 1024)
+        self.stdout.write(f"Corpus: {len(pages)} pages, {corpus_mb:.1f} MB")
+
+        start = time.perf_counter()
+        legacy_chunks = sum(len(processor.split_into_chunks(text.strip())) for _, text in pages if text.strip())
+        self.report('Legacy split_into_chunks', legacy_chunks, time.perf_counter() - start, corpus_mb)
+
+        counter = embedding_token_counter if options['tokenizer'] == 'model' else whitespace_token_counter
+        if counter is embedding_token_counter:
+            counter(['warm up'])  # Keep model loading out of the timing
+
+        for span_pages in (False, True):
+            chunker = TokenChunker(token_counter=counter, span_pages=span_pages)
+            start = time.perf_counter()
+            chunks = list(chunker.chunk_pages(pages))
+            elapsed = time.perf_counter() - start
+
+            label = f"TokenChunker ({options['tokenizer']} tokens, span_pages={span_pages})"
+            self.report(label, len(chunks), elapsed, corpus_mb)
+            if chunks:
+                average = sum(chunk.tokens for chunk in chunks) / len(chunks)
+                self.stdout.write(f"    avg tokens/chunk: {average:.0f}, max: {max(c.tokens for c in chunks)}")
+
+        # The legacy splitter slices characters; TokenChunker also finds sentences and counts their tokens
+        start = time.perf_counter()
+        page_sentences = [split_sentences(text) for _, text in pages]
+        split_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        for sentences in page_sentences:
+            counter(sentences)
+        count_elapsed = time.perf_counter() - start
+        self.stdout.write(f"TokenChunker time per run spent splitting sentences: {split_elapsed:.2f}s, "
+                          f"counting tokens: {count_elapsed:.2f}s")
+
+    def synthetic_pages(self, total_chars, page_chars=3000):
+        rng = random.Random(42)
+        pages = []
+        page_num = 0
+        while total_chars > 0:
+            sentences = []
+            length = 0
+            while length < page_chars:
+                sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 30))).capitalize() + '.'
+                sentences.append(sentence)
+                length += len(sentence) + 1
+            page_num += 1
+            text = ' '.join(sentences)
+            pages.append((page_num, text))
+            total_chars -= len(text)
+        return pages
+
+    def report(self, label, chunk_count, elapsed, corpus_mb):
+        self.stdout.write(
+            f"{label}: {chunk_count} chunks in {elapsed:.2f}s ({corpus_mb / elapsed:.1f} MB/s)"
+        )
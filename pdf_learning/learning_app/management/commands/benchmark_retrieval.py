@@ -0,0 +1,105 @@
+import json
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from learning_app import caches
+from learning_app.ai_service import AIService
+from learning_app.lexical_index import get_lexical_index
+from learning_app.reranker import RERANK_METHODS, estimate_tokens
+
+FIXTURE = Path(__file__).resolve().parents[2] / 'benchmark_data' / 'retrieval.json'
+
+class Command(BaseCommand):
+    help = 'Compare chat context reranking methods by latency and recall@k on a labelled fixture set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixture', default=str(FIXTURE),
+                            help='JSON file of documents (passages with ids) and queries with relevant passage ids')
+        parser.add_argument('--methods', default=','.join(RERANK_METHODS), help='Comma-separated rerank methods')
+        parser.add_argument('--candidates', default='10,20,40', help='Comma-separated candidate depths to try')
+        parser.add_argument('--top-k', type=int, default=settings.RERANK_TOP_K, help='Chunks kept per query')
+        parser.add_argument('--token-budget', type=int, default=settings.CHAT_CONTEXT_TOKEN_BUDGET,
+                            help='Context token budget (0 = no limit)')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed passes over the queries')
+
+    def handle(self, *args, **options):
+        with open(options['fixture']) as f:
+            fixture = json.load(f)
+
+        ai_service = AIService()
+        collections = {}  # document title -> collection id
+        passage_ids = {}  # passage text -> passage id
+        try:
+            for document in fixture['documents']:
+                collection_id = f"bench_{uuid.uuid4().hex}"
+                collections[document['title']] = collection_id
+                texts = [passage['text'] for passage in document['passages']]
+                ai_service.add_text_chunks(collection_id, texts, list(range(1, len(texts) + 1)))
+                passage_ids.update((passage['text'], passage['id']) for passage in document['passages'])
+
+            queries = fixture['queries']
+            # Keep query encoding and model loading out of the timings
+            ai_service.embed_queries([query['query'] for query in queries])
+            self.stdout.write(f"Fixture: {len(passage_ids)} passages in {len(collections)} documents, "
+                              f"{len(queries)} queries; top_k={options['top_k']}, "
+                              f"token budget={options['token_budget']}")
+            self.stdout.write(f"{'method':<14}{'candidates':>11}{'recall@k':>10}{'mean ms':>9}{'p95 ms':>8}"
+                              f"{'chunks':>8}{'tokens':>8}")
+
+            depths = [int(depth) for depth in options['candidates'].split(',')]
+            for method in options['methods'].split(','):
+                if method == 'cross_encoder' and not self.load_cross_encoder():
+                    continue
+                for depth in (depths if method != 'none' else [options['top_k']]):
+                    self.run(ai_service, method, depth, queries, collections, passage_ids, options)
+        finally:
+            lexical = get_lexical_index()
+            for collection_id in collections.values():
+                if lexical:
+                    lexical.delete_collection(collection_id)
+                try:
+                    ai_service.chroma_client.delete_collection(f"doc_{collection_id}")
+                except Exception:
+                    pass
+
+    def load_cross_encoder(self) -> bool:
+        from learning_app.shared_resources import get_cross_encoder
+
+        try:
+            get_cross_encoder()
+            return True
+        except Exception as e:
+            self.stderr.write(f"Skipping cross_encoder: could not load {settings.RERANK_CROSS_ENCODER_MODEL} ({e})")
+            return False
+
+    def run(self, ai_service, method, depth, queries, collections, passage_ids, options):
+        latencies = []
+        recalls = []
+        chunk_counts = []
+        token_counts = []
+        for _ in range(max(1, options['repeat'])):
+            # Measure retrieval itself, not the result cache
+            caches.retrieval_results.clear()
+            for query in queries:
+                start = time.perf_counter()
+                chunks = ai_service.retrieve_reranked(collections[query['document']], query['query'],
+                                                      top_k=options['top_k'], candidates=depth, method=method,
+                                                      token_budget=options['token_budget'])
+                latencies.append(time.perf_counter() - start)
+
+                found = {passage_ids.get(chunk) for chunk in chunks}
+                relevant = set(query['relevant'])
+                recalls.append(len(found & relevant) / len(relevant))
+                chunk_counts.append(len(chunks))
+                token_counts.append(sum(estimate_tokens(chunk) for chunk in chunks))
+
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(
+            f"{method:<14}{depth:>11}{sum(recalls) / len(recalls):>10.3f}"
+            f"{1000 * sum(latencies) / len(latencies):>9.1f}{1000 * p95:>8.1f}"
+            f"{sum(chunk_counts) / len(chunk_counts):>8.1f}{sum(token_counts) / len(token_counts):>8.0f}"
+        )
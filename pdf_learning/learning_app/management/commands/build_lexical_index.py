@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from learning_app.ai_service import AIService
+from learning_app.lexical_index import get_lexical_index
+from learning_app.models import PDFDocument
+
+class Command(BaseCommand):
+    help = 'Add documents ingested before hybrid search to the keyword index, from their vector store chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Re-index documents that are already indexed')
+
+    def handle(self, *args, **options):
+        lexical = get_lexical_index()
+        if lexical is None:
+            raise CommandError('Hybrid search is disabled (HYBRID_SEARCH)')
+
+        ai_service = AIService()
+        indexed = 0
+        # Documents with identical content share a collection; index each once
+        collection_ids = set(document.collection_id for document in PDFDocument.objects.filter(processed=True))
+        for collection_id in sorted(collection_ids):
+            if lexical.has_collection(collection_id) and not options['rebuild']:
+                continue
+            try:
+                collection = ai_service.chroma_client.get_collection(name=f"doc_{collection_id}".replace('-', '_'))
+            except Exception as e:
+                self.stderr.write(f"Skipping {collection_id}: {e}")
+                continue
+
+            chunks = collection.get(include=["documents", "metadatas"])
+            lexical.add_chunks(collection_id, [
+                (chunk_id, text, (metadata or {}).get('page'), (metadata or {}).get('page_end'))
+                for chunk_id, text, metadata in zip(chunks['ids'], chunks['documents'], chunks['metadatas'])
+            ])
+            indexed += 1
+            self.stdout.write(f"Indexed {len(chunks['ids'])} chunks for {collection_id}")
+
+        self.stdout.write(f"Indexed {indexed} collection(s)")
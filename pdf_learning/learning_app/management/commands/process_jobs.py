@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+from learning_app.jobs import recover_stale_jobs, run_pending
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (PDF ingestion etc.), requeueing ones interrupted by a crash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new jobs')
+        parser.add_argument('--interval', type=float, default=2.0, help='Polling interval in seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            recover_stale_jobs()
+            completed = run_pending()
+            if completed:
+                self.stdout.write(f"Processed {completed} job(s)")
+            
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -29,7 +29,7 @@ class Command(BaseCommand):
         
         # Test question generation
         questions = ai_service.generate_mcq_questions(
-            str(document.id), 
+            document.collection_id, 
             topic="", 
             page_range="", 
             num_questions=2
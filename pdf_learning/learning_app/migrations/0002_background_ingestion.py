@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def mark_processed_documents_done(apps, schema_editor):
+    PDFDocument = apps.get_model('learning_app', 'PDFDocument')
+    PDFDocument.objects.filter(processed=True).update(stage='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='chunks_embedded',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='pages_extracted',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pdfdocument',
+            name='stage',
+            field=models.CharField(choices=[('queued', 'Queued'), ('extracting', 'Extracting text'), ('embedding', 'Embedding chunks'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('document', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='learning_app.pdfdocument')),
+            ],
+        ),
+        migrations.RunPython(mark_processed_documents_done, migrations.RunPython.noop),
+    ]
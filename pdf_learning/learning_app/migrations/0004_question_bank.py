@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0003_document_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BankQuestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(blank=True, max_length=200)),
+                ('question_text', models.TextField()),
+                ('options', models.JSONField()),
+                ('correct_answer', models.CharField(max_length=1)),
+                ('explanation', models.TextField(blank=True)),
+                ('page', models.IntegerField(blank=True, null=True)),
+                ('chunk_id', models.CharField(blank=True, max_length=50)),
+                ('times_served', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bank_questions', to='learning_app.pdfdocument')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['document', 'topic', 'times_served'], name='learning_ap_documen_91431e_idx')],
+            },
+        ),
+    ]
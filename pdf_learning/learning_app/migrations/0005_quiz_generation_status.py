@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0004_question_bank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quizsession',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='quizsession',
+            name='requested_questions',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='quizsession',
+            name='status',
+            field=models.CharField(choices=[('generating', 'Generating'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=12),
+        ),
+    ]
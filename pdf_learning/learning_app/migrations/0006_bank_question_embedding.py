@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0005_quiz_generation_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankquestion',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0006_bank_question_embedding'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['document', 'timestamp'], name='chat_document_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pdfdocument',
+            index=models.Index(fields=['-uploaded_at'], name='document_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quizsession',
+            index=models.Index(fields=['document', '-created_at'], name='quiz_document_created_idx'),
+        ),
+    ]
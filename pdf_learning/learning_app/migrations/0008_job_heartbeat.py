@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:59
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_heartbeats_of_running_jobs(apps, schema_editor):
+    BackgroundJob = apps.get_model('learning_app', 'BackgroundJob')
+    BackgroundJob.objects.filter(status='running').update(heartbeat_at=F('started_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('learning_app', '0007_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(start_heartbeats_of_running_jobs, migrations.RunPython.noop),
+    ]
@@ -2,6 +2,14 @@ from django.db import models
 import uuid
 
 class PDFDocument(models.Model):
+    STAGES = [
+        ('queued', 'Queued'),
+        ('extracting', 'Extracting text'),
+        ('embedding', 'Embedding chunks'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=200)
     file = models.FileField(upload_to='pdfs/')
@@ -9,10 +17,52 @@ class PDFDocument(models.Model):
     processed = models.BooleanField(default=False)
     total_pages = models.IntegerField(null=True, blank=True)
     
+    # Ingestion progress, updated by the background worker
+    stage = models.CharField(max_length=20, choices=STAGES, default='queued')
+    pages_extracted = models.IntegerField(default=0)
+    chunks_embedded = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    
+    # SHA-256 of the uploaded file; identical uploads share one vector collection
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    
+    class Meta:
+        indexes = [models.Index(fields=['-uploaded_at'], name='document_uploaded_idx')]
+    
     def __str__(self):
         return self.title
+    
+    @property
+    def collection_id(self) -> str:
+        """Key of the vector store collection holding this document's chunks"""
+        return self.content_hash[:32] if self.content_hash else str(self.id)
+    
+    def find_processed_duplicate(self):
+        """Return an already processed document with the same content, if any"""
+        if not self.content_hash:
+            return None
+        return (PDFDocument.objects
+                .filter(content_hash=self.content_hash, processed=True)
+                .exclude(id=self.id)
+                .first())
+    
+    def copy_ingestion_from(self, source):
+        """Mark this document processed using another document's ingestion results"""
+        self.total_pages = source.total_pages
+        self.pages_extracted = source.pages_extracted
+        self.chunks_embedded = source.chunks_embedded
+        self.stage = 'done'
+        self.processed = True
+        self.error = ''
+        self.save()
 
 class QuizSession(models.Model):
+    STATUS_CHOICES = [
+        ('generating', 'Generating'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     document = models.ForeignKey(PDFDocument, on_delete=models.CASCADE)
     topic = models.CharField(max_length=200, blank=True)
@@ -20,6 +70,14 @@ class QuizSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     completed = models.BooleanField(default=False)
     score = models.FloatField(null=True, blank=True)
+    
+    # Questions are generated in the background and appear as they are produced
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='ready')
+    requested_questions = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    
+    class Meta:
+        indexes = [models.Index(fields=['document', '-created_at'], name='quiz_document_created_idx')]
 
 class Question(models.Model):
     QUESTION_TYPES = [
@@ -35,8 +93,57 @@ class Question(models.Model):
     user_answer = models.CharField(max_length=1, blank=True)
     is_correct = models.BooleanField(null=True, blank=True)
 
+class BankQuestion(models.Model):
+    """A pre-generated question, drawn into quizzes without waiting on the LLM"""
+    document = models.ForeignKey(PDFDocument, on_delete=models.CASCADE, related_name='bank_questions')
+    topic = models.CharField(max_length=200, blank=True)  # Normalized; blank for general questions
+    question_text = models.TextField()
+    options = models.JSONField()
+    correct_answer = models.CharField(max_length=1)
+    explanation = models.TextField(blank=True)
+    
+    # Where the question came from; empty for questions generated live from several chunks
+    page = models.IntegerField(null=True, blank=True)
+    chunk_id = models.CharField(max_length=50, blank=True)
+    
+    times_served = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    # Normalized float32 embedding of question_text, used for duplicate detection
+    embedding = models.BinaryField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [models.Index(fields=['document', 'topic', 'times_served'])]
+    
+    def __str__(self):
+        return self.question_text[:80]
+
 class ChatMessage(models.Model):
     document = models.ForeignKey(PDFDocument, on_delete=models.CASCADE)
     message = models.TextField()
     response = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [models.Index(fields=['document', 'timestamp'], name='chat_document_time_idx')]
+
+class BackgroundJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    kind = models.CharField(max_length=50)
+    document = models.ForeignKey(PDFDocument, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.kind} ({self.status})"
@@ -1,28 +1,80 @@
+import math
+import multiprocessing
+import os
 import PyPDF2
-import re
-from typing import List, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
+from .chunker import TextChunk, TokenChunker
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages [start, end) from a PDF on disk.
+    
+    Module-level so it can be pickled and run in a worker process.
+    """
+    pdf_reader = PyPDF2.PdfReader(pdf_path)
+    return [pdf_reader.pages[i].extract_text() for i in range(start, end)]
 
 class PDFProcessor:
     def __init__(self):
-        self.chunk_size = 1000  # Characters per chunk
-        self.chunk_overlap = 200  # Overlap between chunks
+        self.chunk_size = 1000  # Characters per chunk (legacy split_into_chunks)
+        self.chunk_overlap = 200  # Overlap between chunks (legacy split_into_chunks)
+        self.extraction_workers = settings.PDF_EXTRACTION_WORKERS or os.cpu_count() or 1
+        self.parallel_min_pages = settings.PDF_PARALLEL_MIN_PAGES
+        self.max_pages_per_task = 25  # Upper bound on pages held per worker result
+    
+    def count_pages(self, pdf_file: Union[UploadedFile, str]) -> int:
+        """Return the number of pages without extracting any text"""
+        try:
+            return len(PyPDF2.PdfReader(pdf_file).pages)
+        except Exception as e:
+            raise Exception(f"Error processing PDF: {str(e)}")
     
-    def extract_text_from_pdf(self, pdf_file: UploadedFile) -> Tuple[str, int]:
-        """Extract text from PDF file"""
+    def iter_pages(self, pdf_file: Union[UploadedFile, str]) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, text) for every page, in page order.
+        
+        Page numbers are 1-indexed. Large PDFs given as a path are split into
+        page ranges and extracted in a process pool; small files and in-memory
+        uploads are read serially. Only a bounded window of ranges is in flight
+        at once, so memory stays proportional to a few pages, not the book.
+        """
         try:
             pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
             total_pages = len(pdf_reader.pages)
+            workers = min(self.extraction_workers, total_pages)
             
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                text += f"\n--- Page {page_num + 1} ---\n{page_text}\n"
+            if (not isinstance(pdf_file, (str, os.PathLike))
+                    or workers <= 1
+                    or total_pages < self.parallel_min_pages):
+                for page_num, page in enumerate(pdf_reader.pages):
+                    yield page_num + 1, page.extract_text()
+                return
             
-            return text, total_pages
+            # A couple of ranges per worker keeps the pool busy when some pages
+            # are much heavier than others
+            range_size = min(math.ceil(total_pages / (workers * 2)), self.max_pages_per_task)
+            ranges = ((start, min(start + range_size, total_pages))
+                      for start in range(0, total_pages, range_size))
+            
+            # Spawn rather than fork: ingestion runs on a background thread
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                in_flight = deque()
+                for start, end in ranges:
+                    in_flight.append((start, executor.submit(extract_page_range, str(pdf_file), start, end)))
+                    if len(in_flight) >= workers * 2:
+                        yield from self._drain_range(*in_flight.popleft())
+                while in_flight:
+                    yield from self._drain_range(*in_flight.popleft())
         except Exception as e:
             raise Exception(f"Error processing PDF: {str(e)}")
     
+    def _drain_range(self, start: int, future) -> Iterator[Tuple[int, str]]:
+        for offset, page_text in enumerate(future.result()):
+            yield start + offset + 1, page_text
+    
     def extract_text_from_pages(self, pdf_file: UploadedFile, page_range: str) -> str:
         """Extract text from specific pages"""
         try:
@@ -67,30 +119,15 @@ class PDFProcessor:
         
         return sorted(list(set(pages)))  # Remove duplicates and sort
     
-    def chunk_text(self, text: str) -> Tuple[List[str], List[int]]:
-        """Split text into chunks with page tracking"""
-        chunks = []
-        page_numbers = []
-        
-        # Split by page markers
-        pages = re.split(r'--- Page (\d+) ---', text)
-        
-        current_page = 1
-        for i in range(1, len(pages), 2):  # Skip empty first element, then take page_num, content pairs
-            if i + 1 < len(pages):
-                page_num = int(pages[i])
-                page_content = pages[i + 1].strip()
-                
-                if page_content:
-                    # Split page content into chunks
-                    page_chunks = self.split_into_chunks(page_content)
-                    chunks.extend(page_chunks)
-                    page_numbers.extend([page_num] * len(page_chunks))
-        
-        return chunks, page_numbers
+    def chunk_pages(self, pages: Iterable[Tuple[int, str]], chunker: Optional[TokenChunker] = None) -> Iterator[TextChunk]:
+        """Yield token-sized chunks with page metadata from a stream of page records"""
+        return (chunker or TokenChunker()).chunk_pages(pages)
     
     def split_into_chunks(self, text: str) -> List[str]:
-        """Split text into overlapping chunks"""
+        """Split text into overlapping character-sized chunks.
+        
+        Superseded by TokenChunker; kept as the baseline for benchmark_chunker.
+        """
         if len(text) <= self.chunk_size:
             return [text]
         
@@ -0,0 +1,168 @@
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F
+
+from .ai_service import AIService
+from .caches import normalize_query
+from .dedup import SemanticDeduplicator, normalize_rows
+from .health import check_llm_health
+from .jobs import enqueue, job_handler
+from .llm_client import LLMUnavailableError
+from .models import BackgroundJob, BankQuestion, PDFDocument, QuizSession
+from .scheduler import BACKGROUND
+
+# Per-document pool of pre-generated questions. It is filled in the background
+# after ingestion and topped up as quizzes use it, so most quizzes are assembled
+# from the database instead of waiting on the LLM.
+
+
+def draw_questions(document: PDFDocument, topic: str, pages: List[int], count: int) -> List[BankQuestion]:
+    """Take the count least-served bank questions for a quiz.
+
+    Returns an empty list when the bank can't cover the whole quiz, in which
+    case the caller generates questions live.
+    """
+    candidates = BankQuestion.objects.filter(document=document, topic=normalize_query(topic))
+    if pages:
+        candidates = candidates.filter(page__in=pages)
+
+    drawn = list(candidates.order_by('times_served', '?')[:count])
+    if len(drawn) < count:
+        return []
+
+    BankQuestion.objects.filter(id__in=[question.id for question in drawn]).update(
+        times_served=F('times_served') + 1
+    )
+    return drawn
+
+
+def add_generated(document: PDFDocument, topic: str, questions: List[Dict]) -> List[BankQuestion]:
+    """Keep questions generated live for a quiz so the next quiz on the topic can reuse them"""
+    return BankQuestion.objects.bulk_create([
+        bank_question(document, normalize_query(topic), question, times_served=1)
+        for question in questions
+    ])
+
+
+def request_top_up(document: PDFDocument, topic: str = "") -> Optional[BackgroundJob]:
+    """Queue a fill_bank job when few unserved questions remain for a topic.
+
+    A free-text topic only gets a bank of its own once quizzes have asked for
+    it QUESTION_BANK_TOPIC_REQUESTS times, so typos and one-off topics don't
+    each cost a full bank of background generations.
+    """
+    if settings.QUESTION_BANK_SIZE <= 0:
+        return None
+
+    topic = normalize_query(topic)
+    if topic and QuizSession.objects.filter(document=document, topic__iexact=topic).count() < \
+            settings.QUESTION_BANK_TOPIC_REQUESTS:
+        return None
+    fresh = BankQuestion.objects.filter(document=document, topic=topic, times_served=0).count()
+    if fresh >= settings.QUESTION_BANK_LOW_WATER:
+        return None
+
+    pending = BackgroundJob.objects.filter(
+        kind='fill_bank', document=document, status__in=['queued', 'running'], payload__topic=topic
+    )
+    if pending.exists():
+        return None
+    return enqueue('fill_bank', document, topic=topic, count=settings.QUESTION_BANK_SIZE - fresh)
+
+
+def bank_question(document: PDFDocument, topic: str, question: Dict, page: Optional[int] = None,
+                  chunk_id: str = '', times_served: int = 0) -> BankQuestion:
+    embedding = question.get('embedding')
+    return BankQuestion(
+        document=document,
+        topic=topic,
+        question_text=question['question_text'],
+        options=question['options'],
+        correct_answer=question['correct_answer'],
+        explanation=question.get('explanation', ''),
+        page=page,
+        chunk_id=chunk_id,
+        times_served=times_served,
+        embedding=np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+    )
+
+
+def bank_deduplicator(document: PDFDocument, ai_service: AIService) -> SemanticDeduplicator:
+    """A duplicate detector seeded with every question in the document's bank.
+
+    Live-generated quiz questions are filed in the bank too, so this also
+    covers past quizzes. Questions stored without an embedding are encoded
+    once and backfilled.
+    """
+    questions = list(BankQuestion.objects.filter(document=document).only('id', 'question_text', 'embedding'))
+    missing = [question for question in questions if not question.embedding]
+    if missing:
+        vectors = normalize_rows(ai_service.encode_texts([question.question_text for question in missing]))
+        for question, vector in zip(missing, vectors):
+            question.embedding = vector.tobytes()
+        BankQuestion.objects.bulk_update(missing, ['embedding'])
+
+    seed = [np.frombuffer(question.embedding, dtype=np.float32) for question in questions]
+    return ai_service.question_deduplicator(np.vstack(seed) if seed else None)
+
+
+@job_handler('fill_bank')
+def fill_bank(job: BackgroundJob):
+    """Generate questions for a document's bank, one LLM call per source chunk"""
+    document = job.document
+    topic = job.payload.get('topic', '')
+    count = job.payload.get('count') or settings.QUESTION_BANK_SIZE
+    if count <= 0:
+        return
+
+    # Fail fast rather than spending the retry budget of every request on a dead backend
+    if not check_llm_health()['ok']:
+        raise LLMUnavailableError("AI service unavailable; question bank not filled")
+
+    # Lowest priority: only uses LLM capacity that chat and live quizzes leave idle
+    ai_service = AIService(priority=BACKGROUND, fairness_key=str(document.id))
+    per_call = max(1, settings.MCQ_QUESTIONS_PER_CALL)
+    used_chunks = set(BankQuestion.objects.filter(document=document, topic=topic)
+                      .exclude(chunk_id='').values_list('chunk_id', flat=True))
+    deduplicator = bank_deduplicator(document, ai_service)
+
+    # Prefer chunks no bank question has been generated from yet
+    wanted_chunks = math.ceil(count / per_call)
+    chunks = ai_service.sample_chunks(document.collection_id, wanted_chunks, query=topic, exclude_ids=used_chunks)
+    if not chunks:
+        chunks = ai_service.sample_chunks(document.collection_id, wanted_chunks, query=topic)
+
+    added = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, settings.MCQ_MAX_IN_FLIGHT), thread_name_prefix='bank')
+    try:
+        futures = {executor.submit(ai_service.generate_mcq_set, chunk['text'], per_call, topic): chunk
+                   for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                questions = future.result()
+            except LLMUnavailableError:
+                raise
+            except Exception as e:
+                print(f"Error generating bank questions from {chunk['id']}: {e}")
+                continue
+
+            vectors = deduplicator.filter_new([question['question_text'] for question in questions])
+            accepted = [
+                bank_question(document, topic, dict(question, embedding=vector), page=chunk['page'], chunk_id=chunk['id'])
+                for question, vector in zip(questions, vectors) if vector is not None
+            ][:count - added]
+
+            # Save as results arrive so quizzes can use the bank before the job finishes
+            BankQuestion.objects.bulk_create(accepted)
+            added += len(accepted)
+            if added >= count:
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    print(f"Added {added} questions to the bank for document {document.id} (topic '{topic}')")
@@ -0,0 +1,83 @@
+from typing import Dict, List
+
+from .ai_service import AIService
+from .jobs import QUIZ_POOL, job_handler
+from .models import BackgroundJob, Question, QuizSession
+from .question_bank import add_generated, bank_deduplicator, request_top_up
+from .scheduler import QUIZ
+
+NO_QUESTIONS_ERROR = (
+    'Unable to generate questions. The content in the selected pages may be unclear, '
+    'or the AI model may be struggling with this topic. Try a simpler topic or a different page range.'
+)
+
+
+
+class QuizCompleted(Exception):
+    """The quiz was submitted while its questions were still being generated"""
+
+
+@job_handler('generate_quiz', pool=QUIZ_POOL)
+def generate_quiz(job: BackgroundJob):
+    """Generate a quiz's questions, saving each one as soon as it is produced"""
+    quiz_session = QuizSession.objects.select_related('document').get(id=job.payload['quiz_id'])
+    document = quiz_session.document
+    generated: List[Dict] = []
+
+    # A job requeued after a crash only makes up the questions still missing
+    existing = list(quiz_session.questions.values_list('question_text', flat=True))
+    remaining = quiz_session.requested_questions - len(existing)
+    if remaining <= 0:
+        finish(quiz_session, 'ready')
+        return
+
+    def on_question(question: Dict):
+        # Questions added after grading would show up unanswered in the results
+        if QuizSession.objects.filter(id=quiz_session.id, completed=True).exists():
+            raise QuizCompleted()
+        Question.objects.create(
+            quiz_session=quiz_session,
+            question_text=question['question_text'],
+            options=question['options'],
+            correct_answer=question['correct_answer'],
+            explanation=question.get('explanation', '')
+        )
+        generated.append(question)
+
+    try:
+        # Someone is waiting on this quiz, so it outranks bank filling; quizzes share the LLM in turns
+        ai_service = AIService(priority=QUIZ, fairness_key=str(quiz_session.id))
+        # Steer away from questions students have already seen for this document, and this quiz's own
+        deduplicator = bank_deduplicator(document, ai_service)
+        if existing:
+            deduplicator.add(ai_service.encode_texts(existing))
+        ai_service.generate_mcq_questions(
+            document.collection_id,
+            quiz_session.topic,
+            quiz_session.page_range,
+            remaining,
+            total_pages=document.total_pages,
+            on_question=on_question,
+            deduplicator=deduplicator
+        )
+    except QuizCompleted:
+        print(f"Quiz {quiz_session.id} was submitted; stopping generation after {len(generated)} questions")
+    except Exception as e:
+        finish(quiz_session, 'ready' if generated or existing else 'failed', str(e))
+        raise
+
+    if not generated and not existing:
+        finish(quiz_session, 'failed', NO_QUESTIONS_ERROR)
+        return
+
+    finish(quiz_session, 'ready')
+
+    # Keep the questions so the next quiz on this topic comes from the bank
+    add_generated(document, quiz_session.topic, generated)
+    request_top_up(document, quiz_session.topic)
+
+
+def finish(quiz_session: QuizSession, status: str, error: str = ''):
+    quiz_session.status = status
+    quiz_session.error = error
+    quiz_session.save(update_fields=['status', 'error'])
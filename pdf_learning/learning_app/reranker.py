@@ -0,0 +1,75 @@
+import math
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from .dedup import normalize_rows
+
+# Second retrieval stage for prompt context: the vector store over-fetches
+# candidates, these functions pick the few worth sending to the LLM, and the
+# result is trimmed to a token budget so prefill stays short.
+
+RERANK_METHODS = ('none', 'mmr', 'cross_encoder')
+
+
+def mmr_order(query_vector, candidate_vectors, k: int, lambda_: float,
+              relevance: Optional[Sequence[float]] = None) -> List[int]:
+    """Maximal marginal relevance: indices of k candidates close to the query but not to each other.
+
+    lambda_ = 1 ranks by relevance alone; lower values penalize candidates
+    similar to ones already picked, which drops overlapping chunks.
+    Relevance is cosine similarity to the query unless other scores (such
+    as fused hybrid scores) are given; those are scaled so the best is 1.
+    """
+    candidates = normalize_rows(candidate_vectors)
+    if not len(candidates) or not candidates.shape[1]:
+        return []
+    if relevance is None:
+        relevance = candidates @ normalize_rows(query_vector)[0]
+    else:
+        relevance = np.asarray(relevance, dtype=np.float32)
+        relevance = relevance / (relevance.max() or 1)
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    remaining = [i for i in range(len(candidates)) if i != selected[0]]
+    while remaining and len(selected) < k:
+        redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        scores = lambda_ * relevance[remaining] - (1 - lambda_) * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+        selected.append(best)
+    return selected[:k]
+
+
+def cross_encoder_order(query: str, documents: Sequence[str], k: int) -> List[int]:
+    """Indices of the k documents a cross-encoder scores as most relevant to the query"""
+    from .shared_resources import get_cross_encoder
+
+    if not documents:
+        return []
+    scores = np.asarray(get_cross_encoder().predict([(query, document) for document in documents]))
+    return [int(i) for i in np.argsort(-scores, kind='stable')[:k]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count: about four characters per token for English text"""
+    return math.ceil(len(text) / 4)
+
+
+def trim_to_budget(chunks: List[str], budget: int, count_tokens: Callable[[str], int] = estimate_tokens) -> List[str]:
+    """Keep chunks in rank order while they fit in budget tokens (0 = no limit).
+
+    The top chunk is always kept so a small budget never empties the context.
+    """
+    if budget <= 0:
+        return chunks
+
+    kept = []
+    used = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk)
+        if kept and used + tokens > budget:
+            break
+        kept.append(chunk)
+        used += tokens
+    return kept
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from .caches import LRUCache
+
+# Cache of complete LLM responses keyed by a hash of model, options and prompt.
+# Chat prompts embed the retrieved context, so a re-ingested document produces
+# new prompts and stale answers are never served for it.
+
+
+class LRUBackend:
+    """Per-process in-memory backend"""
+
+    name = 'lru'
+    blocking = False
+
+    def __init__(self, max_entries: int, ttl: Optional[float]):
+        self._cache = LRUCache(max_entries, ttl=ttl)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._cache.get(key)
+
+    def set(self, key: str, entry: Dict[str, Any]):
+        self._cache.set(key, entry)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class DjangoCacheBackend:
+    """Backend on one of Django's CACHES, shared by every process using it.
+
+    Size limits come from that cache's own configuration (e.g. MAX_ENTRIES),
+    and clear() empties the whole cache, so give it a dedicated alias.
+    """
+
+    name = 'django'
+    blocking = True  # File, database and network caches do I/O
+
+    def __init__(self, alias: str, ttl: Optional[float]):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._cache.get(f"llm_response:{key}")
+
+    def set(self, key: str, entry: Dict[str, Any]):
+        self._cache.set(f"llm_response:{key}", entry, timeout=self.ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SQLiteBackend:
+    """On-disk backend shared by the processes on one machine; survives restarts"""
+
+    name = 'sqlite'
+    blocking = True
+
+    def __init__(self, path, max_entries: int, ttl: Optional[float]):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, entry TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the cache safe to use from worker threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT entry, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, entry: Dict[str, Any]):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, json.dumps(entry), now, now))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Trim to 90% of the limit so eviction doesn't run on every write
+        conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+            (count - int(self.max_entries * 0.9),)
+        )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class ResponseCache:
+    """Serve repeated LLM prompts from a backend, counting the work saved.
+
+    Each entry records the tokens the model generated and the seconds the
+    original call took, so hits can be reported as tokens and time saved.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.seconds_saved = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, prompt: str, options: Optional[Dict[str, Any]] = None,
+            response_format: Optional[str] = None) -> str:
+        material = json.dumps([model, options or {}, response_format, prompt], sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """The cached response text, or None"""
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            # A broken cache must never take generation down with it
+            print(f"LLM response cache lookup failed: {e}")
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += entry.get('tokens', 0)
+            self.seconds_saved += entry.get('seconds', 0.0)
+        return entry['response']
+
+    def set(self, key: str, response: str, tokens: int = 0, seconds: float = 0.0):
+        if not response:
+            return
+        try:
+            self.backend.set(key, {'response': response, 'tokens': tokens, 'seconds': round(seconds, 3)})
+        except Exception as e:
+            print(f"LLM response cache write failed: {e}")
+
+    async def aget(self, key: str) -> Optional[str]:
+        """get() for async code; backends that do I/O are called from a worker thread"""
+        if not self.backend.blocking:
+            return self.get(key)
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+    async def aset(self, key: str, response: str, tokens: int = 0, seconds: float = 0.0):
+        if not self.backend.blocking:
+            return self.set(key, response, tokens, seconds)
+        await sync_to_async(self.set, thread_sensitive=False)(key, response, tokens, seconds)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = self.misses = self.tokens_saved = 0
+            self.seconds_saved = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': self.backend.name,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'tokens_saved': self.tokens_saved,
+                'seconds_saved': round(self.seconds_saved, 1),
+            }
+
+
+def make_backend(name: str):
+    ttl = settings.LLM_RESPONSE_CACHE_TTL or None
+    if name == 'lru':
+        return LRUBackend(settings.LLM_RESPONSE_CACHE_SIZE, ttl)
+    if name == 'django':
+        return DjangoCacheBackend(settings.LLM_RESPONSE_CACHE_ALIAS, ttl)
+    if name == 'sqlite':
+        return SQLiteBackend(settings.LLM_RESPONSE_CACHE_PATH, settings.LLM_RESPONSE_CACHE_SIZE, ttl)
+    raise ImproperlyConfigured(f"Unknown LLM_RESPONSE_CACHE_BACKEND '{name}'; use 'lru', 'django', 'sqlite' or 'none'")
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return this process's response cache, or None when caching is disabled"""
+    global _response_cache
+    if settings.LLM_RESPONSE_CACHE_BACKEND == 'none':
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(make_backend(settings.LLM_RESPONSE_CACHE_BACKEND))
+    return _response_cache
@@ -0,0 +1,226 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from .llm_client import LLMUnavailableError
+
+# Priority classes, most urgent first. A free slot always goes to the most
+# urgent class with a waiting request.
+INTERACTIVE = 'interactive'  # Chat answers a user is watching
+QUIZ = 'quiz'  # Live generation for a quiz someone is taking
+BACKGROUND = 'background'  # Question bank filling
+PRIORITIES = (INTERACTIVE, QUIZ, BACKGROUND)
+
+# Recent wait times kept per class for percentiles
+WAIT_SAMPLES = 500
+
+
+class LLMQueueFullError(LLMUnavailableError):
+    """Too many requests of this priority are already waiting; retry later"""
+
+
+class LLMQueueTimeoutError(LLMUnavailableError):
+    """The request waited longer than LLM_QUEUE_TIMEOUT for a free slot"""
+
+
+class _Waiter:
+    __slots__ = ('priority', 'key', 'enqueued_at', 'event', 'loop', 'future', 'granted')
+
+    def __init__(self, priority: str, key: str, loop=None):
+        self.priority = priority
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.loop = loop
+        self.future = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+        self.granted = False
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class LLMScheduler:
+    """Admission control in front of the LLM backend.
+
+    At most max_concurrent requests run at once. Others wait in per-priority
+    queues, and within a priority the waiting keys (a document or quiz) take
+    turns, so one large quiz can't monopolize the backend. A request is
+    rejected at once if its priority's queue is full, and fails if it waits
+    longer than timeout. Works for threads and asyncio tasks alike.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, queue_limits: Optional[Dict[str, int]] = None,
+                 timeout: Optional[float] = None):
+        self.max_concurrent = max(1, max_concurrent or settings.LLM_MAX_CONCURRENT)
+        self.queue_limits = queue_limits or settings.LLM_QUEUE_LIMITS
+        self.timeout = settings.LLM_QUEUE_TIMEOUT if timeout is None else timeout
+        self.in_flight = 0
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}  # priority -> key -> deque of waiters
+        self._depth = dict.fromkeys(PRIORITIES, 0)
+        self._metrics = {priority: self._empty_metrics() for priority in PRIORITIES}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty_metrics() -> Dict[str, Any]:
+        return {'admitted': 0, 'rejected': 0, 'timed_out': 0, 'total_wait': 0.0, 'max_wait': 0.0,
+                'recent_waits': deque(maxlen=WAIT_SAMPLES)}
+
+    @contextmanager
+    def slot(self, priority: str = INTERACTIVE, key: str = ''):
+        """Hold one of the concurrent LLM slots for the duration of the block"""
+        waiter = self._enqueue(priority, key)
+        if waiter and not waiter.event.wait(self.timeout):
+            self._abandon(waiter)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, priority: str = INTERACTIVE, key: str = ''):
+        """slot() for async code; waiting doesn't block the event loop"""
+        waiter = self._enqueue(priority, key, loop=asyncio.get_running_loop())
+        if waiter:
+            try:
+                await asyncio.wait_for(waiter.future, self.timeout)
+            except asyncio.TimeoutError:
+                self._abandon(waiter)
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted = waiter.granted
+                    if not granted:
+                        self._remove(waiter)
+                if granted:
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def is_full(self, priority: str) -> bool:
+        """Whether a new request of this priority would be rejected right now"""
+        with self._lock:
+            if self.in_flight < self.max_concurrent and not any(self._depth.values()):
+                return False
+            return self._depth[priority] >= self.queue_limits.get(priority, 0)
+
+    def _enqueue(self, priority: str, key: str, loop=None) -> Optional[_Waiter]:
+        """Admit immediately (returns None) or queue a waiter; raises if the queue is full"""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown LLM priority '{priority}'")
+
+        with self._lock:
+            metrics = self._metrics[priority]
+            if self.in_flight < self.max_concurrent and not any(self._depth.values()):
+                self.in_flight += 1
+                self._record_wait(metrics, 0.0)
+                return None
+
+            if self._depth[priority] >= self.queue_limits.get(priority, 0):
+                metrics['rejected'] += 1
+                raise LLMQueueFullError(f"AI service is busy ({self._depth[priority]} {priority} requests waiting)")
+
+            waiter = _Waiter(priority, key, loop)
+            self._queues[priority].setdefault(key, deque()).append(waiter)
+            self._depth[priority] += 1
+            return waiter
+
+    def _abandon(self, waiter: _Waiter):
+        """Give up on a waiter that timed out, unless it was granted a slot in the meantime"""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._remove(waiter)
+            self._metrics[waiter.priority]['timed_out'] += 1
+        raise LLMQueueTimeoutError(f"AI service is busy; gave up after waiting {self.timeout:.0f}s")
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues[waiter.priority]
+        waiters = queue.get(waiter.key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self._depth[waiter.priority] -= 1
+            if not waiters:
+                del queue[waiter.key]
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._grant_next()
+
+    def _grant_next(self):
+        while self.in_flight < self.max_concurrent:
+            waiter = self._pop_next()
+            if waiter is None:
+                return
+            waiter.granted = True
+            self.in_flight += 1
+            self._record_wait(self._metrics[waiter.priority], time.monotonic() - waiter.enqueued_at)
+            waiter.wake()
+
+    def _pop_next(self) -> Optional[_Waiter]:
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if not queue:
+                continue
+            # Round-robin between keys: serve the first key, then send it to the back
+            key, waiters = next(iter(queue.items()))
+            waiter = waiters.popleft()
+            del queue[key]
+            if waiters:
+                queue[key] = waiters
+            self._depth[priority] -= 1
+            return waiter
+        return None
+
+    @staticmethod
+    def _record_wait(metrics: Dict[str, Any], waited: float):
+        metrics['admitted'] += 1
+        metrics['total_wait'] += waited
+        metrics['max_wait'] = max(metrics['max_wait'], waited)
+        metrics['recent_waits'].append(waited)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and wait-time metrics per priority class"""
+        with self._lock:
+            classes = {}
+            for priority in PRIORITIES:
+                metrics = self._metrics[priority]
+                waits = sorted(metrics['recent_waits'])
+                classes[priority] = {
+                    'waiting': self._depth[priority],
+                    'admitted': metrics['admitted'],
+                    'rejected': metrics['rejected'],
+                    'timed_out': metrics['timed_out'],
+                    'avg_wait_seconds': round(metrics['total_wait'] / metrics['admitted'], 3) if metrics['admitted'] else 0.0,
+                    'p95_wait_seconds': round(waits[int(len(waits) * 0.95)] if len(waits) > 1 else sum(waits), 3),
+                    'max_wait_seconds': round(metrics['max_wait'], 3),
+                }
+            return {'in_flight': self.in_flight, 'max_concurrent': self.max_concurrent, 'classes': classes}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """Return the scheduler shared by every LLM call in this process"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler()
+    return _scheduler
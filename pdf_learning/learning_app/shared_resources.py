@@ -0,0 +1,106 @@
+import sys
+import threading
+from typing import Dict, Any
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import chromadb
+from sentence_transformers import CrossEncoder, SentenceTransformer
+from django.conf import settings
+
+# Process-wide handles shared by every AIService instance. Each worker process
+# loads the embedding model and opens the vector store exactly once.
+_lock = threading.Lock()
+_embedding_model = None
+_chroma_client = None
+_cross_encoder = None
+_loader = None  # Thread loading the embedding model in the background
+_loader_lock = threading.Lock()
+
+
+def get_embedding_model() -> SentenceTransformer:
+    """Return the shared embedding model, loading it on first use"""
+    global _embedding_model
+    if _embedding_model is None:
+        with _lock:
+            if _embedding_model is None:
+                print(f"Loading embedding model '{settings.EMBEDDING_MODEL_NAME}'")
+                _embedding_model = SentenceTransformer(settings.EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+
+def load_embedding_model_in_background():
+    """Start loading the embedding model on a daemon thread, unless it is loaded or already loading"""
+    global _loader
+    if _embedding_model is not None:
+        return
+    with _loader_lock:
+        if _loader is None or not _loader.is_alive():
+            _loader = threading.Thread(target=_load_embedding_model, name='embedding-model-loader', daemon=True)
+            _loader.start()
+
+
+def _load_embedding_model():
+    try:
+        get_embedding_model()
+    except Exception as e:
+        # The next request that falls back to keyword search tries again
+        print(f"Background load of the embedding model failed: {e}")
+
+
+def get_chroma_client():
+    """Return the shared ChromaDB client, opening it on first use"""
+    global _chroma_client
+    if _chroma_client is None:
+        with _lock:
+            if _chroma_client is None:
+                _chroma_client = chromadb.PersistentClient(path=str(settings.CHROMA_DB_PATH))
+    return _chroma_client
+
+
+def get_cross_encoder() -> CrossEncoder:
+    """Return the shared reranking cross-encoder, loading it on first use"""
+    global _cross_encoder
+    if _cross_encoder is None:
+        with _lock:
+            if _cross_encoder is None:
+                print(f"Loading cross-encoder '{settings.RERANK_CROSS_ENCODER_MODEL}'")
+                _cross_encoder = CrossEncoder(settings.RERANK_CROSS_ENCODER_MODEL)
+    return _cross_encoder
+
+
+def is_embedding_model_loaded() -> bool:
+    """Check whether the embedding model is already resident in this process"""
+    return _embedding_model is not None
+
+
+def warm_up():
+    """Load the embedding model and open the vector store ahead of the first request"""
+    get_embedding_model()
+    get_chroma_client()
+
+
+def memory_footprint() -> Dict[str, Any]:
+    """Report how much memory the shared resources use in this process"""
+    parameter_bytes = 0
+    if _embedding_model is not None:
+        parameter_bytes = sum(
+            p.numel() * p.element_size() for p in _embedding_model.parameters()
+        )
+
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    max_rss = 0
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            max_rss *= 1024
+
+    return {
+        'embedding_model_loaded': _embedding_model is not None,
+        'chroma_client_open': _chroma_client is not None,
+        'embedding_model_mb': round(parameter_bytes / (1024 * 1024), 1),
+        'process_peak_rss_mb': round(max_rss / (1024 * 1024), 1),
+    }
@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import caches
+from .lexical_index import get_lexical_index
+from .models import PDFDocument
+
+
+@receiver(post_delete, sender=PDFDocument)
+def forget_cached_retrieval(sender, instance, **kwargs):
+    """Drop cached retrieval results when a document is deleted"""
+    caches.invalidate_document(instance.collection_id)
+
+
+@receiver(post_delete, sender=PDFDocument)
+def drop_keyword_index(sender, instance, **kwargs):
+    """Remove a deleted document's keyword index rows once no other document shares its collection"""
+    collection_id = instance.collection_id
+    content_hash = instance.content_hash
+
+    def drop():
+        lexical = get_lexical_index()
+        if lexical is None:
+            return
+        # Identical uploads share one collection
+        if content_hash and PDFDocument.objects.filter(content_hash=content_hash).exists():
+            return
+        lexical.delete_collection(collection_id)
+
+    transaction.on_commit(drop)
@@ -1,3 +1,1694 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import caches, jobs, lexical_index, shared_resources
+from .ai_service import AIService
+from .chunker import TextChunk, TokenChunker, split_sentences, whitespace_token_counter
+from .dedup import SemanticDeduplicator
+from .embedding_cache import EmbeddingCache
+from .health import check_llm_health
+from .llm_client import (AsyncOllamaClient, CircuitBreaker, LLMUnavailableError, OllamaClient,
+                         get_async_llm_client)
+from .models import BackgroundJob, BankQuestion, ChatMessage, PDFDocument, Question, QuizSession
+from .pdf_processor import PDFProcessor
+from .question_bank import fill_bank
+from .reranker import mmr_order, trim_to_budget
+from .response_cache import DjangoCacheBackend, ResponseCache, SQLiteBackend, get_response_cache
+from .scheduler import BACKGROUND, INTERACTIVE, QUIZ, LLMQueueFullError, LLMQueueTimeoutError, LLMScheduler
+
+
+class SharedResourcesTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(shared_resources, _embedding_model=None, _chroma_client=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_model_loaded_once_and_lazily(self):
+        with mock.patch.object(shared_resources, 'SentenceTransformer') as model_cls:
+            first, second = AIService(), AIService()
+            model_cls.assert_not_called()
+
+            self.assertIs(first.embedding_model, second.embedding_model)
+            model_cls.assert_called_once()
+
+    def test_memory_footprint_before_loading(self):
+        footprint = shared_resources.memory_footprint()
+        self.assertFalse(footprint['embedding_model_loaded'])
+        self.assertEqual(footprint['embedding_model_mb'], 0)
+
+
+class BackgroundIngestionTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, BACKGROUND_WORKERS=0, QUESTION_BANK_SIZE=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self):
+        pdf_file = SimpleUploadedFile('notes.pdf', b'%PDF-1.4 test', content_type='application/pdf')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_pdf'), {'title': 'Notes', 'pdf_file': pdf_file})
+        return PDFDocument.objects.get(title='Notes')
+
+    @mock.patch.object(AIService, 'add_chunk_stream', side_effect=lambda doc_id, chunks, on_batch: {'chunks': len(list(chunks))})
+    @mock.patch('learning_app.chunker.embedding_token_counter', whitespace_token_counter)
+    @mock.patch('learning_app.ingestion.PDFProcessor.count_pages', return_value=1)
+    @mock.patch('learning_app.ingestion.PDFProcessor.iter_pages', return_value=iter([(1, 'Some text.')]))
+    def test_upload_queues_ingestion_and_reports_progress(self, iter_pages, count_pages, add_chunks):
+        document = self.upload()
+
+        self.assertTrue(document.processed)
+        self.assertEqual(document.stage, 'done')
+        self.assertEqual(document.chunks_embedded, 1)
+        self.assertEqual(BackgroundJob.objects.get().status, 'done')
+
+        status = self.client.get(reverse('document_status', args=[document.id])).json()
+        self.assertEqual(status['stage'], 'done')
+        self.assertEqual(status['pages_extracted'], 1)
+
+    def test_identical_upload_reuses_processed_document(self):
+        original = PDFDocument.objects.create(
+            title='Original', content_hash=hashlib.sha256(b'%PDF-1.4 test').hexdigest(),
+            processed=True, stage='done', total_pages=12, chunks_embedded=40
+        )
+        document = self.upload()
+
+        self.assertTrue(document.processed)
+        self.assertEqual(document.total_pages, 12)
+        self.assertEqual(document.collection_id, original.collection_id)
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    @mock.patch('learning_app.ingestion.PDFProcessor.count_pages',
+                side_effect=Exception('Error processing PDF: broken file'))
+    def test_failed_ingestion_is_recorded(self, count_pages):
+        document = self.upload()
+
+        self.assertFalse(document.processed)
+        self.assertEqual(document.stage, 'failed')
+        self.assertIn('broken file', document.error)
+        self.assertEqual(BackgroundJob.objects.get().status, 'failed')
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(jobs._executors, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(BACKGROUND_WORKERS=1, QUIZ_WORKERS=1)
+    def test_quiz_job_does_not_wait_behind_bank_filling(self):
+        started = []
+        release = threading.Event()
+
+        def run_job(job_id):
+            started.append(job_id)
+            if job_id == 1:
+                release.wait(5)
+
+        with mock.patch('learning_app.jobs.run_job', side_effect=run_job):
+            jobs.submit(1, 'fill_bank')
+            jobs.submit(2, 'fill_bank')
+            jobs.submit(3, 'generate_quiz')
+            jobs.get_executor(jobs.QUIZ_POOL).submit(lambda: None).result(5)
+            self.assertEqual(started, [1, 3])
+
+            release.set()
+            jobs.get_executor(jobs.BACKGROUND_POOL).submit(lambda: None).result(5)
+        self.assertEqual(started, [1, 3, 2])
+
+    def test_process_jobs_runs_quiz_jobs_first(self):
+        ran = []
+        handlers = {kind: (lambda job: ran.append(job.kind)) for kind in ('fill_bank', 'generate_quiz')}
+        BackgroundJob.objects.create(kind='fill_bank')
+        BackgroundJob.objects.create(kind='generate_quiz')
+
+        with mock.patch.dict(jobs._handlers, handlers):
+            self.assertEqual(jobs.run_pending(), 2)
+
+        self.assertEqual(ran, ['generate_quiz', 'fill_bank'])
+
+    def make_running_job(self, heartbeat_age, kind='fill_bank', running_for=timedelta(hours=2)):
+        now = timezone.now()
+        return BackgroundJob.objects.create(kind=kind, status='running', started_at=now - running_for,
+                                            heartbeat_at=now - heartbeat_age)
+
+    @override_settings(BACKGROUND_JOB_TIMEOUT=120)
+    def test_process_jobs_requeues_jobs_interrupted_by_a_crash(self):
+        stale = self.make_running_job(timedelta(minutes=5))
+        # Long-running, but its process is still sending heartbeats
+        live = self.make_running_job(timedelta(seconds=10))
+
+        with mock.patch.dict(jobs._handlers, {'fill_bank': lambda job: None}):
+            call_command('process_jobs', stdout=StringIO())
+
+        stale.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual(stale.status, 'done')
+        self.assertEqual(live.status, 'running')
+
+    @override_settings(BACKGROUND_JOB_TIMEOUT=120, BACKGROUND_JOB_TIMEOUTS={'generate_quiz': 30})
+    def test_quiz_jobs_are_recovered_on_a_shorter_timeout(self):
+        quiz = self.make_running_job(timedelta(minutes=1), kind='generate_quiz')
+        fill = self.make_running_job(timedelta(minutes=1))
+
+        self.assertEqual(jobs.recover_stale_jobs(), [(quiz.id, 'generate_quiz')])
+        fill.refresh_from_db()
+        self.assertEqual(fill.status, 'running')
+
+    def test_running_jobs_send_heartbeats(self):
+        job = self.make_running_job(timedelta(minutes=5))
+        other = self.make_running_job(timedelta(minutes=5))
+
+        with mock.patch.object(jobs, '_running_jobs', {job.id}):
+            self.assertEqual(jobs.send_heartbeats(), 1)
+
+        job.refresh_from_db()
+        other.refresh_from_db()
+        self.assertLess(timezone.now() - job.heartbeat_at, timedelta(seconds=5))
+        self.assertGreater(timezone.now() - other.heartbeat_at, timedelta(minutes=4))
+
+    @override_settings(BACKGROUND_JOB_TIMEOUT=120, BACKGROUND_JOB_HEARTBEAT=15, BACKGROUND_WORKERS=0)
+    def test_requests_resume_interrupted_jobs(self):
+        request_started.connect(jobs.resume_interrupted_jobs)
+        self.addCleanup(request_started.disconnect, jobs.resume_interrupted_jobs)
+        stale = self.make_running_job(timedelta(minutes=5))
+        ran = []
+
+        def crash_again():
+            BackgroundJob.objects.filter(id=stale.id).update(status='running',
+                                                             heartbeat_at=timezone.now() - timedelta(minutes=5))
+
+        with mock.patch.dict(jobs._handlers, {'fill_bank': lambda job: ran.append(job.id)}), \
+                mock.patch.object(jobs, '_last_recovery', None):
+            self.client.get(reverse('home'))
+            # Recovery runs at most once per heartbeat interval, not on every request
+            crash_again()
+            self.client.get(reverse('home'))
+            self.assertEqual(ran, [stale.id])
+
+            jobs._last_recovery -= 20
+            self.client.get(reverse('home'))
+
+        self.assertEqual(ran, [stale.id, stale.id])
+
+
+def make_pdf(page_texts):
+    """Build a minimal PDF with one line of Helvetica text per page"""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in page_texts:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'.encode()
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>'.encode())
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'.encode()
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(output)
+
+
+class PDFExtractionTests(TestCase):
+    def setUp(self):
+        handle, self.pdf_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(handle, 'wb') as pdf_file:
+            pdf_file.write(make_pdf([f'Page {n} text' for n in range(1, 7)]))
+        self.addCleanup(os.remove, self.pdf_path)
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2, PDF_PARALLEL_MIN_PAGES=4)
+    def test_parallel_extraction_keeps_page_order(self):
+        pages = list(PDFProcessor().iter_pages(self.pdf_path))
+        self.assertEqual(pages, [(n, f'Page {n} text') for n in range(1, 7)])
+
+    @override_settings(PDF_PARALLEL_MIN_PAGES=100)
+    def test_small_files_are_extracted_serially(self):
+        with mock.patch('learning_app.pdf_processor.ProcessPoolExecutor') as pool:
+            pages = list(PDFProcessor().iter_pages(self.pdf_path))
+        pool.assert_not_called()
+        self.assertEqual(len(pages), 6)
+
+    def test_chunk_pages_keeps_page_numbers(self):
+        chunker = TokenChunker(max_tokens=50, overlap_tokens=0, span_pages=False,
+                               token_counter=whitespace_token_counter)
+        pages = [(1, 'Intro text.'), (2, '   '), (3, '--- Page 9 --- is just text here.')]
+        chunks = PDFProcessor().chunk_pages(pages, chunker)
+        self.assertEqual([(chunk.text, chunk.page) for chunk in chunks], [
+            ('Intro text.', 1),
+            ('--- Page 9 --- is just text here.', 3),
+        ])
+
+
+class TokenChunkerTests(TestCase):
+    def chunker(self, **kwargs):
+        options = {'max_tokens': 10, 'overlap_tokens': 4, 'span_pages': False,
+                   'token_counter': whitespace_token_counter}
+        options.update(kwargs)
+        return TokenChunker(**options)
+
+    def test_chunks_respect_token_limit_and_overlap(self):
+        text = 'One two three. Four five six. Seven eight nine. Ten eleven twelve.'
+        chunks = list(self.chunker().chunk_pages([(1, text)]))
+
+        self.assertEqual([chunk.text for chunk in chunks], [
+            'One two three. Four five six. Seven eight nine.',
+            'Seven eight nine. Ten eleven twelve.',
+        ])
+        self.assertTrue(all(chunk.tokens <= 10 for chunk in chunks))
+
+    def test_chunks_can_span_pages(self):
+        pages = [(1, 'Alpha beta.'), (2, 'Gamma delta.')]
+
+        per_page = list(self.chunker().chunk_pages(pages))
+        spanning = list(self.chunker(span_pages=True).chunk_pages(pages))
+
+        self.assertEqual([(c.page, c.page_end) for c in per_page], [(1, 1), (2, 2)])
+        self.assertEqual([(c.text, c.page, c.page_end) for c in spanning], [('Alpha beta. Gamma delta.', 1, 2)])
+
+    def test_long_sentences_are_split(self):
+        text = ' '.join(f'w{i}' for i in range(25)) + '.'
+        chunks = list(self.chunker(overlap_tokens=0).chunk_pages([(1, text)]))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(chunk.tokens <= 10 for chunk in chunks))
+
+    def test_sentences_end_at_punctuation_followed_by_whitespace(self):
+        text = '  See section 3.2 first!  Really?\nYes... .\nDone'
+
+        self.assertEqual(split_sentences(text), ['See section 3.2 first!', 'Really?', 'Yes...', '.', 'Done'])
+
+    def test_overlap_carries_across_pages(self):
+        pages = [(1, 'One two three. Four five six. Seven eight.'), (2, 'Nine ten eleven. Twelve.')]
+        chunks = list(self.chunker(span_pages=True).chunk_pages(pages))
+
+        self.assertEqual([(c.text, c.page, c.page_end, c.tokens) for c in chunks], [
+            ('One two three. Four five six. Seven eight.', 1, 1, 8),
+            ('Seven eight. Nine ten eleven. Twelve.', 1, 2, 6),
+        ])
+
+
+@override_settings(EMBEDDING_CACHE_MAX_MB=0)
+class ChunkStreamTests(TestCase):
+    def setUp(self):
+        use_temp_lexical_index(self)
+
+    def test_chunks_are_embedded_and_written_in_batches(self):
+        model = mock.Mock()
+        model.encode.side_effect = lambda texts, **kwargs: np.zeros((len(texts), 4), dtype=np.float64)
+        collection = mock.MagicMock()
+        collection.get.return_value = {'ids': []}
+        client = mock.Mock()
+        client.get_max_batch_size.return_value = 2
+        client.create_collection.return_value = collection
+
+        chunks = (TextChunk(f'chunk {i}', page=i + 1, page_end=i + 1, tokens=2) for i in range(5))
+        progress = []
+        with mock.patch.multiple(shared_resources, _embedding_model=model, _chroma_client=client):
+            stats = AIService().add_chunk_stream('doc', chunks, batch_size=10, on_batch=progress.append)
+
+        self.assertEqual(stats['chunks'], 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(collection.upsert.call_count, 3)
+        last_call = collection.upsert.call_args.kwargs
+        self.assertEqual(last_call['ids'], ['chunk_4'])
+        self.assertEqual(last_call['embeddings'].dtype, np.float32)
+        self.assertEqual(last_call['metadatas'], [{'page': 5, 'page_end': 5, 'chunk_id': 4}])
+
+
+class EmbeddingCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'cache.sqlite3')
+
+    def test_round_trip(self):
+        cache = EmbeddingCache(self.path, max_bytes=1024 * 1024, model_name='test')
+        cache.put_many(['alpha'], np.array([[1.0, 2.0]]))
+
+        alpha, beta = cache.get_many(['alpha', 'beta'])
+        np.testing.assert_array_equal(alpha, np.array([1.0, 2.0], dtype=np.float32))
+        self.assertIsNone(beta)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        # Each 4-dim float32 vector is 16 bytes; room for two of them
+        cache = EmbeddingCache(self.path, max_bytes=40, model_name='test')
+        with mock.patch('learning_app.embedding_cache.time.time', side_effect=[1.0, 2.0, 3.0, 4.0]):
+            cache.put_many(['old'], np.ones((1, 4)))
+            cache.put_many(['recent'], np.ones((1, 4)))
+            cache.get_many(['old'])  # Touch 'old' so 'recent' is now the eviction candidate
+            cache.put_many(['new'], np.ones((1, 4)))
+
+        old, recent, new = cache.get_many(['old', 'recent', 'new'])
+        self.assertIsNotNone(old)
+        self.assertIsNone(recent)
+        self.assertIsNotNone(new)
+
+
+class FakeEmbeddingModel:
+    """Deterministic bag-of-words embeddings so retrieval can be tested without a model download"""
+
+    dimensions = 64
+
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().replace('.', ' ').replace('?', ' ').split():
+                vectors[row, int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dimensions] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+
+def use_fake_embeddings(test_case):
+    """Swap the shared embedding model for FakeEmbeddingModel for the duration of a test"""
+    patcher = mock.patch.object(shared_resources, '_embedding_model', FakeEmbeddingModel())
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
+def use_temp_lexical_index(test_case):
+    """Point the shared lexical index at a throwaway database for the duration of a test"""
+    directory = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, directory, True)
+    patcher = mock.patch.object(lexical_index, '_index', lexical_index.LexicalIndex(os.path.join(directory, 'lexical.sqlite3')))
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
+class StubOllama:
+    """Local HTTP server mimicking Ollama's /api/generate endpoint.
+
+    responder(request_json) returns the generated text for each call.
+    """
+
+    def __init__(self, responder, delay=0.0):
+        self.responder = responder
+        self.delay = delay
+        self.requests = []
+        self.status_codes = []  # Status to send for the next calls; 200 once exhausted
+        self.listings = {}  # GET path -> JSON body, for /api/tags and /api/ps
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    stub.requests.append(body)
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                    call_number = len(stub.requests)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.active -= 1
+                    status = stub.status_codes.pop(0) if stub.status_codes else 200
+                if status != 200:
+                    self.send_response(status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                text = stub.responder(body, call_number)
+                if body.get('stream'):
+                    # NDJSON: one object per word, then a final done marker
+                    lines = [{'response': word, 'done': False} for word in text.split(' ')[:-1]]
+                    lines = [dict(line, response=line['response'] + ' ') for line in lines]
+                    lines.append({'response': text.split(' ')[-1], 'done': False})
+                    lines.append({'response': '', 'done': True, 'eval_count': len(lines)})
+                    payload = ''.join(json.dumps(line) + '\n' for line in lines).encode()
+                else:
+                    payload = json.dumps({'response': text, 'done': True, 'eval_count': len(text.split())}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests.append({'path': self.path})
+                payload = json.dumps(stub.listings.get(self.path, {'models': []})).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def mcq_response(question_text):
+    return (f"QUESTION: {question_text}\nA) One\nB) Two\nC) Three\nD) Four\n"
+            f"ANSWER: B\nEXPLANATION: Because.")
+
+
+@override_settings(MCQ_QUESTIONS_PER_CALL=1)
+class ConcurrentGenerationTests(TestCase):
+    def setUp(self):
+        use_fake_embeddings(self)
+
+    def start_stub(self, responder, delay=0.05):
+        stub = StubOllama(responder, delay=delay)
+        self.addCleanup(stub.close)
+        return stub, AIService(llm_client=OllamaClient(base_url=stub.url))
+
+    @override_settings(MCQ_MAX_IN_FLIGHT=3)
+    def test_requests_run_concurrently_up_to_the_limit(self):
+        texts = ['Which gas do plants absorb?', 'Where is ATP produced?', 'How does water cross membranes?',
+                 'What do enzymes lower?', 'Which organelle builds proteins?', 'Why do cells divide?']
+        stub, ai_service = self.start_stub(lambda body, n: mcq_response(texts[n - 1]))
+
+        questions = ai_service.generate_questions_from_chunks(['context'], num_questions=5)
+
+        self.assertEqual(len(questions), 5)
+        self.assertEqual(stub.max_active, 3)
+        self.assertEqual(len(stub.requests), 5)
+
+    @override_settings(MCQ_MAX_IN_FLIGHT=2)
+    def test_duplicates_and_invalid_responses_are_retried(self):
+        replies = ['not a question', mcq_response('What does the heart pump?'),
+                   mcq_response('What does the heart pump?'), mcq_response('Where is bile made?')]
+        stub, ai_service = self.start_stub(lambda body, n: replies[min(n, len(replies)) - 1], delay=0)
+
+        questions = ai_service.generate_questions_from_chunks(['context'], num_questions=2)
+
+        self.assertEqual([q['question_text'] for q in questions],
+                         ['What does the heart pump?', 'Where is bile made?'])
+
+
+def batch_item(question_text, answer='A'):
+    return {'question': question_text, 'options': {'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'},
+            'answer': answer, 'explanation': 'Because.'}
+
+
+class BatchGenerationTests(TestCase):
+    def setUp(self):
+        use_fake_embeddings(self)
+
+    def test_malformed_items_are_dropped_individually(self):
+        response = json.dumps({'questions': [
+            batch_item('Which gas do plants absorb?'),
+            {'question': 'Missing options', 'answer': 'A'},
+            batch_item('Where is ATP produced?', answer='c'),
+        ]})
+
+        questions = AIService().parse_mcq_batch(response)
+
+        self.assertEqual([(q['question_text'], q['correct_answer']) for q in questions],
+                         [('Which gas do plants absorb?', 'A'), ('Where is ATP produced?', 'C')])
+
+    def test_truncated_json_is_salvaged(self):
+        response = json.dumps({'questions': [batch_item('Which gas do plants absorb?'),
+                                             batch_item('Where is ATP produced?')]})
+        truncated = response[:-40]
+
+        questions = AIService().parse_mcq_batch(truncated)
+
+        self.assertEqual([q['question_text'] for q in questions], ['Which gas do plants absorb?'])
+
+    @override_settings(MCQ_MAX_IN_FLIGHT=1, MCQ_QUESTIONS_PER_CALL=3)
+    def test_batches_fall_back_to_single_questions(self):
+        def responder(body, call_number):
+            if body.get('format') == 'json':
+                if call_number == 1:
+                    return json.dumps({'questions': [batch_item('Which gas do plants absorb?'),
+                                                     batch_item('Where is ATP produced?')]})
+                return 'not json at all'
+            return mcq_response('Why do cells divide?')
+
+        stub = StubOllama(responder)
+        self.addCleanup(stub.close)
+        ai_service = AIService(llm_client=OllamaClient(base_url=stub.url))
+
+        questions = ai_service.generate_questions_from_chunks(['first chunk', 'second chunk'], num_questions=3)
+
+        self.assertEqual([q['question_text'] for q in questions],
+                         ['Which gas do plants absorb?', 'Where is ATP produced?', 'Why do cells divide?'])
+        self.assertEqual([body.get('format') for body in stub.requests], ['json', 'json', None])
+
+
+class StreamingChatTests(TestCase):
+    def setUp(self):
+        self.stub = StubOllama(lambda body, n: 'Chapter three covers osmosis.')
+        self.addCleanup(self.stub.close)
+        self.document = PDFDocument.objects.create(title='Biology', processed=True, stage='done')
+        get_response_cache().clear()
+
+    def test_stream_gemma_yields_fragments(self):
+        ai_service = AIService(llm_client=OllamaClient(base_url=self.stub.url))
+
+        fragments = list(ai_service.stream_gemma('prompt'))
+
+        self.assertEqual(fragments, ['Chapter ', 'three ', 'covers ', 'osmosis.'])
+
+    def test_chat_stream_sends_events_and_saves_message(self):
+        def answer_stream(self, document_id, question):
+            return self.stream_gemma(question)
+
+        with mock.patch('learning_app.ai_service.get_llm_client', return_value=OllamaClient(base_url=self.stub.url)), \
+                mock.patch.object(AIService, 'answer_question_stream', answer_stream):
+            response = self.client.post(reverse('chat_stream_api', args=[self.document.id]),
+                                        data=json.dumps({'message': 'What is chapter 3 about?'}),
+                                        content_type='application/json')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertFalse(ChatMessage.objects.exists())
+            body = b''.join(response.streaming_content).decode()
+
+        self.assertIn('data: {"token": "Chapter "}', body)
+        self.assertIn('event: done', body)
+        message = ChatMessage.objects.get()
+        self.assertEqual(message.response, 'Chapter three covers osmosis.')
+
+    async def test_astream_gemma_yields_fragments(self):
+        ai_service = AIService(async_llm_client=AsyncOllamaClient(base_url=self.stub.url))
+
+        fragments = [fragment async for fragment in ai_service.astream_gemma('prompt')]
+
+        self.assertEqual(fragments, ['Chapter ', 'three ', 'covers ', 'osmosis.'])
+
+    async def test_async_chat_stream_sends_tokens_before_the_answer_is_complete(self):
+        release = asyncio.Event()
+
+        async def answer_stream(self, document_id, question):
+            yield 'Chapter three '
+            await release.wait()
+            yield 'covers osmosis.'
+
+        with mock.patch.object(AIService, 'aanswer_question_stream', answer_stream):
+            response = await self.async_client.post(reverse('chat_stream_api', args=[self.document.id]),
+                                                    {'message': 'What is chapter 3 about?'},
+                                                    content_type='application/json')
+            self.assertTrue(response.is_async)
+            events = aiter(response.streaming_content)
+            # A buffered response would wait for the whole answer and time out here
+            first = await asyncio.wait_for(anext(events), 5)
+            self.assertIn(b'"token": "Chapter three "', first)
+            self.assertFalse(await ChatMessage.objects.aexists())
+
+            release.set()
+            body = first + b''.join([event async for event in events])
+
+        self.assertIn(b'event: done', body)
+        message = await ChatMessage.objects.aget()
+        self.assertEqual(message.response, 'Chapter three covers osmosis.')
+
+
+@override_settings(OLLAMA_RETRY_BACKOFF=0)
+class OllamaClientTests(TestCase):
+    def setUp(self):
+        self.stub = StubOllama(lambda body, n: 'OK')
+        self.addCleanup(self.stub.close)
+
+    def test_transient_errors_are_retried(self):
+        self.stub.status_codes = [503, 502]
+        client = OllamaClient(base_url=self.stub.url)
+
+        self.assertEqual(client.generate('hi')['response'], 'OK')
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_open_circuit_fails_fast(self):
+        self.stub.status_codes = [503] * 3
+        client = OllamaClient(base_url=self.stub.url, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+
+        with self.assertRaises(LLMUnavailableError):
+            client.generate('hi')
+        with self.assertRaisesMessage(LLMUnavailableError, 'circuit open'):
+            client.generate('hi')
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_half_open_circuit_closes_after_success(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'half-open')
+
+        client = OllamaClient(base_url=self.stub.url, breaker=breaker)
+        client.generate('hi')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_unexpected_error_during_trial_does_not_wedge_the_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        client = OllamaClient(base_url=self.stub.url, breaker=breaker)
+
+        with mock.patch.object(client.session, 'request', side_effect=RuntimeError('unexpected')):
+            with self.assertRaises(RuntimeError):
+                client.generate('hi')
+
+        self.assertFalse(breaker.trial_in_progress)
+        self.assertEqual(client.generate('hi')['response'], 'OK')
+        self.assertEqual(breaker.state, 'closed')
+
+    async def test_cancelled_trial_counts_as_a_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        client = AsyncOllamaClient(base_url=self.stub.url, breaker=breaker)
+        self.stub.delay = 1
+
+        task = asyncio.ensure_future(client.generate('hi'))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertFalse(breaker.trial_in_progress)
+        self.assertEqual(breaker.failures, 2)
+        await client.aclose()
+
+    @override_settings(MCQ_QUESTIONS_PER_CALL=1, MCQ_MAX_IN_FLIGHT=1, OLLAMA_MAX_RETRIES=0)
+    def test_generation_stops_when_backend_is_down(self):
+        self.stub.status_codes = [503] * 20
+        ai_service = AIService(llm_client=OllamaClient(base_url=self.stub.url))
+
+        self.assertEqual(ai_service.generate_questions_from_chunks(['context'], num_questions=5), [])
+        self.assertEqual(len(self.stub.requests), 1)
+
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE, OLLAMA_MODEL='gemma2:2b', OLLAMA_KEEP_ALIVE='30m')
+class HealthCheckTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stub = StubOllama(lambda body, n: '')
+        self.addCleanup(self.stub.close)
+        self.client_ = OllamaClient(base_url=self.stub.url)
+
+    def test_healthy_backend_is_probed_once_and_cached(self):
+        self.stub.listings = {'/api/tags': {'models': [{'name': 'gemma2:2b'}]},
+                              '/api/ps': {'models': [{'name': 'gemma2:2b'}]}}
+
+        first = check_llm_health(client=self.client_)
+        second = check_llm_health(client=self.client_)
+
+        self.assertTrue(first['ok'] and first['model_loaded'])
+        self.assertEqual(first, second)
+        self.assertEqual([r['path'] for r in self.stub.requests], ['/api/tags', '/api/ps'])
+
+    def test_missing_model_is_reported(self):
+        self.stub.listings = {'/api/tags': {'models': [{'name': 'llama3:8b'}]}}
+
+        result = check_llm_health(client=self.client_)
+
+        self.assertFalse(result['ok'])
+        self.assertTrue(result['server_up'])
+        self.assertIn('ollama pull gemma2:2b', result['error'])
+
+    def test_unloaded_model_is_preloaded(self):
+        self.stub.listings = {'/api/tags': {'models': [{'name': 'gemma2:2b'}]}}
+
+        with mock.patch('learning_app.health.preload_model') as preload:
+            self.assertTrue(check_llm_health(client=self.client_)['ok'])
+        preload.assert_called_once_with(self.client_)
+
+    def test_health_endpoint_reports_unreachable_backend(self):
+        with mock.patch('learning_app.health.get_async_llm_client',
+                        return_value=AsyncOllamaClient(base_url='http://127.0.0.1:9')):
+            response = self.client.get(reverse('health'))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()['llm']['server_up'])
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        use_fake_embeddings(self)
+        self.stub = StubOllama(lambda body, n: mcq_response(f'Question number {n}?'))
+        self.addCleanup(self.stub.close)
+        self.ai_service = AIService(llm_client=OllamaClient(base_url=self.stub.url))
+        self.cache = get_response_cache()
+        self.cache.clear()
+
+    def test_identical_prompts_are_answered_from_the_cache(self):
+        first = self.ai_service.call_gemma('What is chapter 3 about?', max_tokens=500)
+        second = self.ai_service.call_gemma('What is chapter 3 about?', max_tokens=500)
+        self.ai_service.call_gemma('What is chapter 3 about?', max_tokens=200)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.stub.requests), 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['tokens_saved'], len(first.split()))
+
+    def test_streamed_answers_are_cached_once_complete(self):
+        fragments = list(self.ai_service.stream_gemma('What is chapter 3 about?'))
+        cached = list(self.ai_service.stream_gemma('What is chapter 3 about?'))
+
+        self.assertEqual(cached, [''.join(fragments)])
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_question_generation_bypasses_the_cache(self):
+        first = self.ai_service.generate_single_mcq('Cells divide by mitosis.')
+        second = self.ai_service.generate_single_mcq('Cells divide by mitosis.')
+
+        self.assertNotEqual(first['question_text'], second['question_text'])
+        self.assertEqual(len(self.stub.requests), 2)
+
+    @override_settings(LLM_RESPONSE_CACHE_BACKEND='none')
+    def test_cache_can_be_disabled(self):
+        self.assertIsNone(get_response_cache())
+        self.ai_service.call_gemma('prompt')
+        self.ai_service.call_gemma('prompt')
+
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_sqlite_backend_expires_and_evicts_entries(self):
+        path = os.path.join(tempfile.mkdtemp(), 'responses.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        cache = ResponseCache(SQLiteBackend(path, max_entries=10, ttl=60))
+
+        for i in range(11):
+            cache.set(ResponseCache.key('model', f'prompt {i}'), f'answer {i}', tokens=5, seconds=2.0)
+
+        self.assertIsNone(cache.get(ResponseCache.key('model', 'prompt 0')))
+        self.assertEqual(cache.get(ResponseCache.key('model', 'prompt 10')), 'answer 10')
+        with mock.patch('learning_app.response_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get(ResponseCache.key('model', 'prompt 10')))
+        self.assertEqual(cache.stats()['seconds_saved'], 2.0)
+
+    def test_async_lookups_keep_disk_backends_off_the_event_loop(self):
+        path = os.path.join(tempfile.mkdtemp(), 'responses.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        backend = SQLiteBackend(path, max_entries=10, ttl=60)
+        cache = ResponseCache(backend)
+        key = ResponseCache.key('model', 'prompt')
+        threads = []
+
+        def record_thread(method):
+            def wrapper(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+            return wrapper
+
+        async def round_trip():
+            with mock.patch.object(backend, 'get', side_effect=record_thread(backend.get)), \
+                    mock.patch.object(backend, 'set', side_effect=record_thread(backend.set)):
+                await cache.aset(key, 'answer', tokens=2)
+                return await cache.aget(key), threading.current_thread()
+
+        cached, loop_thread = asyncio.run(round_trip())
+
+        self.assertEqual(cached, 'answer')
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+
+    @override_settings(CACHES={**LOCMEM_CACHE, 'llm_responses': LOCMEM_CACHE['default']})
+    def test_django_cache_backend_round_trips_entries(self):
+        cache = ResponseCache(DjangoCacheBackend('llm_responses', ttl=60))
+        key = ResponseCache.key('model', 'prompt', {'num_predict': 10}, 'json')
+
+        self.assertIsNone(cache.get(key))
+        cache.set(key, '{"questions": []}', tokens=3)
+
+        self.assertEqual(cache.get(key), '{"questions": []}')
+        self.assertEqual(cache.stats()['tokens_saved'], 3)
+        self.assertNotEqual(key, ResponseCache.key('model', 'prompt', {'num_predict': 10}))
+
+
+class VectorStoreTestCase(TestCase):
+    """Runs AIService against an in-memory Chroma client and the fake embedding model"""
+
+    def setUp(self):
+        import chromadb
+
+        self.chroma = chromadb.EphemeralClient()
+        use_fake_embeddings(self)
+        use_temp_lexical_index(self)
+        patcher = mock.patch.object(shared_resources, '_chroma_client', self.chroma)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(EMBEDDING_CACHE_MAX_MB=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        caches.query_embeddings.clear()
+        caches.retrieval_results.clear()
+        get_response_cache().clear()
+
+        self.document_id = uuid.uuid4().hex
+        self.addCleanup(self.drop_collection)
+        self.ai_service = AIService()
+
+    def drop_collection(self):
+        try:
+            self.chroma.delete_collection(f'doc_{self.document_id}')
+        except Exception:
+            pass
+
+    def add_pages(self, pages):
+        self.ai_service.add_text_chunks(self.document_id, [text for _, text in pages], [page for page, _ in pages])
+
+
+class ReingestTests(VectorStoreTestCase):
+    def test_reingest_with_fewer_chunks_drops_the_old_tail(self):
+        self.add_pages([(1, 'Alpha.'), (2, 'Beta.'), (3, 'Gamma.')])
+        self.add_pages([(1, 'Delta.')])
+
+        stored = self.chroma.get_collection(f'doc_{self.document_id}').get()
+        self.assertEqual((stored['ids'], stored['documents']), (['chunk_0'], ['Delta.']))
+        self.assertEqual(lexical_index.get_lexical_index().search(self.document_id, 'alpha beta gamma delta'),
+                         [{'id': 'chunk_0', 'text': 'Delta.', 'page': 1}])
+
+
+class PageRangeRetrievalTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(page, f'Page {page} discusses photosynthesis topic number {page}.') for page in range(1, 21)]
+                       + [(15, 'Mitochondria produce energy for the cell.')])
+
+    def test_without_range_searches_whole_document(self):
+        chunks = self.ai_service.retrieve_relevant_context(self.document_id, 'mitochondria energy', n_results=1)
+        self.assertEqual(chunks, ['Mitochondria produce energy for the cell.'])
+
+    def test_small_range_scans_only_its_chunks(self):
+        from chromadb.api.models.Collection import Collection
+
+        with mock.patch.object(Collection, 'query') as query:
+            chunks = self.ai_service.retrieve_relevant_context(
+                self.document_id, 'mitochondria energy', n_results=2, page_range='3-4', total_pages=20)
+
+        query.assert_not_called()
+        self.assertCountEqual(chunks, ['Page 3 discusses photosynthesis topic number 3.',
+                                       'Page 4 discusses photosynthesis topic number 4.'])
+
+    @override_settings(PAGE_RANGE_SCAN_MAX_PAGES=2)
+    def test_large_range_uses_filtered_search(self):
+        chunks = self.ai_service.retrieve_relevant_context(
+            self.document_id, 'mitochondria energy', n_results=3, page_range='10-16', total_pages=20)
+
+        self.assertEqual(chunks[0], 'Mitochondria produce energy for the cell.')
+        self.assertTrue(all('number 1' in chunk for chunk in chunks[1:]))
+
+
+class MultiQueryRetrievalTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.'),
+                        (2, 'Photosynthesis converts light into chemical energy.'),
+                        (3, 'The treaty ended the war in Europe.')])
+
+    def test_queries_share_one_encode_and_one_search(self):
+        from chromadb.api.models.Collection import Collection
+
+        model = shared_resources._embedding_model
+        original_query = Collection.query
+        with mock.patch.object(model, 'encode', wraps=model.encode) as encode, \
+                mock.patch.object(Collection, 'query', autospec=True,
+                                  side_effect=lambda *args, **kwargs: original_query(*args, **kwargs)) as query:
+            chunks = self.ai_service.retrieve_for_queries(
+                self.document_id, ['mitochondria energy', 'photosynthesis light energy'], n_results=2)
+
+        encode.assert_called_once()
+        query.assert_called_once()
+        # Both queries retrieve the two biology chunks; each appears once
+        self.assertCountEqual(chunks, ['Mitochondria produce energy for the cell.',
+                                       'Photosynthesis converts light into chemical energy.'])
+
+    def test_merge_keeps_best_distance_per_chunk(self):
+        results = {
+            'ids': [['a', 'b'], ['b', 'c']],
+            'documents': [['A', 'B'], ['B', 'C']],
+            'distances': [[0.4, 0.5], [0.1, 0.3]],
+        }
+        self.assertEqual(self.ai_service.merge_results(results), ['B', 'C', 'A'])
+
+    def test_limit_applies_after_merge(self):
+        chunks = self.ai_service.retrieve_for_queries(
+            self.document_id, ['war treaty', 'mitochondria'], n_results=3, limit=2)
+        self.assertEqual(len(chunks), 2)
+
+
+class LRUCacheTests(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = caches.LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_entries_expire_after_ttl(self):
+        cache = caches.LRUCache(max_entries=10, ttl=60)
+        with mock.patch('learning_app.caches.time.monotonic', return_value=1000):
+            cache.set('a', 1)
+        with mock.patch('learning_app.caches.time.monotonic', return_value=1061):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class RetrievalCacheTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.'),
+                        (2, 'The treaty ended the war in Europe.')])
+
+    def test_repeated_query_skips_encoding_and_search(self):
+        first = self.ai_service.retrieve_relevant_context(self.document_id, 'Mitochondria energy', n_results=1)
+        with mock.patch.object(shared_resources._embedding_model, 'encode') as encode:
+            second = self.ai_service.retrieve_relevant_context(self.document_id, '  mitochondria   ENERGY', n_results=1)
+
+        encode.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual(caches.retrieval_results.stats()['hits'], 1)
+
+    def test_only_uncached_queries_are_encoded(self):
+        self.ai_service.retrieve_relevant_context(self.document_id, 'mitochondria', n_results=1)
+        model = shared_resources._embedding_model
+        with mock.patch.object(model, 'encode', wraps=model.encode) as encode:
+            vectors = self.ai_service.embed_queries(['Mitochondria', 'treaty'])
+
+        encode.assert_called_once_with(['treaty'])
+        self.assertEqual(vectors.shape, (2, FakeEmbeddingModel.dimensions))
+
+    def test_deleting_document_invalidates_its_results(self):
+        document = PDFDocument.objects.create(title='Cells', file='pdfs/cells.pdf', content_hash=self.document_id)
+        self.ai_service.retrieve_relevant_context(document.collection_id, 'mitochondria', n_results=1)
+        self.assertEqual(caches.retrieval_results.stats()['entries'], 1)
+
+        document.delete()
+        self.assertEqual(caches.retrieval_results.stats()['entries'], 0)
+
+
+class RerankingTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.'),
+                        (2, 'Mitochondria produce energy for the cell, as noted.'),
+                        (3, 'Ribosomes build proteins for the cell.'),
+                        (4, 'The treaty ended the war in Europe.')])
+
+    def test_mmr_skips_candidates_redundant_with_earlier_picks(self):
+        candidates = [[1.0, 0.0, 0.0], [0.99, 0.1, 0.0], [0.6, 0.0, 0.8]]
+
+        self.assertEqual(mmr_order([1.0, 0.0, 0.0], candidates, 2, lambda_=1.0), [0, 1])
+        self.assertEqual(mmr_order([1.0, 0.0, 0.0], candidates, 2, lambda_=0.3), [0, 2])
+
+    def test_trim_to_budget_keeps_rank_order_and_the_top_chunk(self):
+        chunks = ['a' * 40, 'b' * 40, 'c' * 40]
+
+        self.assertEqual(trim_to_budget(chunks, 25), chunks[:2])
+        self.assertEqual(trim_to_budget(chunks, 5), chunks[:1])
+        self.assertEqual(trim_to_budget(chunks, 0), chunks)
+
+    def test_mmr_reranking_returns_top_k_distinct_chunks_and_caches_them(self):
+        chunks = self.ai_service.retrieve_reranked(self.document_id, 'mitochondria energy cell', top_k=2,
+                                                   candidates=4, method='mmr', token_budget=0)
+        with mock.patch('chromadb.api.models.Collection.Collection.query') as query:
+            again = self.ai_service.retrieve_reranked(self.document_id, 'Mitochondria energy cell', top_k=2,
+                                                      candidates=4, method='mmr', token_budget=0)
+
+        query.assert_not_called()
+        self.assertEqual(chunks, again)
+        self.assertEqual(len(chunks), 2)
+        self.assertIn('Mitochondria', chunks[0])
+
+    def test_cross_encoder_scores_decide_the_order(self):
+        encoder = mock.Mock()
+        encoder.predict.side_effect = lambda pairs: [1.0 if 'treaty' in text else 0.0 for _, text in pairs]
+        with mock.patch('learning_app.shared_resources.get_cross_encoder', return_value=encoder):
+            chunks = self.ai_service.retrieve_reranked(self.document_id, 'cell', top_k=1, candidates=4,
+                                                       method='cross_encoder', token_budget=0)
+
+        self.assertEqual(chunks, ['The treaty ended the war in Europe.'])
+        self.assertEqual(len(encoder.predict.call_args.args[0]), 4)
+
+    def test_benchmark_reports_recall_for_each_configuration(self):
+        out = StringIO()
+        call_command('benchmark_retrieval', methods='none,mmr', candidates='5,10', repeat=1, stdout=out)
+
+        rows = [line.split() for line in out.getvalue().splitlines() if line.startswith(('none', 'mmr'))]
+        self.assertEqual([(row[0], row[1]) for row in rows], [('none', '4'), ('mmr', '5'), ('mmr', '10')])
+        for row in rows:
+            self.assertTrue(0.0 <= float(row[2]) <= 1.0)
+        self.assertEqual([name for name in self.chroma.list_collections() if 'bench' in str(name)], [])
+        self.assertEqual(lexical_index.get_lexical_index()._connect().execute('SELECT COUNT(*) FROM chunks').fetchone(),
+                         (4,))
+
+NADH_CHUNK = 'NADH carries electrons.'
+
+
+class HybridSearchTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # Distinct lengths keep both the vector and the BM25 order free of ties
+        self.add_pages([(1, 'Mitochondria energy cell.'),
+                        (2, 'Mitochondria release energy in the cell.'),
+                        (3, 'The cell gets energy from mitochondria daily.'),
+                        (4, 'Energy for the cell comes from mitochondria each day.'),
+                        (5, NADH_CHUNK),
+                        (6, 'Section 3.2 covers glycolysis.')])
+        self.index = lexical_index.get_lexical_index()
+        self.query = 'mitochondria energy cell NADH'
+
+    def test_ingestion_indexes_chunks_with_vector_store_ids_and_pages(self):
+        hits = self.index.search(self.document_id, 'NADH')
+        stored = self.chroma.get_collection(f'doc_{self.document_id}').get(ids=[hits[0]['id']], include=['metadatas'])
+
+        self.assertEqual([hit['text'] for hit in hits], [NADH_CHUNK])
+        self.assertEqual(hits[0]['page'], stored['metadatas'][0]['page'])
+
+    def test_search_matches_exact_terms_within_a_collection_and_page_range(self):
+        self.index.add_chunks('other', [('chunk_0', 'NADH in another document.', 1, 1)])
+
+        self.assertEqual([hit['page'] for hit in self.index.search(self.document_id, 'section 3.2')], [6])
+        self.assertEqual(self.index.search(self.document_id, 'NADH', pages=[1, 2]), [])
+        self.assertEqual(self.index.search(self.document_id, 'NEAR("AND" OR)'), [])
+        self.assertEqual(self.index.search(self.document_id, '?!'), [])
+
+    def test_search_is_scoped_by_the_collection_column(self):
+        # Documents without a content hash use their UUID, hyphens included
+        collection_id = str(uuid.uuid4())
+        self.index.add_chunks(collection_id, [('chunk_0', 'NADH again.', 1, 1)])
+
+        self.assertEqual([hit['text'] for hit in self.index.search(collection_id, 'NADH')], ['NADH again.'])
+        self.assertEqual(self.index.search(collection_id, collection_id.split('-')[0]), [])
+
+    def test_deleting_the_last_document_of_a_collection_drops_its_keyword_rows(self):
+        first = PDFDocument.objects.create(title='Cells', file='pdfs/cells.pdf', content_hash=self.document_id)
+        copy = PDFDocument.objects.create(title='Cells again', file='pdfs/cells.pdf', content_hash=self.document_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(self.index.has_collection(self.document_id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+        self.assertFalse(self.index.has_collection(self.document_id))
+
+    def test_reciprocal_rank_fusion_rewards_agreement(self):
+        fused = lexical_index.reciprocal_rank_fusion([['a', 'b', 'c'], ['d', 'b']], k=60)
+
+        self.assertEqual([item for item, _ in fused], ['b', 'a', 'd', 'c'])
+        self.assertAlmostEqual(fused[0][1], 1 / 62 + 1 / 62)
+
+    def test_fusion_never_lengthens_the_vector_results(self):
+        ranked = [('a', 'A'), ('b', 'B')]
+        hits = [{'id': chunk_id, 'text': chunk_id.upper()} for chunk_id in ('c', 'b', 'd')]
+
+        self.assertEqual(self.ai_service.fuse_lexical(ranked, hits), [('b', 'B'), ('a', 'A')])
+        self.assertEqual(len(self.ai_service.fuse_lexical([], hits)), 3)
+
+    def test_keyword_matches_are_fused_into_vector_results(self):
+        with override_settings(HYBRID_SEARCH=False):
+            vector_only = self.ai_service.retrieve_relevant_context(self.document_id, self.query, n_results=3)
+        caches.retrieval_results.clear()
+        hybrid = self.ai_service.retrieve_relevant_context(self.document_id, self.query, n_results=3)
+
+        self.assertNotIn(NADH_CHUNK, vector_only)
+        self.assertIn(NADH_CHUNK, hybrid)
+        self.assertEqual(len(hybrid), 3)
+
+    def test_reranking_considers_keyword_only_candidates(self):
+        chunks = self.ai_service.retrieve_reranked(self.document_id, self.query, top_k=3, candidates=2,
+                                                   method='mmr', token_budget=0)
+
+        self.assertIn(NADH_CHUNK, chunks)
+
+    def test_keyword_index_answers_while_the_embedding_model_loads(self):
+        loading = threading.Event()
+
+        def slow_load(name):
+            loading.wait(5)
+            return FakeEmbeddingModel()
+
+        with mock.patch.object(shared_resources, '_embedding_model', None), \
+                mock.patch.object(shared_resources, 'SentenceTransformer', side_effect=slow_load) as load:
+            chunks = self.ai_service.retrieve_relevant_context(self.document_id, 'NADH', n_results=2)
+            self.ai_service.retrieve_reranked(self.document_id, 'NADH', top_k=2, method='mmr')
+
+            self.assertEqual(chunks, [NADH_CHUNK])
+            self.assertEqual(caches.retrieval_results.stats()['entries'], 0)
+            self.assertFalse(shared_resources.is_embedding_model_loaded())
+
+            # The first fallback started one background load, which the next requests can use
+            loading.set()
+            shared_resources._loader.join(5)
+            self.assertTrue(shared_resources.is_embedding_model_loaded())
+            load.assert_called_once()
+
+    def test_existing_documents_can_be_backfilled_from_the_vector_store(self):
+        PDFDocument.objects.create(title='Cells', file='pdfs/cells.pdf', processed=True, content_hash=self.document_id)
+        use_temp_lexical_index(self)
+        empty = lexical_index.get_lexical_index()
+        self.assertFalse(empty.has_collection(self.document_id))
+
+        call_command('build_lexical_index', stdout=StringIO())
+
+        self.assertEqual([hit['page'] for hit in empty.search(self.document_id, 'NADH')], [5])
+
+@override_settings(QUESTION_BANK_SIZE=4, QUESTION_BANK_LOW_WATER=2, MCQ_QUESTIONS_PER_CALL=2, BACKGROUND_WORKERS=0)
+class QuestionBankTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.'),
+                        (2, 'Photosynthesis converts light into chemical energy.'),
+                        (3, 'The treaty ended the war in Europe.')])
+        self.document = PDFDocument.objects.create(title='Notes', file='pdfs/notes.pdf', processed=True,
+                                                   stage='done', total_pages=3, content_hash=self.document_id)
+
+    def generated(self, context, count, topic=''):
+        stems = ['What does this passage state: {}', 'Which claim is false given that {}']
+        return [AIService().normalize_mcq_item(batch_item(stem.format(context))) for stem in stems[:count]]
+
+    def test_fill_bank_tags_questions_with_their_source(self):
+        job = BackgroundJob.objects.create(kind='fill_bank', document=self.document, payload={'topic': '', 'count': 4})
+        with mock.patch('learning_app.question_bank.check_llm_health', return_value={'ok': True}), \
+                mock.patch.object(AIService, 'generate_mcq_set', side_effect=self.generated):
+            fill_bank(job)
+
+        pages = {'Mitochondria': 1, 'Photosynthesis': 2}
+        bank = list(self.document.bank_questions.all())
+        self.assertEqual(len(bank), 4)
+        for question in bank:
+            source = next(word for word in pages if word in question.question_text)
+            self.assertEqual(question.page, pages[source])
+            self.assertEqual(question.chunk_id, f'chunk_{pages[source] - 1}')
+
+    def test_quiz_is_assembled_from_the_bank_without_the_llm(self):
+        BankQuestion.objects.bulk_create([
+            BankQuestion(document=self.document, question_text=f'Banked question {i}?', page=i % 3 + 1,
+                         options={'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'}, correct_answer='B')
+            for i in range(5)
+        ])
+
+        with mock.patch.object(AIService, 'atest_connection') as test_connection, \
+                mock.patch('learning_app.question_bank.enqueue') as enqueue_job:
+            response = self.client.post(reverse('create_quiz', args=[self.document.id]),
+                                        {'topic': '', 'page_range': '', 'num_questions': 4})
+
+        test_connection.assert_not_called()
+        quiz = QuizSession.objects.get()
+        self.assertRedirects(response, reverse('take_quiz', args=[quiz.id]), fetch_redirect_response=False)
+        self.assertEqual(quiz.questions.count(), 4)
+        self.assertEqual(BankQuestion.objects.filter(times_served=1).count(), 4)
+        # Only one unserved question is left, below the low-water mark
+        enqueue_job.assert_called_once_with('fill_bank', self.document, topic='', count=3)
+
+    def test_only_repeated_topics_get_a_bank_of_their_own(self):
+        from .question_bank import request_top_up
+        QuizSession.objects.create(document=self.document, topic='Krebs cycle')
+
+        with mock.patch('learning_app.question_bank.enqueue') as enqueue_job:
+            self.assertIsNone(request_top_up(self.document, 'Krebs cycle'))
+            enqueue_job.assert_not_called()
+
+            QuizSession.objects.create(document=self.document, topic='krebs cycle')
+            request_top_up(self.document, 'Krebs cycle')
+        enqueue_job.assert_called_once_with('fill_bank', self.document, topic='krebs cycle', count=4)
+
+    def test_bank_that_cannot_cover_the_quiz_is_not_used(self):
+        BankQuestion.objects.create(document=self.document, question_text='Banked question?', page=1,
+                                    options={'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'}, correct_answer='B')
+
+        from .question_bank import draw_questions
+        self.assertEqual(draw_questions(self.document, '', [], 2), [])
+        self.assertEqual(draw_questions(self.document, '', [2], 1), [])
+        self.assertEqual(BankQuestion.objects.get().times_served, 0)
+
+
+@override_settings(MCQ_MAX_IN_FLIGHT=1, MCQ_QUESTIONS_PER_CALL=1, QUESTION_BANK_SIZE=0)
+class QuizGenerationTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.'),
+                        (2, 'Photosynthesis converts light into chemical energy.')])
+        self.document = PDFDocument.objects.create(title='Notes', file='pdfs/notes.pdf', processed=True,
+                                                   stage='done', total_pages=2, content_hash=self.document_id)
+
+    def test_create_quiz_returns_before_generation(self):
+        with mock.patch.object(AIService, 'atest_connection', return_value=True), \
+                mock.patch.object(AIService, 'generate_mcq_questions') as generate:
+            response = self.client.post(reverse('create_quiz', args=[self.document.id]),
+                                        {'topic': 'cells', 'page_range': '', 'num_questions': 3})
+
+        generate.assert_not_called()
+        quiz = QuizSession.objects.get()
+        self.assertRedirects(response, reverse('take_quiz', args=[quiz.id]), fetch_redirect_response=False)
+        self.assertEqual((quiz.status, quiz.requested_questions), ('generating', 3))
+        job = BackgroundJob.objects.get(kind='generate_quiz')
+        self.assertEqual(job.payload, {'quiz_id': str(quiz.id)})
+
+    @override_settings(QUIZ_MAX_BACKLOG=1)
+    def test_create_quiz_is_turned_away_while_the_quiz_backlog_is_full(self):
+        BackgroundJob.objects.create(kind='generate_quiz', document=self.document, status='running')
+
+        with mock.patch.object(AIService, 'atest_connection', return_value=True):
+            response = self.client.post(reverse('create_quiz', args=[self.document.id]),
+                                        {'topic': 'cells', 'page_range': '', 'num_questions': 3})
+
+        self.assertRedirects(response, reverse('create_quiz', args=[self.document.id]), fetch_redirect_response=False)
+        self.assertFalse(QuizSession.objects.exists())
+        self.assertEqual(BackgroundJob.objects.filter(kind='generate_quiz').count(), 1)
+
+    def test_questions_are_saved_as_they_are_generated(self):
+        quiz = QuizSession.objects.create(document=self.document, status='generating', requested_questions=2)
+        job = BackgroundJob.objects.create(kind='generate_quiz', document=self.document,
+                                           payload={'quiz_id': str(quiz.id)})
+        saved_before_call = []
+        stems = iter(['Which organelle produces energy?', 'What does photosynthesis convert?'])
+
+        def generate(context, count, topic=''):
+            # Runs on a generation thread, so count saves rather than querying the database
+            saved_before_call.append(create.call_count)
+            return [AIService().normalize_mcq_item(batch_item(next(stems)))]
+
+        with mock.patch.object(AIService, 'generate_mcq_set', side_effect=generate), \
+                mock.patch.object(Question.objects, 'create', wraps=Question.objects.create) as create:
+            from .quiz_generation import generate_quiz
+            generate_quiz(job)
+
+        quiz.refresh_from_db()
+        self.assertEqual(saved_before_call, [0, 1])
+        self.assertEqual(quiz.status, 'ready')
+
+        # The page fetches only the questions it hasn't shown yet
+        data = self.client.get(reverse('quiz_questions', args=[quiz.id]), {'after': 1}).json()
+        self.assertEqual(data['status'], 'ready')
+        self.assertEqual([q['question_text'] for q in data['questions']], ['What does photosynthesis convert?'])
+        self.assertNotIn('correct_answer', data['questions'][0])
+
+    def test_quiz_without_questions_is_marked_failed(self):
+        quiz = QuizSession.objects.create(document=self.document, status='generating', requested_questions=2)
+        job = BackgroundJob.objects.create(kind='generate_quiz', document=self.document,
+                                           payload={'quiz_id': str(quiz.id)})
+
+        with mock.patch.object(AIService, 'generate_mcq_set', return_value=[]):
+            from .quiz_generation import generate_quiz
+            generate_quiz(job)
+
+        quiz.refresh_from_db()
+        self.assertEqual(quiz.status, 'failed')
+        self.assertTrue(quiz.error)
+        self.assertContains(self.client.get(reverse('take_quiz', args=[quiz.id])), quiz.error)
+
+    def test_requeued_job_only_makes_up_missing_questions(self):
+        quiz = QuizSession.objects.create(document=self.document, status='generating', requested_questions=3)
+        Question.objects.create(quiz_session=quiz, question_text='Which organelle produces energy?',
+                                options={'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'}, correct_answer='A')
+        job = BackgroundJob.objects.create(kind='generate_quiz', document=self.document,
+                                           payload={'quiz_id': str(quiz.id)})
+        stems = iter(['Which organelle produces energy?', 'What does photosynthesis convert?', 'What is ATP?'])
+
+        from .quiz_generation import generate_quiz
+        with mock.patch.object(AIService, 'generate_mcq_set',
+                               side_effect=lambda *args: [AIService().normalize_mcq_item(batch_item(next(stems)))]):
+            generate_quiz(job)
+
+        self.assertEqual(list(quiz.questions.order_by('id').values_list('question_text', flat=True)),
+                         ['Which organelle produces energy?', 'What does photosynthesis convert?', 'What is ATP?'])
+
+        # Running the job again has nothing left to generate
+        with mock.patch.object(AIService, 'generate_mcq_set') as generate:
+            generate_quiz(job)
+        generate.assert_not_called()
+        self.assertEqual(quiz.questions.count(), 3)
+
+    def test_generation_stops_once_the_quiz_is_submitted(self):
+        quiz = QuizSession.objects.create(document=self.document, status='generating', requested_questions=3)
+        job = BackgroundJob.objects.create(kind='generate_quiz', document=self.document,
+                                           payload={'quiz_id': str(quiz.id)})
+        stems = iter(['Which organelle produces energy?', 'What does photosynthesis convert?', 'What is ATP?'])
+        create = Question.objects.create
+
+        def create_then_submit(**fields):
+            question = create(**fields)
+            QuizSession.objects.filter(id=quiz.id).update(completed=True)
+            return question
+
+        with mock.patch.object(AIService, 'generate_mcq_set',
+                               side_effect=lambda *args: [AIService().normalize_mcq_item(batch_item(next(stems)))]), \
+                mock.patch.object(Question.objects, 'create', side_effect=create_then_submit):
+            from .quiz_generation import generate_quiz
+            generate_quiz(job)
+
+        quiz.refresh_from_db()
+        self.assertEqual(quiz.questions.count(), 1)
+        self.assertEqual(quiz.status, 'ready')
+
+
+class SemanticDeduplicatorTests(TestCase):
+    def setUp(self):
+        self.model = FakeEmbeddingModel()
+
+    def test_duplicates_within_a_batch_and_against_earlier_ones(self):
+        deduplicator = SemanticDeduplicator(self.model.encode, threshold=0.9)
+        first = deduplicator.filter_new(['Where is ATP produced?', 'where is atp produced',
+                                         'What does the heart pump?'])
+        second = deduplicator.filter_new(['What does the HEART pump?', 'Why do cells divide?'])
+
+        self.assertEqual([vector is not None for vector in first], [True, False, True])
+        self.assertEqual([vector is not None for vector in second], [False, True])
+        self.assertEqual(deduplicator.size, 3)
+
+    def test_seeding_with_thousands_of_vectors(self):
+        rng = np.random.default_rng(0)
+        seed = rng.normal(size=(5000, FakeEmbeddingModel.dimensions))
+        deduplicator = SemanticDeduplicator(self.model.encode, threshold=0.9)
+        for rows in np.array_split(seed, 7):
+            deduplicator.add(rows)
+
+        self.assertEqual(deduplicator.size, 5000)
+        self.assertTrue(deduplicator.is_duplicate(seed[1234] / np.linalg.norm(seed[1234])))
+
+
+class BankDeduplicationTests(TestCase):
+    def setUp(self):
+        use_fake_embeddings(self)
+        self.document = PDFDocument.objects.create(title='Notes', file='pdfs/notes.pdf')
+
+    def test_bank_seeds_deduplicator_and_backfills_embeddings(self):
+        from .question_bank import bank_deduplicator
+
+        BankQuestion.objects.create(document=self.document, question_text='Where is ATP produced?',
+                                    options={'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'}, correct_answer='A')
+
+        deduplicator = bank_deduplicator(self.document, AIService())
+
+        self.assertIsNotNone(BankQuestion.objects.get().embedding)
+        self.assertEqual([vector is None for vector in deduplicator.filter_new(['where is ATP produced',
+                                                                                'What does the heart pump?'])],
+                         [True, False])
+
+
+class QuizWriteTests(TestCase):
+    OPTIONS = {'A': 'One', 'B': 'Two', 'C': 'Three', 'D': 'Four'}
+
+    def setUp(self):
+        self.document = PDFDocument.objects.create(title='Notes', file='pdfs/notes.pdf', processed=True,
+                                                   stage='done', total_pages=3)
+
+    def make_quiz(self, count):
+        quiz = QuizSession.objects.create(document=self.document)
+        Question.objects.bulk_create([
+            Question(quiz_session=quiz, question_text=f'Question {i}?', options=self.OPTIONS, correct_answer='B')
+            for i in range(count)
+        ])
+        return quiz
+
+    def test_submission_uses_a_constant_number_of_queries(self):
+        quiz = self.make_quiz(50)
+        answers = {f'question_{question.id}': 'B' if i % 2 else 'C'
+                   for i, question in enumerate(quiz.questions.order_by('id'))}
+
+        # Quiz lookup, question select, then savepoint, bulk update, session update, release
+        with self.assertNumQueries(6):
+            response = self.client.post(reverse('take_quiz', args=[quiz.id]), answers)
+
+        self.assertRedirects(response, reverse('quiz_results', args=[quiz.id]), fetch_redirect_response=False)
+        quiz.refresh_from_db()
+        self.assertTrue(quiz.completed)
+        self.assertEqual(quiz.score, 50)
+        self.assertEqual(quiz.questions.filter(is_correct=True).count(), 25)
+        self.assertEqual(quiz.questions.filter(user_answer='C', is_correct=False).count(), 25)
+
+    def test_quiz_cannot_be_submitted_while_generating(self):
+        quiz = self.make_quiz(2)
+        QuizSession.objects.filter(id=quiz.id).update(status='generating')
+        question = quiz.questions.first()
+
+        response = self.client.post(reverse('take_quiz', args=[quiz.id]), {f'question_{question.id}': 'B'})
+
+        self.assertRedirects(response, reverse('take_quiz', args=[quiz.id]), fetch_redirect_response=False)
+        quiz.refresh_from_db()
+        self.assertFalse(quiz.completed)
+        self.assertIsNone(quiz.questions.get(id=question.id).is_correct)
+
+    @override_settings(QUESTION_BANK_SIZE=0)
+    def test_quiz_from_bank_is_created_with_one_insert(self):
+        BankQuestion.objects.bulk_create([
+            BankQuestion(document=self.document, question_text=f'Banked {i}?', options=self.OPTIONS,
+                         correct_answer='A')
+            for i in range(20)
+        ])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('create_quiz', args=[self.document.id]),
+                             {'topic': '', 'page_range': '', 'num_questions': 20})
+
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "learning_app_question"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(QuizSession.objects.get().questions.count(), 20)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_connection_is_tuned(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite profile only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def test_document_quiz_history_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plan check is SQLite specific')
+        queryset = QuizSession.objects.filter(document_id=uuid.uuid4()).order_by('-created_at')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+        self.assertIn('quiz_document_created_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class AsyncViewTests(VectorStoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_pages([(1, 'Mitochondria produce energy for the cell.')])
+        self.document = PDFDocument.objects.create(title='Notes', file='pdfs/notes.pdf', processed=True,
+                                                   stage='done', total_pages=1, content_hash=self.document_id)
+        self.stub = StubOllama(lambda body, n: 'They produce energy.', delay=0.3)
+        self.addCleanup(self.stub.close)
+
+    async def test_concurrent_chats_wait_on_the_llm_together(self):
+        with mock.patch('learning_app.ai_service.get_async_llm_client',
+                        side_effect=lambda: AsyncOllamaClient(base_url=self.stub.url)), \
+                mock.patch('learning_app.ai_service.get_scheduler', return_value=LLMScheduler(max_concurrent=10)):
+            started = time.perf_counter()
+            responses = await asyncio.gather(*[
+                self.async_client.post(reverse('chat_api', args=[self.document.id]),
+                                       {'message': f'What do mitochondria do? ({i})'}, content_type='application/json')
+                for i in range(10)
+            ])
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(responses[0].json()['response'], 'They produce energy.')
+        self.assertEqual(self.stub.max_active, 10)
+        self.assertLess(elapsed, 10 * 0.3)
+        self.assertEqual(await ChatMessage.objects.filter(document=self.document).acount(), 10)
+
+    def test_async_client_is_closed_with_its_event_loop(self):
+        async def client_for_loop():
+            return get_async_llm_client()
+
+        first = asyncio.run(client_for_loop())
+        second = asyncio.run(client_for_loop())
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.client.is_closed)
+        self.assertTrue(second.client.is_closed)
+
+    def test_asgi_lifespan_shutdown_closes_the_async_client(self):
+        from pdf_learning.asgi import application
+
+        async def serve():
+            client = get_async_llm_client()
+            messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await application({'type': 'lifespan'}, receive, send)
+            return sent, client.client.is_closed
+
+        sent, closed = asyncio.run(serve())
+
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(closed)
+
+    async def test_async_client_retries_transient_errors(self):
+        self.stub.delay = 0
+        self.stub.status_codes = [503]
+        client = AsyncOllamaClient(base_url=self.stub.url)
+
+        data = await client.generate('hi')
+
+        self.assertEqual(data['response'], 'They produce energy.')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    async def test_chat_is_rejected_with_429_when_its_queue_is_full(self):
+        scheduler = LLMScheduler(max_concurrent=1, queue_limits={INTERACTIVE: 0})
+        with mock.patch('learning_app.ai_service.get_async_llm_client',
+                        side_effect=lambda: AsyncOllamaClient(base_url=self.stub.url)), \
+                mock.patch('learning_app.ai_service.get_scheduler', return_value=scheduler), \
+                scheduler.slot(BACKGROUND):
+            response = await self.async_client.post(reverse('chat_api', args=[self.document.id]),
+                                                    {'message': 'What do mitochondria do?'},
+                                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(scheduler.stats()['classes'][INTERACTIVE]['rejected'], 1)
+
+
+    async def test_chat_stream_is_rejected_with_429_before_streaming(self):
+        scheduler = LLMScheduler(max_concurrent=1, queue_limits={INTERACTIVE: 0})
+        url = reverse('chat_stream_api', args=[self.document.id])
+        with mock.patch('learning_app.views.get_scheduler', return_value=scheduler), \
+                mock.patch('learning_app.ai_service.get_scheduler', return_value=scheduler):
+            with scheduler.slot(BACKGROUND):
+                response = await self.async_client.post(url, {'message': 'What do mitochondria do?'},
+                                                        content_type='application/json')
+            self.assertFalse(scheduler.is_full(INTERACTIVE))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self.stub.requests, [])
+
+
+class LLMSchedulerTests(TestCase):
+    def queue_request(self, scheduler, order, priority, key, label):
+        """Start a thread that records label once it is granted a slot, and wait until it is queued"""
+        def run():
+            with scheduler.slot(priority, key):
+                order.append(label)
+
+        waiting = scheduler.stats()['classes'][priority]['waiting']
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        while scheduler.stats()['classes'][priority]['waiting'] == waiting:
+            time.sleep(0.001)
+        return thread
+
+    def test_higher_priority_requests_are_served_first(self):
+        scheduler = LLMScheduler(max_concurrent=1, timeout=5)
+        order = []
+        with scheduler.slot(INTERACTIVE):
+            threads = [self.queue_request(scheduler, order, BACKGROUND, 'doc', 'bank'),
+                       self.queue_request(scheduler, order, QUIZ, 'quiz', 'quiz'),
+                       self.queue_request(scheduler, order, INTERACTIVE, 'doc', 'chat')]
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, ['chat', 'quiz', 'bank'])
+
+    def test_keys_take_turns_within_a_priority(self):
+        scheduler = LLMScheduler(max_concurrent=1, timeout=5)
+        order = []
+        with scheduler.slot(QUIZ):
+            threads = [self.queue_request(scheduler, order, QUIZ, 'big', f'big-{i}') for i in range(3)]
+            threads.append(self.queue_request(scheduler, order, QUIZ, 'small', 'small-0'))
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(order, ['big-0', 'small-0', 'big-1', 'big-2'])
+
+    def test_full_queue_rejects_immediately(self):
+        scheduler = LLMScheduler(max_concurrent=1, queue_limits={QUIZ: 1}, timeout=5)
+        with scheduler.slot(QUIZ):
+            thread = self.queue_request(scheduler, [], QUIZ, 'a', 'a')
+            self.assertTrue(scheduler.is_full(QUIZ))
+            with self.assertRaises(LLMQueueFullError):
+                with scheduler.slot(QUIZ, 'b'):
+                    pass
+        thread.join(5)
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['classes'][QUIZ]['rejected'], 1)
+        self.assertEqual(stats['classes'][QUIZ]['admitted'], 2)
+
+    def test_waiting_too_long_times_out_and_wait_times_are_reported(self):
+        scheduler = LLMScheduler(max_concurrent=1, timeout=0.05)
+        with scheduler.slot(INTERACTIVE):
+            with self.assertRaises(LLMQueueTimeoutError):
+                with scheduler.slot(BACKGROUND):
+                    pass
+        with scheduler.slot(BACKGROUND):
+            pass
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['classes'][BACKGROUND]['waiting'], 0)
+        self.assertEqual(stats['classes'][BACKGROUND]['timed_out'], 1)
+        self.assertEqual(stats['classes'][BACKGROUND]['admitted'], 1)
+
+    async def test_async_waiters_share_slots_with_threads(self):
+        scheduler = LLMScheduler(max_concurrent=1, timeout=5)
+        release = threading.Event()
+
+        def hold():
+            with scheduler.slot(BACKGROUND):
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        while not scheduler.in_flight:
+            await asyncio.sleep(0.001)
+
+        async def chat():
+            async with scheduler.aslot(INTERACTIVE, 'doc'):
+                return scheduler.in_flight
+
+        task = asyncio.ensure_future(chat())
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())
+        release.set()
+
+        self.assertEqual(await asyncio.wait_for(task, 5), 1)
+        await asyncio.to_thread(thread.join, 5)
+        stats = scheduler.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertGreater(stats['classes'][INTERACTIVE]['max_wait_seconds'], 0.04)
@@ -1,13 +1,35 @@
+import hashlib
 import json
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from contextlib import aclosing
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
 from django.core.files.storage import default_storage
+from django.db import transaction
 from .models import PDFDocument, QuizSession, Question, ChatMessage
-from .pdf_processor import PDFProcessor
 from .ai_service import AIService
+from .pdf_processor import PDFProcessor
+from .jobs import enqueue, pending_jobs
+from .question_bank import draw_questions, request_top_up
+from .llm_client import LLMUnavailableError
+from .health import acheck_llm_health
+from .caches import cache_stats
+from .response_cache import get_response_cache
+from .scheduler import INTERACTIVE, LLMQueueFullError, get_scheduler
+from .shared_resources import is_embedding_model_loaded, memory_footprint
+
+def file_sha256(uploaded_file) -> str:
+    """Hash an uploaded file without reading it into memory at once"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
 
 def home(request):
     """Home page with upload form"""
@@ -30,33 +52,28 @@ def upload_pdf(request):
             return redirect('home')
         
         try:
-            # Create document record
+            # Create document record; extraction and embedding run in the background
             document = PDFDocument.objects.create(
                 title=title,
-                file=pdf_file
+                file=pdf_file,
+                content_hash=file_sha256(pdf_file)
             )
             
-            # Process PDF
-            processor = PDFProcessor()
-            ai_service = AIService()
-            
-            # Extract text and get page count
-            full_text, total_pages = processor.extract_text_from_pdf(pdf_file)
-            document.total_pages = total_pages
-            document.save()
-            
-            # Create text chunks and add to vector database
-            chunks, page_numbers = processor.chunk_text(full_text)
-            ai_service.add_text_chunks(str(document.id), chunks, page_numbers)
+            # Identical files reuse the collection built for the earlier upload
+            duplicate = document.find_processed_duplicate()
+            if duplicate:
+                document.copy_ingestion_from(duplicate)
+                request_top_up(document)
+                messages.success(request, f'PDF "{title}" uploaded and ready (same content as "{duplicate.title}").')
+                return redirect('document_detail', document_id=document.id)
             
-            document.processed = True
-            document.save()
+            enqueue('ingest_document', document=document)
             
-            messages.success(request, f'PDF "{title}" uploaded and processed successfully!')
+            messages.success(request, f'PDF "{title}" uploaded. Processing has started in the background.')
             return redirect('document_detail', document_id=document.id)
             
         except Exception as e:
-            messages.error(request, f'Error processing PDF: {str(e)}')
+            messages.error(request, f'Error uploading PDF: {str(e)}')
             return redirect('home')
     
     return redirect('home')
@@ -71,10 +88,28 @@ def document_detail(request, document_id):
         'quiz_sessions': quiz_sessions
     })
 
-def create_quiz(request, document_id):
-    """Create a new quiz session with comprehensive debugging"""
+def document_status(request, document_id):
+    """JSON ingestion progress for a document, polled by the detail page"""
     document = get_object_or_404(PDFDocument, id=document_id)
     
+    return JsonResponse({
+        'stage': document.stage,
+        'stage_display': document.get_stage_display(),
+        'processed': document.processed,
+        'total_pages': document.total_pages,
+        'pages_extracted': document.pages_extracted,
+        'chunks_embedded': document.chunks_embedded,
+        'error': document.error,
+    })
+
+async def create_quiz(request, document_id):
+    """Create a new quiz session with comprehensive debugging.
+    
+    Async so waiting on the LLM health check holds no worker thread; ORM work
+    runs through sync_to_async.
+    """
+    document = await aget_object_or_404(PDFDocument, id=document_id)
+    
     if not document.processed:
         messages.error(request, 'Document is still being processed. Please wait and try again.')
         return redirect('document_detail', document_id=document.id)
@@ -94,101 +129,47 @@ def create_quiz(request, document_id):
         print(f"Number of Questions: {num_questions}")
         
         try:
-            # Test AI connection first
+            PDFProcessor().parse_page_range(page_range, document.total_pages or 0)
+        except ValueError:
+            messages.error(request, f'Invalid page range "{page_range}". Use a format like 1-5 or 3,7,9.')
+            return redirect('create_quiz', document_id=document.id)
+        
+        try:
             ai_service = AIService()
             
+            # Serve the quiz from the pre-generated bank when it covers the request
+            quiz_session = await sync_to_async(create_quiz_from_bank)(
+                document, topic, page_range, ai_service.pages_in_range(page_range, document.total_pages), num_questions
+            )
+            if quiz_session:
+                print(f"✓ Quiz {quiz_session.id} assembled from the question bank")
+                messages.success(request, f'🎉 Quiz created successfully with {num_questions} questions!')
+                return redirect('take_quiz', quiz_id=quiz_session.id)
+            
+            # Test AI connection first
             print("Testing AI connection...")
-            if not ai_service.test_connection():
+            if not await ai_service.atest_connection():
                 messages.error(request, 'AI service is not available. Please make sure Ollama is running with Gemma 2B model.')
                 return redirect('document_detail', document_id=document.id)
             print("✓ AI connection successful")
             
-            # Test context retrieval
-            print("Testing context retrieval...")
-            test_query = topic if topic else "main concepts"
-            context_chunks = ai_service.retrieve_relevant_context(str(document.id), test_query, n_results=3)
-            
-            if not context_chunks:
-                messages.error(request, 'No content found in the document. The document might not have been processed correctly.')
-                return redirect('document_detail', document_id=document.id)
-            
-            print(f"✓ Retrieved {len(context_chunks)} context chunks")
-            print(f"Sample context (first 200 chars): {context_chunks[0][:200]}...")
-            
-            # Create quiz session
-            quiz_session = QuizSession.objects.create(
-                document=document,
-                topic=topic,
-                page_range=page_range
-            )
-            print(f"✓ Quiz session created: {quiz_session.id}")
-            
-            # Generate questions with detailed logging
-            print("Starting question generation...")
-            questions_data = ai_service.generate_mcq_questions(
-                str(document.id), 
-                topic, 
-                page_range, 
-                num_questions
-            )
-            
-            print(f"Question generation completed. Generated {len(questions_data)} questions")
-            
-            if not questions_data:
-                print("❌ No questions generated")
-                
-                # Try a simpler approach - generate just one question to test
-                print("Attempting to generate a single test question...")
-                test_context = context_chunks[0][:800]  # Use first chunk, limited size
-                test_question = ai_service.generate_single_mcq(test_context, topic)
-                
-                if test_question:
-                    print("✓ Test question generation successful")
-                    questions_data = [test_question]
-                else:
-                    print("❌ Even test question generation failed")
-                    messages.error(request, 
-                        'Unable to generate questions. This could be due to:\n'
-                        '• Complex or unclear content in the specified range\n'
-                        '• AI model limitations with the current topic\n'
-                        '• Try with a simpler topic or different page range\n'
-                        '• Check that Ollama and Gemma 2B are working properly'
-                    )
-                    quiz_session.delete()
-                    return redirect('document_detail', document_id=document.id)
-            
-            # Create question objects
-            created_questions = 0
-            for i, q_data in enumerate(questions_data):
-                try:
-                    print(f"Creating question {i+1}: {q_data.get('question_text', 'No text')[:50]}...")
-                    
-                    Question.objects.create(
-                        quiz_session=quiz_session,
-                        question_text=q_data['question_text'],
-                        options=q_data['options'],
-                        correct_answer=q_data['correct_answer'],
-                        explanation=q_data.get('explanation', '')
-                    )
-                    created_questions += 1
-                    print(f"✓ Question {i+1} created successfully")
-                    
-                except Exception as e:
-                    print(f"❌ Error creating question {i+1}: {e}")
-                    continue
-            
-            if created_questions == 0:
-                print("❌ No questions were successfully created")
-                messages.error(request, 'Failed to create any questions. Please try again with different parameters.')
-                quiz_session.delete()
-                return redirect('document_detail', document_id=document.id)
+            # Turn the request away rather than queue a quiz behind a backlog it would wait minutes on
+            if await pending_jobs('generate_quiz').acount() >= settings.QUIZ_MAX_BACKLOG:
+                messages.error(request, 'The AI service is busy generating other quizzes. Please try again in a minute.')
+                return redirect('create_quiz', document_id=document.id)
             
-            print(f"✓ Successfully created {created_questions} questions")
+            # Generate in the background; take_quiz shows questions as they are saved
+            quiz_session = await sync_to_async(queue_quiz_generation)(document, topic, page_range, num_questions)
+            print(f"✓ Quiz session {quiz_session.id} queued for generation")
             print("="*50)
             
-            messages.success(request, f'🎉 Quiz created successfully with {created_questions} questions!')
             return redirect('take_quiz', quiz_id=quiz_session.id)
             
+        except LLMUnavailableError as e:
+            print(f"❌ AI service unavailable: {e}")
+            messages.error(request, 'AI service is not available. Please make sure Ollama is running with Gemma 2B model.')
+            return redirect('document_detail', document_id=document.id)
+            
         except Exception as e:
             import traceback
             print(f"❌ CRITICAL ERROR: {str(e)}")
@@ -199,37 +180,75 @@ def create_quiz(request, document_id):
             messages.error(request, f'Unexpected error: {str(e)}. Please check the console for details and try again.')
             return redirect('document_detail', document_id=document.id)
     
-    return render(request, 'learning_app/create_quiz.html', {'document': document})
+    return await sync_to_async(render)(request, 'learning_app/create_quiz.html', {'document': document})
+
+def create_quiz_from_bank(document, topic, page_range, pages, num_questions):
+    """Create a quiz from bank questions in one transaction; None if the bank can't cover it"""
+    with transaction.atomic():
+        bank_questions = draw_questions(document, topic, pages, num_questions)
+        if not bank_questions:
+            return None
+        
+        quiz_session = QuizSession.objects.create(
+            document=document,
+            topic=topic,
+            page_range=page_range
+        )
+        Question.objects.bulk_create([
+            Question(
+                quiz_session=quiz_session,
+                question_text=bank_question.question_text,
+                options=bank_question.options,
+                correct_answer=bank_question.correct_answer,
+                explanation=bank_question.explanation
+            )
+            for bank_question in bank_questions
+        ])
+        request_top_up(document, topic)
+    return quiz_session
+
+def queue_quiz_generation(document, topic, page_range, num_questions):
+    """Create a quiz in the generating state and queue its background job"""
+    quiz_session = QuizSession.objects.create(
+        document=document,
+        topic=topic,
+        page_range=page_range,
+        status='generating',
+        requested_questions=num_questions
+    )
+    enqueue('generate_quiz', document, quiz_id=str(quiz_session.id))
+    return quiz_session
 
 def take_quiz(request, quiz_id):
-    """Take a quiz"""
+    """Take a quiz; questions still being generated are fetched by the page as they arrive"""
     quiz_session = get_object_or_404(QuizSession, id=quiz_id)
-    questions = quiz_session.questions.all()
+    questions = quiz_session.questions.order_by('id')
     
     if request.method == 'POST':
-        # Process quiz submission
-        ai_service = AIService()
+        # Grading now would score only the questions saved so far
+        if quiz_session.status == 'generating':
+            messages.warning(request, 'Questions are still being generated. Please submit once they are all ready.')
+            return redirect('take_quiz', quiz_id=quiz_session.id)
+        
+        # Grade in memory, then write every answer in a single transaction
+        questions = list(questions)
         correct_count = 0
         
         for question in questions:
             user_answer = request.POST.get(f'question_{question.id}', '').strip().upper()
             question.user_answer = user_answer
-            
-            if user_answer == question.correct_answer:
-                question.is_correct = True
-                correct_count += 1
-            else:
-                question.is_correct = False
-            
-            question.save()
+            question.is_correct = user_answer == question.correct_answer
+            correct_count += question.is_correct
         
         # Calculate score
-        total_questions = questions.count()
+        total_questions = len(questions)
         score = (correct_count / total_questions) * 100 if total_questions > 0 else 0
         
         quiz_session.score = score
         quiz_session.completed = True
-        quiz_session.save()
+        with transaction.atomic():
+            Question.objects.bulk_update(questions, ['user_answer', 'is_correct'])
+            quiz_session.save(update_fields=['score', 'completed'])
         
         return redirect('quiz_results', quiz_id=quiz_session.id)
     
@@ -238,6 +257,25 @@ def take_quiz(request, quiz_id):
         'questions': questions
     })
 
+def quiz_questions(request, quiz_id):
+    """Generation status of a quiz and the questions saved after the first `after` ones"""
+    quiz_session = get_object_or_404(QuizSession, id=quiz_id)
+    try:
+        after = max(0, int(request.GET.get('after', 0)))
+    except ValueError:
+        after = 0
+    
+    questions = quiz_session.questions.order_by('id')[after:]
+    return JsonResponse({
+        'status': quiz_session.status,
+        'requested_questions': quiz_session.requested_questions,
+        'error': quiz_session.error,
+        'questions': [
+            {'id': question.id, 'question_text': question.question_text, 'options': question.options}
+            for question in questions
+        ],
+    })
+
 def quiz_results(request, quiz_id):
     """Show quiz results"""
     quiz_session = get_object_or_404(QuizSession, id=quiz_id)
@@ -260,9 +298,9 @@ def chatbot(request, document_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def chat_api(request, document_id):
-    """API endpoint for chat"""
-    document = get_object_or_404(PDFDocument, id=document_id)
+async def chat_api(request, document_id):
+    """API endpoint for chat; async so a waiting LLM call doesn't pin a worker thread"""
+    document = await aget_object_or_404(PDFDocument, id=document_id)
     
     try:
         data = json.loads(request.body)
@@ -272,11 +310,11 @@ def chat_api(request, document_id):
             return JsonResponse({'error': 'Message is required'}, status=400)
         
         # Get AI response
-        ai_service = AIService()
-        ai_response = ai_service.answer_question(str(document.id), user_message)
+        ai_service = AIService(priority=INTERACTIVE, fairness_key=str(document.id))
+        ai_response = await ai_service.aanswer_question(document.collection_id, user_message)
         
         # Save chat message
-        chat_message = ChatMessage.objects.create(
+        chat_message = await ChatMessage.objects.acreate(
             document=document,
             message=user_message,
             response=ai_response
@@ -287,9 +325,108 @@ def chat_api(request, document_id):
             'timestamp': chat_message.timestamp.isoformat()
         })
         
+    except LLMQueueFullError as e:
+        response = JsonResponse({'error': str(e)}, status=429)
+        response['Retry-After'] = str(settings.LLM_RETRY_AFTER)
+        return response
+    except LLMUnavailableError as e:
+        return JsonResponse({'error': str(e)}, status=503)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def sse_event(data: dict, event: str = '') -> str:
+    """Format one server-sent event"""
+    prefix = f"event: {event}\n" if event else ''
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def chat_stream_api(request, document_id):
+    """Streaming chat endpoint: sends the answer as server-sent events while it is generated.
+    
+    Under ASGI the answer streams from an async generator, so an open stream
+    holds no worker thread.
+    """
+    document = await aget_object_or_404(PDFDocument, id=document_id)
+    
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    user_message = data.get('message', '').strip()
+    if not user_message:
+        return JsonResponse({'error': 'Message is required'}, status=400)
+    
+    # Once streaming starts the status is already 200, so turn a full queue away before that
+    if get_scheduler().is_full(INTERACTIVE):
+        response = JsonResponse({'error': 'AI service is busy; please retry shortly'}, status=429)
+        response['Retry-After'] = str(settings.LLM_RETRY_AFTER)
+        return response
+    
+    ai_service = AIService(priority=INTERACTIVE, fairness_key=str(document.id))
+    if isinstance(request, ASGIRequest):
+        events = achat_events(ai_service, document, user_message)
+    else:
+        # WSGI servers (runserver) would collect an async stream in full before sending it
+        events = chat_events(ai_service, document, user_message)
+    
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+def chat_events(ai_service, document, user_message):
+    """Server-sent events for a streamed chat answer, saving the exchange once it completes"""
+    fragments = []
+    try:
+        for fragment in ai_service.answer_question_stream(document.collection_id, user_message):
+            fragments.append(fragment)
+            yield sse_event({'token': fragment})
+    except Exception as e:
+        yield sse_event({'error': str(e)}, event='error')
+        return
+    
+    # Persist the exchange only once the full answer has been streamed
+    chat_message = ChatMessage.objects.create(
+        document=document,
+        message=user_message,
+        response=''.join(fragments)
+    )
+    yield sse_event({'timestamp': chat_message.timestamp.isoformat()}, event='done')
+
+async def achat_events(ai_service, document, user_message):
+    """chat_events for ASGI servers"""
+    fragments = []
+    try:
+        async with aclosing(ai_service.aanswer_question_stream(document.collection_id, user_message)) as stream:
+            async for fragment in stream:
+                fragments.append(fragment)
+                yield sse_event({'token': fragment})
+    except Exception as e:
+        yield sse_event({'error': str(e)}, event='error')
+        return
+    
+    chat_message = await ChatMessage.objects.acreate(
+        document=document,
+        message=user_message,
+        response=''.join(fragments)
+    )
+    yield sse_event({'timestamp': chat_message.timestamp.isoformat()}, event='done')
+
+async def health(request):
+    """Backend health for load balancers and the UI; served from a short-lived shared cache"""
+    llm = await acheck_llm_health(force=request.GET.get('force') == '1')
+    response_cache = get_response_cache()
+    return JsonResponse({
+        'ok': llm['ok'],
+        'llm': llm,
+        'embedding_model_loaded': is_embedding_model_loaded(),
+        'caches': cache_stats(),
+        'llm_scheduler': get_scheduler().stats(),
+        'llm_response_cache': response_cache.stats() if response_cache else None,
+    }, status=200 if llm['ok'] else 503)
+
 def debug_quiz_generation(request, document_id):
     """Debug view to test quiz generation step by step"""
     document = get_object_or_404(PDFDocument, id=document_id)
@@ -305,13 +442,13 @@ def debug_quiz_generation(request, document_id):
         # Test 1: AI Connection
         test_result = {
             'name': 'AI Connection Test',
-            'status': 'success' if ai_service.test_connection() else 'failed',
+            'status': 'success' if ai_service.test_connection(force=True) else 'failed',
             'details': 'Testing connection to Gemma 2B via Ollama'
         }
         debug_info['tests'].append(test_result)
         
         # Test 2: Context Retrieval
-        context_chunks = ai_service.retrieve_relevant_context(str(document.id), "main concepts", n_results=3)
+        context_chunks = ai_service.retrieve_relevant_context(document.collection_id, "main concepts", n_results=3)
         test_result = {
             'name': 'Context Retrieval Test',
             'status': 'success' if context_chunks else 'failed',
@@ -333,6 +470,35 @@ def debug_quiz_generation(request, document_id):
                 test_result['question'] = test_question
             debug_info['tests'].append(test_result)
         
+        # Shared model memory usage for this worker
+        footprint = memory_footprint()
+        debug_info['tests'].append({
+            'name': 'Shared Model Memory',
+            'status': 'success' if footprint['embedding_model_loaded'] else 'failed',
+            'details': f"Embedding model: {footprint['embedding_model_mb']} MB, "
+                       f"process peak RSS: {footprint['process_peak_rss_mb']} MB"
+        })
+        
+        # Retrieval cache effectiveness for this worker
+        stats = cache_stats()
+        debug_info['tests'].append({
+            'name': 'Retrieval Caches',
+            'status': 'success',
+            'details': ', '.join(f"{name}: {tier['hits']} hits / {tier['misses']} misses ({tier['entries']} entries)"
+                                 for name, tier in stats.items())
+        })
+        
+        # Work saved by answering repeated prompts from the response cache
+        response_cache = get_response_cache()
+        if response_cache:
+            stats = response_cache.stats()
+            debug_info['tests'].append({
+                'name': 'LLM Response Cache',
+                'status': 'success',
+                'details': f"{stats['backend']}: {stats['hits']} hits / {stats['misses']} misses, "
+                           f"saved {stats['tokens_saved']} tokens and {stats['seconds_saved']}s of generation"
+            })
+        
     except Exception as e:
         debug_info['error'] = str(e)
     
@@ -13,4 +13,21 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pdf_learning.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from learning_app.llm_client import aclose_async_llm_client  # noqa: E402 (needs the app registry)
+
+
+async def application(scope, receive, send):
+    """Django's ASGI application, plus lifespan events so pooled LLM connections are closed on shutdown"""
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_async_llm_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
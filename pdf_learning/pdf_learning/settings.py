@@ -1,6 +1,8 @@
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 SECRET_KEY = 'django-insecure-5pt_6svw3#-8uex)!iq*(2cftuqqqz&hn9y&(gxqf@!q$*ppm6'
@@ -45,10 +47,49 @@ TEMPLATES = [
     },
 ]
 
-DATABASES = {
+# Database profile, chosen with DATABASE_ENGINE=sqlite (default) or postgres
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgres':
+    # Requires psycopg (pip install "psycopg[binary]")
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'pdf_learning'),
+            'USER': os.environ.get('POSTGRES_USER', 'pdf_learning'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Reuse connections across requests instead of reconnecting each time
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+elif DATABASE_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            # init_command and transaction_mode need Django 5.1+
+            'OPTIONS': {
+                # WAL lets readers run alongside a writer; NORMAL sync is safe with WAL
+                'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL',
+                # Wait for a busy writer instead of failing with "database is locked"
+                'timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+                # Take the write lock when a transaction starts so it can't deadlock on upgrade
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_ENGINE '{DATABASE_ENGINE}'; use 'sqlite' or 'postgres'")
+
+# File-based so cached values (e.g. the LLM health check) are shared by all
+# worker processes on this host
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
     }
 }
 
@@ -63,3 +104,113 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Custom settings
 CHROMA_DB_PATH = BASE_DIR / 'chroma_db'
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+
+# Embedding model shared by every request in a worker process
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Load the embedding model when the app starts instead of on the first request
+AI_WARMUP_ON_STARTUP = os.environ.get('AI_WARMUP_ON_STARTUP', '').lower() in ('1', 'true', 'yes')
+# Threads per process that run background jobs such as PDF ingestion.
+# Set to 0 to run jobs inline in the request that queued them.
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 2))
+# Threads per process reserved for live quiz generation, so a quiz someone is
+# waiting on never queues behind ingestion or question bank filling (0 = inline)
+QUIZ_WORKERS = int(os.environ.get('QUIZ_WORKERS', 2))
+# Live quiz jobs queued or running before new quiz requests are turned away
+QUIZ_MAX_BACKLOG = int(os.environ.get('QUIZ_MAX_BACKLOG', 20))
+# Seconds between the heartbeats a process records for the jobs it is running
+BACKGROUND_JOB_HEARTBEAT = int(os.environ.get('BACKGROUND_JOB_HEARTBEAT', 15))
+# Seconds without a heartbeat after which a running job is assumed to have died
+# with its process and is queued again; keep it a few heartbeats long
+BACKGROUND_JOB_TIMEOUT = int(os.environ.get('BACKGROUND_JOB_TIMEOUT', 120))
+# Per-kind overrides; someone is watching a quiz generate, so recover it sooner
+BACKGROUND_JOB_TIMEOUTS = {
+    'generate_quiz': int(os.environ.get('QUIZ_JOB_TIMEOUT', 45)),
+}
+# Processes used to extract text from large PDFs (0 = one per CPU core)
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', 0))
+# PDFs with fewer pages than this are extracted serially
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 40))
+# Chunk sizes are measured in embedding-model tokens (all-MiniLM-L6-v2 reads up to 256)
+CHUNK_MAX_TOKENS = 200
+CHUNK_OVERLAP_TOKENS = 40
+# Let chunks continue across page breaks; metadata records the first and last page
+CHUNK_SPAN_PAGES = False
+# Chunks embedded and written to ChromaDB per batch during ingestion
+# (capped at the client's maximum batch size)
+EMBEDDING_BATCH_SIZE = 256
+# Batch size handed to SentenceTransformer.encode within each write batch
+EMBEDDING_ENCODE_BATCH_SIZE = 32
+# On-disk cache of chunk embeddings shared across documents (0 MB disables it)
+EMBEDDING_CACHE_PATH = BASE_DIR / 'embedding_cache.sqlite3'
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get('EMBEDDING_CACHE_MAX_MB', 512))
+# Concurrent question-generation requests sent to Ollama per quiz.
+# Match this to the server's OLLAMA_NUM_PARALLEL.
+MCQ_MAX_IN_FLIGHT = int(os.environ.get('MCQ_MAX_IN_FLIGHT', 4))
+# Questions requested per LLM call over a shared context block (1 = one question per call)
+MCQ_QUESTIONS_PER_CALL = int(os.environ.get('MCQ_QUESTIONS_PER_CALL', 3))
+# Characters of context sent with a multi-question prompt
+MCQ_BATCH_CONTEXT_CHARS = 3000
+# Cosine similarity above which a generated question counts as a duplicate of an earlier one
+QUESTION_DUPLICATE_THRESHOLD = 0.9
+# Ollama backend
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'gemma2:2b')
+OLLAMA_CONNECT_TIMEOUT = 5  # Seconds to establish a connection
+OLLAMA_READ_TIMEOUT = 120  # Seconds to wait for a generation
+OLLAMA_MAX_RETRIES = 2  # Retries for connection errors and 5xx responses
+OLLAMA_RETRY_BACKOFF = 0.5  # Seconds before the first retry, doubled each time
+OLLAMA_POOL_SIZE = 10  # Keep-alive connections kept per process
+OLLAMA_ASYNC_MAX_CONNECTIONS = 256  # Concurrent connections per process for async views
+OLLAMA_BREAKER_THRESHOLD = 5  # Consecutive failures before failing fast
+OLLAMA_BREAKER_RESET = 30  # Seconds before a trial request is let through
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')  # Keep the model loaded between requests ('' = Ollama default)
+# Health check of the Ollama backend (seconds)
+LLM_HEALTH_TTL = 30  # Reuse a successful check for this long
+LLM_HEALTH_FAILURE_TTL = 5  # Re-probe a failed backend sooner
+LLM_HEALTH_TIMEOUT = 3  # Read timeout for /api/tags and /api/ps
+# Page ranges up to this many pages are ranked by scanning their chunks directly
+# rather than with a filtered vector search
+PAGE_RANGE_SCAN_MAX_PAGES = 5
+# In-process caches for repeated queries (entries per worker process)
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # Query text -> embedding
+RETRIEVAL_CACHE_SIZE = 512  # (document, queries, n_results, pages) -> chunks
+RETRIEVAL_CACHE_TTL = 600  # Seconds; bounds staleness when another process re-ingests
+# Pre-generated question bank per document (0 disables it)
+QUESTION_BANK_SIZE = int(os.environ.get('QUESTION_BANK_SIZE', 30))  # Unserved questions to keep per topic
+QUESTION_BANK_LOW_WATER = 10  # Top up in the background below this many unserved questions
+QUESTION_BANK_TOPIC_REQUESTS = 2  # Quizzes on a free-text topic before it gets a bank of its own
+# Process-wide LLM scheduler: generations beyond LLM_MAX_CONCURRENT wait in
+# per-priority queues (interactive chat > live quizzes > bank filling)
+LLM_MAX_CONCURRENT = int(os.environ.get('LLM_MAX_CONCURRENT', 4))  # Match Ollama's OLLAMA_NUM_PARALLEL
+LLM_QUEUE_LIMITS = {'interactive': 32, 'quiz': 64, 'background': 256}  # Waiting requests before rejecting
+LLM_QUEUE_TIMEOUT = 60  # Seconds a request may wait for a slot before failing
+LLM_RETRY_AFTER = 5  # Retry-After seconds sent with 429 responses when the chat queue is full
+# Cache of complete LLM responses for identical prompts (model + options + prompt):
+# 'lru' (per process), 'django' (the LLM_RESPONSE_CACHE_ALIAS cache), 'sqlite' (on disk) or 'none'
+LLM_RESPONSE_CACHE_BACKEND = os.environ.get('LLM_RESPONSE_CACHE_BACKEND', 'lru')
+LLM_RESPONSE_CACHE_SIZE = 1000  # Entries kept by the lru and sqlite backends
+LLM_RESPONSE_CACHE_TTL = 3600  # Seconds before a cached response expires (0 = never)
+LLM_RESPONSE_CACHE_PATH = BASE_DIR / 'llm_response_cache.sqlite3'
+LLM_RESPONSE_CACHE_ALIAS = 'llm_responses'
+CACHES[LLM_RESPONSE_CACHE_ALIAS] = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': BASE_DIR / 'cache' / 'llm_responses',
+    'OPTIONS': {'MAX_ENTRIES': LLM_RESPONSE_CACHE_SIZE},
+}
+# Question generation resends prompts to sample new questions, so it bypasses the response cache
+MCQ_USE_RESPONSE_CACHE = False
+# Reranking of chat context: over-fetch RERANK_CANDIDATES chunks, keep the best
+# RERANK_TOP_K by RERANK_METHOD ('mmr', 'cross_encoder' or 'none' for vector
+# distance only), then drop chunks past CHAT_CONTEXT_TOKEN_BUDGET
+RERANK_METHOD = os.environ.get('RERANK_METHOD', 'mmr')
+RERANK_CANDIDATES = 20
+RERANK_TOP_K = 4
+RERANK_MMR_LAMBDA = 0.7  # 1 = relevance only; lower values favour chunks unlike those already picked
+RERANK_CROSS_ENCODER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+CHAT_CONTEXT_TOKEN_BUDGET = 1200  # Estimated LLM tokens of context per chat prompt (0 = no limit)
+# Hybrid search: an SQLite FTS5 keyword index of every chunk, built during
+# ingestion and fused with vector results by reciprocal rank (RRF_K damps the
+# weight of top ranks). Also answers retrieval while the embedding model loads.
+HYBRID_SEARCH = os.environ.get('HYBRID_SEARCH', '1') == '1'
+LEXICAL_INDEX_PATH = BASE_DIR / 'lexical_index.sqlite3'
+RRF_K = 60
@@ -46,7 +46,7 @@ def test_quiz_generation():
     # Test 3: Context Retrieval
     print("\n3. Testing Context Retrieval...")
     context_chunks = ai_service.retrieve_relevant_context(
-        str(document.id), 
+        document.collection_id, 
         "main concepts", 
         n_results=3
     )
@@ -74,7 +74,7 @@ def test_quiz_generation():
     # Test 5: Multiple Questions Generation
     print("\n5. Testing Multiple Questions Generation...")
     questions = ai_service.generate_mcq_questions(
-        str(document.id), 
+        document.collection_id, 
         topic="", 
         page_range="", 
         num_questions=3